@@ -39,12 +39,14 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'core'
 ]
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'core.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -83,7 +85,10 @@ DATABASES = {
         'HOST': os.environ.get('DB_HOST'),
         'NAME': os.environ.get('DB_NAME'),
         'USER': os.environ.get('DB_USER'),
-        'PASSWORD': os.environ.get('DB_PASS')
+        'PASSWORD': os.environ.get('DB_PASS'),
+        # the connections are kept by the worker threads and by the
+        # threads of the ASGI handler between their requests
+        'CONN_MAX_AGE': 60
     }
 }
 
@@ -106,6 +111,17 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# The passwords are hashed in a pool of PASSWORD_HASHING_WORKERS threads,
+# when PASSWORD_HASHING_QUEUE more are waiting, or one waited for
+# PASSWORD_HASHING_TIMEOUT seconds, the next logins and signups get HTTP 503,
+# the staff can watch the queue at /status/password-hashing/. The waiting
+# logins hold the threads of the server, so the queue must stay below them.
+# The model backend of django keeps the sessions it logged in valid.
+AUTHENTICATION_BACKENDS = ['core.passwords.PooledModelBackend', 'django.contrib.auth.backends.ModelBackend']
+PASSWORD_HASHING_WORKERS = 2
+PASSWORD_HASHING_QUEUE = 8
+PASSWORD_HASHING_TIMEOUT = 1.0
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/3.0/topics/i18n/
@@ -128,3 +144,137 @@ STATIC_URL = '/static/'
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
+
+
+# Attachment uploads
+# The attachments are stored by the hash of their content, the uploaded
+# files are hashed by the upload handlers while they are received.
+# Big attachments are uploaded in chunks that are written to part files in
+# the upload directory, it should be on the filesystem of MEDIA_ROOT so the
+# finished uploads are moved instead of copied. The uploads that aren't
+# finished after the expiry are deleted by the clear_expired_uploads command.
+
+FILE_UPLOAD_HANDLERS = [
+    'core.uploadhandlers.HashingMemoryFileUploadHandler',
+    'core.uploadhandlers.HashingTemporaryFileUploadHandler',
+]
+
+ATTACHMENT_UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
+ATTACHMENT_UPLOAD_MAX_SIZE = 500 * 1000 * 1000
+ATTACHMENT_UPLOAD_EXPIRY = 24 * 60 * 60
+
+
+# Attachment downloads
+# The attachments are streamed by the workers, behind nginx or apache the
+# transfer can be handed to the server by setting ATTACHMENT_SENDFILE to
+# 'X-Accel-Redirect' or 'X-Sendfile'. nginx sends the file from an internal
+# location at ATTACHMENT_SENDFILE_URL that is an alias of MEDIA_ROOT:
+#     location /protected/ { internal; alias /path/to/media/; }
+
+ATTACHMENT_SENDFILE = None
+ATTACHMENT_SENDFILE_URL = '/protected/'
+
+
+# Background tasks
+# The work that the requests don't wait for runs in BACKGROUND_WORKERS threads
+# of every server process after the transaction commits, their CPU heavy
+# parts run in a pool of BACKGROUND_PROCESSES worker processes.
+
+BACKGROUND_WORKERS = 2
+BACKGROUND_PROCESSES = 2
+
+
+# Profile photos
+# Square WebP thumbnails of the profile photos are generated by the
+# background threads after the photo is saved, the clients get their URLs
+# in profile_photo_thumbnails. The photos without thumbnails, like the ones
+# whose process exited first, get them with the generate_thumbnails command.
+
+PROFILE_PHOTO_THUMBNAIL_SIZES = (40, 80, 160)
+PROFILE_PHOTO_THUMBNAIL_QUALITY = 80
+
+
+# Attachment previews
+# The metadata of the attachments, and the WebP previews of the images and of
+# the first pages of the PDFs when PyMuPDF is installed, are made by the
+# worker processes after the attachments are saved. The attachments without
+# them get them with the generate_previews command.
+
+ATTACHMENT_PREVIEW_SIZE = 320
+ATTACHMENT_PREVIEW_QUALITY = 75
+
+
+# Cache
+# The notebook trees are cached here, with many server processes it must
+# be a shared cache like memcached or redis for them to see the invalidations.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
+# Rest framework
+# JSON is rendered with orjson if it's installed.
+
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'core.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'core.authentication.AccessTokenAuthentication',
+        'core.authentication.ProfileSessionAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
+    ],
+}
+
+# The logged in users are loaded with their profiles in one query, and kept
+# in the cache for this many seconds when it's set, it must be a shared
+# cache with many server processes so they see the changes of the users.
+AUTH_USER_CACHE_TIMEOUT = 0
+
+# The API clients can log in with tokens instead of sessions, the access
+# tokens are signed and verified without any query, they expire after
+# ACCESS_TOKEN_LIFETIME seconds and the refresh tokens give new ones until
+# REFRESH_TOKEN_LIFETIME seconds after their last refresh. The revoked
+# access tokens are kept in the cache until they expire, with many server
+# processes it must be a shared cache so they're revoked in all of them.
+ACCESS_TOKEN_LIFETIME = 5 * 60
+REFRESH_TOKEN_LIFETIME = 30 * 24 * 60 * 60
+
+
+# Sessions
+# The sessions are read from the database on every request by default.
+# 'core.sessions' keeps them in the cache and writes them to the database
+# in the background threads, the database is only read when the cache
+# doesn't have them, with many server processes it must be a shared cache
+# so a logout is seen by all of them. The signed cookies of
+# 'django.contrib.sessions.backends.signed_cookies' aren't stored at all,
+# but a cookie stays valid after a logout until it expires. The expired
+# sessions of the database are deleted by the sweep_sessions command.
+
+SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+
+
+# Search
+# The backend of the notes search, if it's None the full text search of
+# PostgreSQL is used on PostgreSQL and the in-process index on other databases.
+
+SEARCH_BACKEND = None
+SEARCH_INDEX_PATH = os.path.join(BASE_DIR, 'search_index.journal')
+
+
+# ASGI
+# The ASGI handler runs the views in ASGI_REQUEST_THREADS threads, a request
+# gives its thread back before its body is sent to the client and the next
+# requests wait for one, every thread keeps its database connection.
+
+ASGI_REQUEST_THREADS = 32
+
+
+# Tests
+# The tests keep the journal of the search index in a temporary directory.
+
+TEST_RUNNER = 'core.tests.runner.TestRunner'
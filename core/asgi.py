@@ -0,0 +1,153 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from django.conf import settings
+from django.core import signals
+from django.core.handlers import asgi
+from django.db import connections
+from django.http import FileResponse
+from django.urls import set_script_prefix
+
+_end = object()
+
+
+class ASGIHandler(asgi.ASGIHandler):
+    """The ASGI handler of the API. The views are synchronous, every request
+    runs its view in a thread of the handler and gives the thread back before
+    its body is sent, so a slow client holds no thread while the event loop
+    waits for it. The lists streamed from a database cursor are rendered in
+    the thread of their view, as the cursor belongs to its connection, they
+    are one page of rows. The attachment downloads are read block by block in
+    any thread of the handler, so their file reads never block the event loop.
+    The ASGI_REQUEST_THREADS threads keep their database connections between
+    the requests, the requests over that number wait on the event loop.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._executor = None
+        self._workers = 0
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        """the threads of the handler, they start when they run their first request"""
+
+        with self._lock:
+            if self._executor is None:
+                self._workers = settings.ASGI_REQUEST_THREADS
+                self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='asgi-request')
+            return self._executor
+
+    async def run_in_thread(self, func, *args):
+        """runs a function in a thread of the handler and returns its result"""
+
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(context.run, func, *args))
+
+    def close(self):
+        """closes the database connections of the threads and stops them,
+        when the handler isn't used anymore, like at the end of the tests"""
+
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is None:
+            return
+        barrier = threading.Barrier(self._workers)
+
+        def close_connections():
+            barrier.wait()  # every thread takes one of the calls
+            connections.close_all()
+
+        for future in [executor.submit(close_connections) for _ in range(self._workers)]:
+            future.result()
+        executor.shutdown()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            raise ValueError('Django can only handle ASGI/HTTP connections, not %s.' % scope['type'])
+        try:
+            body_file = await self.read_body(receive)
+        except asgi.RequestAborted:
+            return
+        set_script_prefix(self.get_script_prefix(scope))
+        response = await self.run_in_thread(self.handle_request, scope, body_file)
+        await self.send_response(response, send)
+
+    def handle_request(self, scope, body_file):
+        """runs a request in a thread of the handler, from the request_started
+        signal to the closing of its response, except for the file downloads
+        which are read and closed while they are sent"""
+
+        signals.request_started.send(sender=self.__class__, scope=scope)
+        request, response = self.create_request(scope, body_file)
+        if request is not None:
+            response = self.get_response(request)
+        response._handler_class = self.__class__
+        if isinstance(response, FileResponse):
+            response.block_size = self.chunk_size
+            return response
+        try:
+            if response.streaming:
+                response.streaming_content = list(response)
+        finally:
+            response.close()
+        return response
+
+    @staticmethod
+    def response_headers(response):
+        """returns the headers and the cookies of a response as ASGI headers"""
+
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+        return headers
+
+    async def send_response(self, response, send):
+        """sends a response like the handler of django, the blocks of the
+        file downloads are read and the file is closed in the threads"""
+
+        if not isinstance(response, FileResponse):
+            await send({'type': 'http.response.start', 'status': response.status_code,
+                        'headers': self.response_headers(response)})
+            if response.streaming:
+                for part in response:
+                    for chunk, _ in self.chunk_bytes(part):
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                await send({'type': 'http.response.body'})
+            else:
+                for chunk, last in self.chunk_bytes(response.content):
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': not last})
+            return
+
+        try:
+            await send({'type': 'http.response.start', 'status': response.status_code,
+                        'headers': self.response_headers(response)})
+            iterator = iter(response)
+            while True:
+                part = await self.run_in_thread(next, iterator, _end)
+                if part is _end:
+                    break
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body'})
+        finally:
+            await self.run_in_thread(response.close)
+
+
+def get_asgi_application():
+    """returns the ASGI application of the API, like get_asgi_application of django"""
+
+    django.setup(set_prefix=False)
+    return ASGIHandler()
@@ -0,0 +1,157 @@
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model, load_backend
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.db import router
+from django.shortcuts import get_object_or_404
+from django.utils.crypto import constant_time_compare
+from django.utils.translation import gettext_lazy as _
+from rest_framework.authentication import BaseAuthentication, SessionAuthentication, get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed
+
+from core.models import UserProfileModel
+from core.tokens import read_access_token
+
+
+def user_cache_key(user_id):
+    """returns the cache key of a user with its profile"""
+    return 'auth-user:{0}'.format(user_id)
+
+
+def forget_user(user_id):
+    """Removes a user from the cache after it or its profile changed.
+    Arguments:
+        user_id: the id of the user.
+    """
+    if settings.AUTH_USER_CACHE_TIMEOUT:
+        cache.delete(user_cache_key(user_id))
+
+
+def _load_user(user_id):
+    """returns the user with its profile in one query, from the cache if
+    AUTH_USER_CACHE_TIMEOUT is set, or None if it doesn't exist"""
+
+    timeout = settings.AUTH_USER_CACHE_TIMEOUT
+    if timeout:
+        user = cache.get(user_cache_key(user_id))
+        if user is not None:
+            return user
+    user = get_user_model()._default_manager.select_related('profile').filter(pk=user_id).first()
+    if user is not None and timeout:
+        cache.set(user_cache_key(user_id), user, timeout)
+    return user
+
+
+def get_session_user(request):
+    """Returns the user of a session like django.contrib.auth.get_user,
+    with its profile loaded in the same query, so checking and using
+    the profile later runs no queries.
+    Arguments:
+        request: the Django request.
+    Returns:
+        the logged in user, or None if the session has no valid user.
+    """
+    try:
+        user_id = get_user_model()._meta.pk.to_python(request.session[SESSION_KEY])
+        backend_path = request.session[BACKEND_SESSION_KEY]
+    except KeyError:
+        return None
+    if backend_path not in settings.AUTHENTICATION_BACKENDS:
+        return None
+
+    backend = load_backend(backend_path)
+    if isinstance(backend, ModelBackend):
+        user = _load_user(user_id)
+        if user is not None and not backend.user_can_authenticate(user):
+            user = None
+    else:
+        user = backend.get_user(user_id)  # users of other backends are loaded by them
+    if user is None:
+        return None
+
+    # the session of a user whose password changed is invalid
+    session_hash = request.session.get(HASH_SESSION_KEY)
+    if not session_hash or not constant_time_compare(session_hash, user.get_session_auth_hash()):
+        request.session.flush()
+        return None
+    return user
+
+
+class ProfileSessionAuthentication(SessionAuthentication):
+    """Session authentication that loads the user with its profile in
+    one query, the permission classes and the views share that profile.
+    """
+
+    def authenticate(self, request):
+        user = get_session_user(request._request)
+        if user is None or not user.is_active:
+            return None
+        # the lazy user of AuthenticationMiddleware would load the user again
+        request._request.user = user
+        self.enforce_csrf(request)
+        return user, None
+
+
+def _token_user(payload):
+    """returns the user of an access token with its profile, only their ids
+    are loaded, the other fields are loaded when they're used"""
+
+    user_model = get_user_model()
+    user = user_model.from_db(router.db_for_read(user_model), ['id', 'is_active'], [payload['u'], True])
+    profile = UserProfileModel.from_db(router.db_for_read(UserProfileModel), ['id', 'account_id'],
+                                       [payload['p'], payload['u']])
+    user_model.profile.related.set_cached_value(user, profile)
+    UserProfileModel.account.field.set_cached_value(profile, user)
+    return user
+
+
+def load_profile(request):
+    """Returns the profile of the logged in user with all of its fields and
+    its account, the profile of the token users only has its ids loaded.
+    Arguments:
+        request: the request of the logged in user.
+    """
+    profile = request.user.profile
+    if profile.get_deferred_fields():
+        profile = get_object_or_404(UserProfileModel.objects.select_related('account'), pk=profile.pk)
+    return profile
+
+
+class AccessTokenAuthentication(BaseAuthentication):
+    """Authentication of the API clients by the access tokens in their
+    Authorization header, the token is verified without any query and has
+    the ids of the user and its profile, so the permission classes and
+    the views that only filter by the profile never load them.
+    """
+
+    keyword = 'Bearer'
+
+    def _credentials(self, request):
+        """returns the parts of the Authorization header if it has a bearer token"""
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        return auth
+
+    def authenticate(self, request):
+        auth = self._credentials(request)
+        if auth is None:
+            return None
+        if len(auth) != 2:
+            raise AuthenticationFailed(_('Invalid token header.'))
+        try:
+            payload = read_access_token(auth[1].decode())
+        except UnicodeError:
+            payload = None
+        if payload is None:
+            raise AuthenticationFailed(_('Invalid or expired token.'))
+
+        user = _token_user(payload)
+        request._request.user = user
+        return user, payload['t']
+
+    def authenticate_header(self, request):
+        # only the clients that sent a token are told to refresh it, the others get 403 like with sessions
+        if self._credentials(request) is None:
+            return None
+        return '{0} error="invalid_token"'.format(self.keyword)
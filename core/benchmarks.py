@@ -0,0 +1,467 @@
+"""Benchmarks for the hot paths of the API.
+they are run by the benchmark management command, and every one
+of them runs inside a transaction that is rolled back at the end
+so they never leave data behind in the database."""
+
+import io
+import random
+import time
+from importlib import import_module
+
+from PIL import Image
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, Prefetch, Q, prefetch_related_objects
+from rest_framework.pagination import Cursor, LimitOffsetPagination
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from core.models import UserProfileModel, NoteBookModel, NoteModel, NoteAttachmentModel
+from core.pagination import KeysetPagination, SearchPagination
+from core.renderers import FastJSONRenderer, json_dumps
+from core.search import InvertedIndexBackend, PostgresSearchBackend
+from core.serializers import NoteSerializer, NoteDetailSerializer, NoteBookSerializer, NoteValuesSerializer, \
+    NoteDetailValuesSerializer, NoteBookValuesSerializer, UserProfileSerializer, first_rows
+from core.signals import bulk_unique_slugify
+from core.streaming import StreamingJSONResponse, iterate_in_chunks
+from core.thumbnails import make_thumbnails
+from core.views import NoteBookView, NoteView
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """decorator that registers a benchmark function by its name"""
+
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return register
+
+
+class _Rollback(Exception):
+    """raised to roll back the data created by a benchmark"""
+
+
+def run_benchmark(name, size, report):
+    """runs a registered benchmark inside a rolled back transaction
+    Arguments:
+        name: the name of the benchmark.
+        size: the number of rows the benchmark works on.
+        report: function called with every line of the results.
+    """
+    try:
+        with transaction.atomic():
+            BENCHMARKS[name](size, report)
+            raise _Rollback
+    except _Rollback:
+        pass
+
+
+class Timer:
+    """context manager that measures the time and the queries of its block"""
+
+    def _count(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self.queries = 0
+        self._wrapper = connection.execute_wrapper(self._count)
+        self._wrapper.__enter__()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds = time.perf_counter() - self._start
+        self._wrapper.__exit__(*args)
+
+
+def create_profile(username='benchmark'):
+    """creates a user profile to hold the benchmark data"""
+
+    account = User.objects.create_user(username=username, password='password')
+    return UserProfileModel.objects.create(account=account)
+
+
+def summarize(report, label, timers):
+    """reports the mean latency and queries of a list of timers"""
+
+    count = len(timers) or 1
+    report('{0:<40} {1:>10.3f} ms {2:>8.1f} queries'.format(
+        label, sum(timer.seconds for timer in timers) * 1000 / count,
+        sum(timer.queries for timer in timers) / count))
+
+
+@benchmark('slugs')
+def slugs_benchmark(size, report):
+    """creates size notes with the same title in one notebook
+    and reports the latency and queries per insert"""
+
+    profile = create_profile()
+    notebook = NoteBookModel.objects.create(user=profile, title='notebook')
+
+    timers = []
+    for _ in range(size):
+        with Timer() as timer:
+            NoteModel.objects.create(notebook=notebook, title='Meeting')
+        timers.append(timer)
+
+    step = max(size // 5, 1)
+    for start in range(0, size, step):
+        summarize(report, 'insert {0}-{1}'.format(start + 1, min(start + step, size)),
+                  timers[start:start + step])
+    summarize(report, 'insert (all)', timers)
+
+
+@benchmark('bulk_create')
+def bulk_create_benchmark(size, report):
+    """creates size notes one by one and then in one bulk
+    and reports the latency and queries of both ways"""
+
+    profile = create_profile()
+    notebook = NoteBookModel.objects.create(user=profile, title='notebook')
+    titles = ['Imported note {0}'.format(number % 100) for number in range(size)]
+
+    with Timer() as single:
+        for title in titles:
+            NoteModel.objects.create(notebook=notebook, title=title, text='text')
+    report('{0:<40} {1:>10.3f} ms {2:>8} queries'.format('one by one', single.seconds * 1000, single.queries))
+
+    with Timer() as bulk:
+        notes = [NoteModel(notebook=notebook, title=title, text='text') for title in titles]
+        slugs = bulk_unique_slugify(NoteModel, 'notebook', notebook.pk, titles)
+        for note, slug in zip(notes, slugs):
+            note.slug = slug
+        NoteModel.objects.bulk_create(notes, batch_size=500)
+    report('{0:<40} {1:>10.3f} ms {2:>8} queries'.format('bulk', bulk.seconds * 1000, bulk.queries))
+
+
+@benchmark('pagination')
+def pagination_benchmark(size, report):
+    """fills a notebook with size notes and reports the latency of
+    getting a page at growing depths with offset and cursor pagination"""
+
+    profile = create_profile()
+    notebook = NoteBookModel.objects.create(user=profile, title='notebook')
+    titles = ['note {0}'.format(number) for number in range(size)]
+    notes = [NoteModel(notebook=notebook, title=title, slug=title.replace(' ', '-')) for title in titles]
+    NoteModel.objects.bulk_create(notes, batch_size=500)
+
+    queryset = notebook.notes.all()
+    ids = list(queryset.order_by('id').values_list('id', flat=True))
+    factory = APIRequestFactory()
+
+    for depth in sorted({0, size // 10, size // 2, max(size - 30, 0)}):
+        paginator = LimitOffsetPagination()
+        request = Request(factory.get('/', {'limit': 30, 'offset': depth}))
+        with Timer() as offset_timer:
+            list(paginator.paginate_queryset(queryset.order_by('id'), request))
+
+        paginator = KeysetPagination(page_size=30)
+        request = Request(factory.get('/', {'cursor': ''}))
+        paginator.base_url = request.build_absolute_uri()
+        position = str(ids[depth - 1]) if depth else None
+        cursor = paginator.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+        request = Request(factory.get(cursor))
+        with Timer() as cursor_timer:
+            list(paginator.paginate_queryset(queryset, request))
+
+        report('depth {0:<10} offset {1:>8.3f} ms {2} queries   cursor {3:>8.3f} ms {4} queries'.format(
+            depth, offset_timer.seconds * 1000, offset_timer.queries,
+            cursor_timer.seconds * 1000, cursor_timer.queries))
+
+
+def _random_words(generator, vocabulary, count):
+    """returns count words from the vocabulary with a skewed distribution
+    so that some words are common and most of them are rare"""
+
+    return ' '.join(vocabulary[int(len(vocabulary) * generator.random() ** 3)] for _ in range(count))
+
+
+def fill_notebook_with_words(notebook, size, vocabulary_size=5000):
+    """fills a notebook with size notes of random words and returns the vocabulary"""
+
+    generator = random.Random(size)
+    vocabulary = ['word{0}'.format(number) for number in range(vocabulary_size)]
+    for start in range(0, size, 500):
+        NoteModel.objects.bulk_create([
+            NoteModel(notebook=notebook, slug='note-{0}'.format(number),
+                      title=_random_words(generator, vocabulary, 4),
+                      text=_random_words(generator, vocabulary, 100))
+            for number in range(start, min(start + 500, size))])
+    return vocabulary
+
+
+def report_percentiles(report, label, timers):
+    """reports the median and 95th percentile latency of a list of timers"""
+
+    latencies = sorted(timer.seconds * 1000 for timer in timers)
+    report('{0:<40} p50 {1:>8.3f} ms   p95 {2:>8.3f} ms'.format(
+        label, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)]))
+
+
+@benchmark('search')
+def search_benchmark(size, report):
+    """fills a notebook with size notes of random words and reports
+    the latency of searching them for common, rare and many words"""
+
+    if connection.vendor != 'postgresql':
+        report('full text search needs PostgreSQL, skipped.')
+        return
+
+    profile = create_profile()
+    notebook = NoteBookModel.objects.create(user=profile, title='notebook')
+    vocabulary = fill_notebook_with_words(notebook, size)
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE core_notemodel')
+
+    factory = APIRequestFactory()
+    cases = [('common word', vocabulary[:20]), ('rare word', vocabulary[-20:]),
+             ('two words', ['{0} {1}'.format(a, b) for a, b in zip(vocabulary[:20], vocabulary[20:40])])]
+    for label, queries in cases:
+        timers = []
+        for text in queries:
+            paginator = SearchPagination(page_size=20)
+            with Timer() as timer:
+                list(paginator.paginate_queryset(PostgresSearchBackend().search(profile, text),
+                                                 Request(factory.get('/'))))
+            timers.append(timer)
+        report_percentiles(report, label, timers)
+
+
+@benchmark('search_index')
+def search_index_benchmark(size, report):
+    """fills a notebook with size notes of random words and reports
+    the latency of searching them with the inverted index and with
+    a scan of the notes table for the same words, the scan stops at
+    the first page of matches as it has no rank to order them by"""
+
+    profile = create_profile()
+    notebook = NoteBookModel.objects.create(user=profile, title='notebook')
+    vocabulary = fill_notebook_with_words(notebook, size)
+
+    backend = InvertedIndexBackend()
+    with Timer() as build:
+        backend.rebuild(NoteModel.objects.filter(notebook=notebook)
+                        .values_list('id', 'notebook__user_id', 'title', 'text').iterator())
+    report('{0:<40} {1:>10.3f} ms'.format('build index', build.seconds * 1000))
+
+    factory = APIRequestFactory()
+    cases = [('common word', vocabulary[:20]), ('rare word', vocabulary[-20:]),
+             ('two words', ['{0} {1}'.format(a, b) for a, b in zip(vocabulary[:20], vocabulary[20:40])]),
+             ('prefix', ['{0}*'.format(word) for word in vocabulary[40:60]]),
+             ('phrase', ['"{0} {1}"'.format(a, b) for a, b in zip(vocabulary[:20], vocabulary[20:40])])]
+    for label, queries in cases:
+        index_timers, scan_timers = [], []
+        for text in queries:
+            paginator = SearchPagination(page_size=20)
+            with Timer() as timer:
+                list(paginator.paginate_queryset(backend.search(profile, text), Request(factory.get('/'))))
+            index_timers.append(timer)
+
+            condition = Q()
+            for word in text.strip('"').rstrip('*').split():
+                condition &= Q(title__icontains=word) | Q(text__icontains=word)
+            with Timer() as timer:
+                list(NoteModel.objects.filter(condition, notebook__user=profile).order_by('-id')[:20])
+            scan_timers.append(timer)
+        report_percentiles(report, '{0} (index)'.format(label), index_timers)
+        report_percentiles(report, '{0} (scan)'.format(label), scan_timers)
+
+
+@benchmark('text_edits')
+def text_edits_benchmark(size, report):
+    """autosaves size small edits of a 20 KB and a 200 KB note with a full
+    PUT of the text and with a PATCH of text edits, and reports the bytes
+    sent and received and the latency of every autosave"""
+
+    profile = create_profile()
+    notebook = NoteBookModel.objects.create(user=profile, title='notebook')
+    generator = random.Random(size)
+    vocabulary = ['word{0}'.format(number) for number in range(5000)]
+    factory = APIRequestFactory()
+    view = NoteView.as_view({'put': 'update', 'patch': 'partial_update'})
+
+    def save(method, note, data):
+        request = getattr(factory, method)('/', data, format='json', HTTP_IF_MATCH=note.etag)
+        force_authenticate(request, user=profile.account)
+        sent = len(request.body)
+        with Timer() as timer:
+            response = view(request, notebook_slug=notebook.slug, slug=note.slug).render()
+        assert response.status_code == 200, response.content
+        note.version += 1
+        return timer, sent + len(response.content)
+
+    for kilobytes in (20, 200):
+        text = _random_words(generator, vocabulary, kilobytes * 1000 // 8)
+        for method in ('put', 'patch'):
+            note = NoteModel.objects.create(notebook=notebook, title='{0} {1}'.format(method, kilobytes), text=text)
+            timers, transferred = [], 0
+            for _ in range(size):
+                position = generator.randrange(len(note.text))
+                sentence = ' ' + _random_words(generator, vocabulary, 8)
+                if method == 'put':
+                    note.text = note.text[:position] + sentence + note.text[position:]
+                    data = {'title': note.title, 'text': note.text}
+                else:
+                    data = {'text_edits': [{'position': position, 'insert': sentence}]}
+                    note.text = note.text[:position] + sentence + note.text[position:]
+                timer, sent = save(method, note, data)
+                timers.append(timer)
+                transferred += sent
+            report_percentiles(report, '{0} KB note {1}'.format(kilobytes, method.upper()), timers)
+            report('{0:<40} {1:>10.1f} KB per autosave'.format('  sent and received', transferred / 1000 / size))
+
+
+@benchmark('serialization')
+def serialization_benchmark(size, report):
+    """renders the hot read endpoints size times, a note with attachments,
+    a page of 100 notes and a page of 100 notebooks with their first notes,
+    with the model serializers and the JSON renderer of DRF and with the
+    values serializers and the fast renderer, and reports their requests per second"""
+
+    profile = create_profile()
+    generator = random.Random(size)
+    vocabulary = ['word{0}'.format(number) for number in range(5000)]
+    for number in range(100):
+        notebook = NoteBookModel.objects.create(user=profile, title='notebook {0}'.format(number))
+        NoteModel.objects.bulk_create([
+            NoteModel(notebook=notebook, title='note {0}'.format(index), slug='note-{0}'.format(index),
+                      text=_random_words(generator, vocabulary, 50)) for index in range(100)])
+    notebook = profile.notebooks.order_by('id').first()
+    note = notebook.notes.order_by('id').first()
+    for number in range(10):
+        NoteAttachmentModel.objects.create(note=note, file='attachments/file{0}.txt'.format(number))
+
+    first_notes = NoteModel.objects.order_by('id')
+    notebooks = profile.notebooks.annotate(notes_count=Count('notes')).order_by('id')
+
+    def serializer_note():
+        return JSONRenderer().render(NoteDetailSerializer(NoteModel.objects.get(pk=note.pk)).data)
+
+    def values_note():
+        instance = NoteModel.objects.get(pk=note.pk)
+        row = {'id': instance.id, 'slug': instance.slug, 'title': instance.title, 'text': instance.text}
+        return FastJSONRenderer().render(NoteDetailValuesSerializer(
+            NoteDetailValuesSerializer.add_attachments([row])[0]).data)
+
+    def serializer_notes():
+        return JSONRenderer().render(NoteSerializer(notebook.notes.order_by('id')[:100], many=True).data)
+
+    def values_notes():
+        rows = NoteValuesSerializer.values(notebook.notes.order_by('id'))[:100]
+        return b''.join(StreamingJSONResponse({}, 'notes', iterate_in_chunks(rows, NoteView.chunk_size),
+                                              NoteValuesSerializer))
+
+    def serializer_notebooks():
+        page = list(notebooks[:100])
+        prefetched = first_rows(first_notes.filter(notebook__in=page), 'notebook', NoteBookView.notes_preview_size)
+        prefetch_related_objects(page, Prefetch('notes', queryset=prefetched))
+        return JSONRenderer().render(NoteBookSerializer(page, many=True).data)
+
+    def values_notebooks():
+        rows = NoteBookValuesSerializer.values(notebooks)[:100]
+        chunks = (NoteBookValuesSerializer.add_notes(chunk, first_notes, NoteBookView.notes_preview_size)
+                  for chunk in iterate_in_chunks(rows, NoteBookView.chunk_size))
+        return b''.join(StreamingJSONResponse({}, 'notebooks', chunks, NoteBookValuesSerializer))
+
+    for label, render in (('note with attachments', (serializer_note, values_note)),
+                          ('page of 100 notes', (serializer_notes, values_notes)),
+                          ('page of 100 notebooks', (serializer_notebooks, values_notebooks))):
+        for kind, func in zip(('serializers', 'values'), render):
+            timers = []
+            for _ in range(size):
+                with Timer() as timer:
+                    func()
+                timers.append(timer)
+            name = '{0} ({1})'.format(label, kind)
+            report_percentiles(report, name, timers)
+            report('{0:<40} {1:>10.1f} requests/s'.format(
+                '', len(timers) / sum(timer.seconds for timer in timers)))
+
+
+def _camera_photo(width=1600, height=1200):
+    """returns the JPEG of a noisy image about the size of a phone photo"""
+
+    noise = Image.effect_noise((width, height), 32)
+    gradient = Image.linear_gradient('L').resize((width, height))
+    image = Image.merge('RGB', (noise, gradient, Image.blend(noise, gradient, 0.5)))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+@benchmark('thumbnails')
+def thumbnails_benchmark(size, report):
+    """generates the thumbnails of size // 10 photos and reports their latency,
+    and the bytes a client downloads to show the 40px avatar of a profile,
+    its JSON and the photo before the thumbnails, and its JSON and the
+    smallest thumbnail after them"""
+
+    photo = _camera_photo()
+    timers = []
+    for _ in range(max(size // 10, 1)):
+        with Timer() as timer:
+            thumbnails = make_thumbnails(io.BytesIO(photo), settings.PROFILE_PHOTO_THUMBNAIL_SIZES)
+        timers.append(timer)
+    report_percentiles(report, 'thumbnails of a photo', timers)
+
+    # the files aren't stored, the URLs only need their names
+    profile = create_profile()
+    profile.profile_photo.name = 'users/photo.jpg'
+    data = UserProfileSerializer(profile).data
+    before = len(json_dumps({key: value for key, value in data.items() if key != 'profile_photo_thumbnails'}))
+    profile.thumbnails_of = profile.profile_photo.name
+    after = len(json_dumps(UserProfileSerializer(profile).data))
+    smallest = min(settings.PROFILE_PHOTO_THUMBNAIL_SIZES)
+    for label, json_size, image_size in (('profile view (photo)', before, len(photo)),
+                                         ('profile view ({0}px thumbnail)'.format(smallest), after,
+                                          len(thumbnails[smallest]))):
+        report('{0:<40} {1:>10} bytes ({2} JSON + {3} image)'.format(
+            label, json_size + image_size, json_size, image_size))
+
+
+SESSION_ENGINES = ('django.contrib.sessions.backends.db', 'django.contrib.sessions.backends.cached_db',
+                   'core.sessions', 'django.contrib.sessions.backends.signed_cookies')
+
+
+@benchmark('sessions')
+def sessions_benchmark(size, report):
+    """logs size users in with every session engine and reports the latency
+    and queries that the session adds to the login, to a request that reads
+    it, and to a request that changes it. The background writes of the
+    cached sessions run after commit, so they're never run here."""
+
+    account = create_profile().account
+    data = {SESSION_KEY: str(account.pk), BACKEND_SESSION_KEY: settings.AUTHENTICATION_BACKENDS[0],
+            HASH_SESSION_KEY: account.get_session_auth_hash()}
+    for engine in SESSION_ENGINES:
+        store_class = import_module(engine).SessionStore
+        cache.clear()
+        logins, reads, writes = [], [], []
+        for number in range(size):
+            with Timer() as timer:
+                session = store_class()
+                session.update(data)
+                session.save()
+            logins.append(timer)
+            # the signed cookie sessions are their own keys
+            session_key = session.session_key
+            with Timer() as timer:
+                store_class(session_key)[SESSION_KEY]
+            reads.append(timer)
+            with Timer() as timer:
+                session = store_class(session_key)
+                session['last_request'] = number
+                session.save()
+            writes.append(timer)
+        report(engine)
+        summarize(report, '  login', logins)
+        summarize(report, '  request (read)', reads)
+        summarize(report, '  request (write)', writes)
@@ -0,0 +1,189 @@
+import io
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from rest_framework.exceptions import NotAcceptable
+from rest_framework.negotiation import DefaultContentNegotiation
+
+re_byte_range = re.compile(r'^\s*bytes=(\d*)-(\d*)\s*$')
+
+
+class RangeNotSatisfiable(Exception):
+    """Raised for a byte range that starts after the end of the file"""
+
+
+class DownloadContentNegotiation(DefaultContentNegotiation):
+    """Content negotiation of the download views, the files are sent
+    whatever the client accepts, the renderers are only used for errors"""
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        try:
+            return super().select_renderer(request, renderers, format_suffix)
+        except NotAcceptable:
+            return renderers[0], renderers[0].media_type
+
+
+class FileRange:
+    """A file like object that reads length bytes of
+    a file starting from the current position of the file"""
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """Returns the first and the last byte positions of a Range header.
+    Only a single range of bytes is supported, the whole file is sent for
+    the other ranges as the HTTP spec allows.
+    Arguments:
+        header: the value of the Range header.
+        size: the size of the file.
+    Returns:
+        None if the header is missing or isn't a valid single byte range,
+        if not, returns a tuple of the first and the last positions of the range.
+    Raises:
+        RangeNotSatisfiable if no byte of the file is in the range.
+    """
+    match = re_byte_range.match(header or '')
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # a suffix range of the last bytes of the file
+        if int(last) == 0 or size == 0:
+            raise RangeNotSatisfiable
+        return max(size - int(last), 0), size - 1
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiable
+    return first, min(int(last), size - 1) if last else size - 1
+
+
+def _if_range_matches(request, etag, last_modified):
+    """returns True if the Range of the request can be sent, a range of
+    another version of the file than the If-Range header's is ignored"""
+
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        # If-Range uses the strong comparison, weak ETags never match
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def _sendfile_response(path, name, filename):
+    """returns the response that hands the file to the front server"""
+
+    # the headers of the file without a body, the body is sent by the server
+    response = FileResponse(io.BytesIO(), as_attachment=True, filename=filename)
+    del response['Content-Length']
+    if settings.ATTACHMENT_SENDFILE == 'X-Accel-Redirect':
+        response['X-Accel-Redirect'] = quote(settings.ATTACHMENT_SENDFILE_URL + name)
+    else:
+        response[settings.ATTACHMENT_SENDFILE] = path
+    return response
+
+
+def _stream_response(request, path, size, filename, etag, last_modified, block_size):
+    """returns the response that streams the file or the requested range of it"""
+
+    byte_range = None
+    if _if_range_matches(request, etag, last_modified):
+        try:
+            byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+
+    file = open(path, 'rb')
+    if byte_range is None:
+        response = FileResponse(file, as_attachment=True, filename=filename)
+    else:
+        first, last = byte_range
+        file.seek(first)
+        response = FileResponse(FileRange(file, last - first + 1), as_attachment=True, filename=filename,
+                                status=206)
+        response['Content-Length'] = last - first + 1
+        response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+    response.block_size = block_size
+    return response
+
+
+def file_response(request, path, name, filename, etag, block_size=64 * 1024):
+    """Returns the response that downloads a stored file.
+    The file is read in blocks while it's sent, with support for
+    conditional and range requests. If ATTACHMENT_SENDFILE is set,
+    the file is sent by the front server instead of the workers.
+    Arguments:
+        request: the request of the download.
+        path: the path of the file on the disk.
+        name: the name of the file in the storage.
+        filename: the name the file is downloaded with.
+        etag: the quoted strong ETag of the file's content.
+        block_size: the size of the blocks that the file is read in.
+    Returns:
+        HTTP 404 Response if the file is missing,
+        HTTP 304 or 412 Response for conditional requests,
+        HTTP 416 Response if the range is after the end of the file,
+        HTTP 206 Response with the bytes of a range request, if not,
+        returns HTTP 200 Response with the file.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise Http404
+    last_modified = int(stat.st_mtime)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        if settings.ATTACHMENT_SENDFILE:
+            response = _sendfile_response(path, name, filename)
+        else:
+            response = _stream_response(request, path, stat.st_size, filename, etag, last_modified, block_size)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Accept-Ranges'] = 'bytes'
+    response['Cache-Control'] = 'private'
+    return response
+
+
+def download_url(view_name, request=None, query=None, **kwargs):
+    """Returns the URL of a download view, the stored files aren't served
+    at MEDIA_URL, they're downloaded by their owners from these views.
+    Arguments:
+        view_name: the name of the download view.
+        request: the request that the URL is made absolute with.
+        query: the query string of the URL.
+        kwargs: the arguments of the view's URL.
+    Returns:
+        the URL of the view.
+    """
+    url = reverse(view_name, kwargs=kwargs)
+    if query:
+        url += '?' + query
+    if request is not None:
+        url = request.build_absolute_uri(url)
+    return url
@@ -0,0 +1,201 @@
+"""A load test of the API under WSGI and ASGI in the same process.
+Many clients that read their responses slowly get the notes of a notebook
+and download an attachment at once, the WSGI server is a pool of worker
+threads like a threaded gunicorn, the ASGI servers are the handler of
+django and the handler of the API on one event loop. Unlike the benchmarks,
+the handlers run in other threads that must see the data, so it's
+committed and deleted at the end."""
+
+import asyncio
+import threading
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.handlers.asgi import ASGIHandler as DjangoASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.test import RequestFactory
+from django.urls import reverse
+
+from core.asgi import ASGIHandler
+from core.models import UserProfileModel, NoteBookModel, NoteModel, NoteAttachmentModel, FileDeletionModel
+from core.tokens import issue_tokens
+
+
+class _Results:
+    """the latencies, the errors and the peak of concurrent requests of a server"""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.active = 0
+        self.peak = 0
+        self.peak_threads = threading.active_count()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    def finish(self, started, error):
+        with self._lock:
+            self.active -= 1
+            if error:
+                self.errors += 1
+            else:
+                self.latencies.append(time.perf_counter() - started)
+
+    def report(self, report, label, seconds):
+        latencies = sorted(latency * 1000 for latency in self.latencies)
+        done = len(latencies)
+        p50 = latencies[done // 2] if done else 0
+        p99 = latencies[min(int(done * 0.99), done - 1)] if done else 0
+        report('{0:<16} {1:>8.1f} requests/s   p50 {2:>8.1f} ms   p99 {3:>8.1f} ms   '
+               '{4:>3} concurrent   {5:>3} threads   {6} errors'.format(
+                   label, done / seconds, p50, p99, self.peak, self.peak_threads, self.errors))
+
+
+def _create_data(notes, attachment_size):
+    """creates and commits a user with a notebook of notes and an attachment,
+    returns the user and the paths of the requests with its access token"""
+
+    account = User.objects.create_user(username='loadtest-{0}'.format(uuid.uuid4().hex[:12]), password='password')
+    profile = UserProfileModel.objects.create(account=account)
+    notebook = NoteBookModel.objects.create(user=profile, title='load test')
+    NoteModel.objects.bulk_create([NoteModel(notebook=notebook, title='note {0}'.format(number),
+                                             slug='note-{0}'.format(number), text='text of the note ' * 20)
+                                   for number in range(notes)])
+    note = notebook.notes.get(slug='note-0')
+    attachment = NoteAttachmentModel.objects.create(
+        note=note, file=ContentFile(uuid.uuid4().bytes * (attachment_size // 16), name='load.bin'))
+    paths = [
+        reverse('core:notes-list', kwargs={'notebook_slug': notebook.slug}) + '?limit=100',
+        reverse('core:attachments-download', kwargs={'notebook_slug': notebook.slug, 'note_slug': note.slug,
+                                                      'slug': attachment.slug}),
+    ]
+    return account, paths, issue_tokens(account)['access']
+
+
+def _delete_data(account):
+    """deletes the user of the load test with its notes and its attachment file"""
+
+    account.profile.delete()
+    FileDeletionModel.objects.delete_files(1000)
+
+
+def _run_wsgi(paths, token, clients, requests, workers, delay):
+    """runs the clients in threads against a pool of worker threads,
+    a worker is held until its slow client read the whole response"""
+
+    handler = WSGIHandler()
+    factory = RequestFactory()
+    results = _Results()
+    worker_slots = threading.Semaphore(workers)
+
+    def client(number):
+        for request_number in range(requests):
+            environ = factory.get(paths[(number + request_number) % len(paths)],
+                                  HTTP_AUTHORIZATION='Bearer ' + token).environ
+            started = time.perf_counter()
+            with worker_slots:
+                results.start()
+                error = False
+                try:
+                    response = handler(environ, lambda status, headers, exc_info=None: None)
+                    error = response.status_code != 200
+                    try:
+                        for _ in response:
+                            time.sleep(delay)
+                    finally:
+                        response.close()
+                except Exception:
+                    error = True
+                results.finish(started, error)
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+
+def _run_asgi(handler, paths, token, clients, requests, delay):
+    """runs the clients on one event loop, every client reads slowly"""
+
+    results = _Results()
+
+    async def request(path):
+        path, _, query = path.partition('?')
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                 'scheme': 'http', 'path': path, 'root_path': '', 'query_string': query.encode(),
+                 'headers': [(b'host', b'testserver'), (b'authorization', ('Bearer ' + token).encode())],
+                 'client': ('127.0.0.1', 0), 'server': ('testserver', 80)}
+        status = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+            elif message.get('body'):
+                await asyncio.sleep(delay)
+
+        started = time.perf_counter()
+        results.start()
+        error = False
+        try:
+            await handler(scope, receive, send)
+            error = status != [200]
+        except Exception:
+            error = True
+        results.finish(started, error)
+
+    async def client(number):
+        for request_number in range(requests):
+            await request(paths[(number + request_number) % len(paths)])
+
+    async def main():
+        started = time.perf_counter()
+        await asyncio.gather(*(client(number) for number in range(clients)))
+        return time.perf_counter() - started
+
+    try:
+        seconds = asyncio.run(main())
+    finally:
+        if isinstance(handler, ASGIHandler):
+            handler.close()
+    return results, seconds
+
+
+def run_load_test(report, clients=32, requests=10, workers=4, delay=0.005, notes=500,
+                  attachment_size=1024 * 1024):
+    """Runs the load test and reports the requests per second, the latencies,
+    the peak of concurrent requests and of threads and the errors of every server.
+    Arguments:
+        report: function called with every line of the results.
+        clients: the number of clients that send requests at once.
+        requests: the number of requests every client sends one after another.
+        workers: the number of worker threads of the WSGI server.
+        delay: the seconds a client takes to read every chunk of a response.
+        notes: the number of notes in the notebook.
+        attachment_size: the size of the downloaded attachment in bytes.
+    """
+    account, paths, token = _create_data(notes, attachment_size)
+    try:
+        servers = [
+            ('wsgi ({0} workers)'.format(workers),
+             lambda: _run_wsgi(paths, token, clients, requests, workers, delay)),
+            ('asgi (django)', lambda: _run_asgi(DjangoASGIHandler(), paths, token, clients, requests, delay)),
+            ('asgi (core)', lambda: _run_asgi(ASGIHandler(), paths, token, clients, requests, delay)),
+        ]
+        for label, run in servers:
+            results, seconds = run()
+            results.report(report, label, seconds)
+    finally:
+        _delete_data(account)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.benchmarks import BENCHMARKS, run_benchmark
+
+
+class Command(BaseCommand):
+    """Runs the benchmarks of the API against the configured database."""
+
+    help = 'Runs the API benchmarks, the data they create is rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='benchmarks to run, all of them by default.')
+        parser.add_argument('--size', type=int, default=1000,
+                            help='number of rows every benchmark works on.')
+
+    def handle(self, *args, **options):
+        names = options['names'] or sorted(BENCHMARKS)
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError('Unknown benchmark "{0}", choices are: {1}'.format(
+                    name, ', '.join(sorted(BENCHMARKS))))
+
+        for name in names:
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            run_benchmark(name, options['size'], self.stdout.write)
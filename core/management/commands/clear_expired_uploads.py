@@ -0,0 +1,18 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import NoteAttachmentUploadModel
+
+
+class Command(BaseCommand):
+    """Deletes the attachment uploads that weren't finished before their expiry."""
+
+    help = 'Deletes the unfinished attachment uploads older than ATTACHMENT_UPLOAD_EXPIRY and their part files.'
+
+    def handle(self, *args, **options):
+        expired = timezone.now() - timedelta(seconds=settings.ATTACHMENT_UPLOAD_EXPIRY)
+        count, _ = NoteAttachmentUploadModel.objects.filter(created_at__lt=expired).delete()
+        self.stdout.write(self.style.SUCCESS('Deleted {0} expired uploads.'.format(count)))
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from core.models import NoteAttachmentModel, AttachmentBlobModel, content_name
+
+
+class Command(BaseCommand):
+    """Renames the attachment files stored before the content addressing
+    by the hash of their content, so the files with the same content
+    are stored once. It can be run again if it's interrupted."""
+
+    help = 'Renames the attachment files by the hash of their content and deletes the duplicates.'
+
+    def handle(self, *args, **options):
+        storage = NoteAttachmentModel._meta.get_field('file').storage
+        names = list(NoteAttachmentModel.objects.exclude(file='').order_by('file')
+                     .values_list('file', flat=True).distinct())
+        renamed = missing = freed = 0
+        for name in names:
+            if not storage.exists(name):
+                missing += 1
+                continue
+            with storage.open(name) as file:
+                new_name = content_name(file, name)
+                if new_name == name:
+                    continue
+                if storage.exists(new_name):
+                    freed += storage.size(name)
+                else:
+                    storage.save(new_name, file)
+
+            # the new file is stored before the attachments are moved to it,
+            # and the old one is deleted after, so no attachment loses its file.
+            with transaction.atomic():
+                moved = NoteAttachmentModel.objects.filter(file=name).update(file=new_name)
+                AttachmentBlobModel.objects.filter(name=name).delete()
+                if not AttachmentBlobModel.objects.filter(name=new_name).update(references=F('references') + moved):
+                    AttachmentBlobModel.objects.create(name=new_name, references=moved)
+            storage.delete(name)
+            renamed += 1
+
+        self.stdout.write(self.style.SUCCESS('Renamed {0} files, {1} MB of duplicates were deleted, '
+                                             '{2} files are missing.'.format(renamed, freed // (1000 * 1000),
+                                                                            missing)))
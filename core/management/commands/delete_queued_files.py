@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.models import FileDeletionModel
+
+
+class Command(BaseCommand):
+    """Deletes the queued attachment files that aren't referenced anymore,
+    with --loop it's the background worker that keeps the queue empty,
+    many workers can run at once as they lock different batches."""
+
+    help = 'Deletes the attachment files queued for deletion in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='number of files deleted in every transaction.')
+        parser.add_argument('--loop', action='store_true',
+                            help='keeps running and waits for new files when the queue is empty.')
+        parser.add_argument('--interval', type=float, default=10,
+                            help='seconds to wait between the checks of an empty queue.')
+
+    def handle(self, *args, **options):
+        deleted = 0
+        while True:
+            count = FileDeletionModel.objects.delete_files(options['batch_size'])
+            deleted += count
+            if count < options['batch_size']:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS('Deleted {0} files.'.format(deleted)))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from core.models import NoteAttachmentModel
+from core.thumbnails import generate_attachment_preview
+
+
+class Command(BaseCommand):
+    """Reads the metadata and renders the previews of the attachments that
+    don't have them, like the attachments saved before the previews or
+    the ones whose background task was lost."""
+
+    help = 'Generates the missing metadata and previews of the note attachments.'
+
+    def handle(self, *args, **options):
+        names = list(NoteAttachmentModel.objects.exclude(file='').filter(size__isnull=True).order_by('file')
+                     .values_list('file', flat=True).distinct())
+        generated = failed = 0
+        for name in names:
+            # the other attachments with the same file are saved with the first one
+            attachment_id = NoteAttachmentModel.objects.filter(file=name).values_list('id', flat=True).first()
+            try:
+                generate_attachment_preview(attachment_id)
+                generated += 1
+            except OSError as error:  # a missing file
+                self.stderr.write('{0}: {1}'.format(name, error))
+                failed += 1
+        self.stdout.write(self.style.SUCCESS('Generated the previews of {0} files, {1} failed.'.format(
+            generated, failed)))
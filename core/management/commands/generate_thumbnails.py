@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from core.models import UserProfileModel
+from core.thumbnails import generate_profile_photo_thumbnails
+
+
+class Command(BaseCommand):
+    """Generates the thumbnails of the profile photos that don't have them,
+    like the photos saved before the thumbnails or the ones whose
+    background task was lost, --all generates them again after
+    the sizes are changed."""
+
+    help = 'Generates the missing thumbnails of the profile photos.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='generates the thumbnails of all the photos again.')
+
+    def handle(self, *args, **options):
+        profiles = UserProfileModel.objects.exclude(profile_photo='').exclude(profile_photo=None)
+        if not options['all']:
+            profiles = profiles.exclude(thumbnails_of=F('profile_photo'))
+        generated = failed = 0
+        for profile_id, photo_name in profiles.values_list('id', 'profile_photo').iterator():
+            try:
+                generate_profile_photo_thumbnails(profile_id, photo_name)
+                generated += 1
+            except OSError as error:  # a missing photo or one that isn't an image anymore
+                self.stderr.write('{0}: {1}'.format(photo_name, error))
+                failed += 1
+        self.stdout.write(self.style.SUCCESS('Generated the thumbnails of {0} photos, {1} failed.'.format(
+            generated, failed)))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from core.loadtest import run_load_test
+
+
+class Command(BaseCommand):
+    """Runs the load test of the API under WSGI and ASGI against the configured database."""
+
+    help = 'Compares the capacity and the latency of the WSGI and the ASGI handlers with slow clients.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=32,
+                            help='number of clients that send requests at once.')
+        parser.add_argument('--requests', type=int, default=10,
+                            help='number of requests every client sends.')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='number of worker threads of the WSGI server.')
+        parser.add_argument('--delay', type=float, default=0.005,
+                            help='seconds a client takes to read every chunk of a response.')
+
+    def handle(self, *args, **options):
+        run_load_test(self.stdout.write, clients=options['clients'], requests=options['requests'],
+                      workers=options['workers'], delay=options['delay'])
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import NoteModel
+from core.search import get_search_backend
+
+
+class Command(BaseCommand):
+    """Rebuilds the inverted index search backend from the notes in the database."""
+
+    help = 'Rebuilds the search index from all the notes, it replaces the index journal.'
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        if not hasattr(backend, 'rebuild'):
+            raise CommandError('The {0} search backend has no index to rebuild.'.format(type(backend).__name__))
+
+        notes = NoteModel.objects.values_list('id', 'notebook__user_id', 'title', 'text').iterator()
+        backend.rebuild(notes)
+        self.stdout.write(self.style.SUCCESS('Indexed {0} notes.'.format(NoteModel.objects.count())))
@@ -0,0 +1,39 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import NoteAttachmentModel, AttachmentBlobModel, FileDeletionModel
+
+
+class Command(BaseCommand):
+    """Finds the attachment files that no attachment references, like
+    the files of crashed requests or of deletions before the queue,
+    and queues them to be deleted by delete_queued_files."""
+
+    help = 'Queues the orphaned files in the attachments directory for deletion.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=24 * 60 * 60,
+                            help='seconds since a file was written before it can be swept, '
+                                 'the files of running requests are referenced in their transactions.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='number of files checked in every query.')
+
+    def handle(self, *args, **options):
+        storage = NoteAttachmentModel._meta.get_field('file').storage
+        if not storage.exists('attachments'):
+            self.stdout.write(self.style.SUCCESS('Queued 0 orphaned files.'))
+            return
+        _, files = storage.listdir('attachments')
+        written_before = timezone.now() - timedelta(seconds=options['min_age'])
+
+        orphans = []
+        for start in range(0, len(files), options['batch_size']):
+            names = ['attachments/' + file for file in files[start:start + options['batch_size']]]
+            referenced = set(AttachmentBlobModel.objects.filter(name__in=names).values_list('name', flat=True))
+            orphans.extend(name for name in names
+                           if name not in referenced and storage.get_modified_time(name) < written_before)
+        for start in range(0, len(orphans), options['batch_size']):
+            FileDeletionModel.objects.queue(orphans[start:start + options['batch_size']])
+        self.stdout.write(self.style.SUCCESS('Queued {0} orphaned files.'.format(len(orphans))))
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.sessions import delete_expired_sessions
+from core.tokens import delete_expired_tokens
+
+
+class Command(BaseCommand):
+    """Deletes the expired sessions and refresh tokens of the database in
+    batches, with --loop it's the background worker that keeps their tables
+    small. The signed cookie sessions aren't stored, they have nothing to sweep."""
+
+    help = 'Deletes the expired sessions and refresh tokens from the database in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='number of sessions or tokens deleted in every transaction.')
+        parser.add_argument('--loop', action='store_true',
+                            help='keeps running and sweeps the sessions that expire later.')
+        parser.add_argument('--interval', type=float, default=300,
+                            help='seconds to wait between the sweeps.')
+
+    def handle(self, *args, **options):
+        sessions = tokens = 0
+        while True:
+            session_count = delete_expired_sessions(options['batch_size'])
+            token_count = delete_expired_tokens(options['batch_size'])
+            sessions += session_count
+            tokens += token_count
+            if max(session_count, token_count) < options['batch_size']:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS('Deleted {0} expired sessions and {1} expired tokens.'.format(
+            sessions, tokens)))
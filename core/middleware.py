@@ -0,0 +1,64 @@
+import re
+
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # brotli is in the requirements, the responses are gzipped without it
+    brotli = None
+
+re_accepts_brotli = re.compile(r'\bbr\b')
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """Compresses the responses with the encoding the client accepts.
+    Brotli is used if the client accepts it and the brotli package is
+    installed, if not, the responses are gzipped like GZipMiddleware does.
+    Streaming responses are compressed chunk by chunk as they are written,
+    the file downloads that accept byte ranges aren't compressed.
+    """
+
+    brotli_quality = 5
+
+    def process_response(self, request, response):
+        """compresses the response with brotli or gzip if it's worth it"""
+        # the byte ranges of the downloads are positions in the file, so they're sent as they are
+        if response.has_header('Accept-Ranges') or response.has_header('Content-Range'):
+            return response
+        if brotli is None or not re_accepts_brotli.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+            return super().process_response(request, response)
+
+        # the same rules GZipMiddleware follows
+        if not response.streaming and len(response.content) < 200:
+            return response
+        if response.has_header('Content-Encoding'):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        if response.streaming:
+            response.streaming_content = self._compress_sequence(response.streaming_content)
+            del response['Content-Length']
+        else:
+            compressed_content = brotli.compress(response.content, quality=self.brotli_quality)
+            if len(compressed_content) >= len(response.content):
+                return response
+            response.content = compressed_content
+            response['Content-Length'] = str(len(response.content))
+
+        # the compressed body isn't byte for byte the same anymore
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = 'br'
+        return response
+
+    def _compress_sequence(self, sequence):
+        """compresses every chunk of a streaming response as it's written"""
+        compressor = brotli.Compressor(quality=self.brotli_quality)
+        for chunk in sequence:
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
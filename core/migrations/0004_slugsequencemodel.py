@@ -0,0 +1,25 @@
+# Generated by Django 3.0.7 on 2026-10-17 11:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_auto_20200313_1745'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlugSequenceModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=100)),
+                ('base', models.CharField(max_length=255)),
+                ('last', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('scope', 'base')},
+            },
+        ),
+    ]
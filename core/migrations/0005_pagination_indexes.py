@@ -0,0 +1,21 @@
+# Generated by Django 3.0.7 on 2026-10-17 11:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_slugsequencemodel'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notebookmodel',
+            index=models.Index(fields=['user', 'id'], name='core_notebo_user_id_10503c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notemodel',
+            index=models.Index(fields=['notebook', 'id'], name='core_notemo_noteboo_7abdb2_idx'),
+        ),
+    ]
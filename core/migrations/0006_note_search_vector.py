@@ -0,0 +1,55 @@
+# Generated by Django 3.0.7 on 2026-10-17 11:51
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+CREATE_SEARCH_TRIGGER = """
+CREATE FUNCTION core_notemodel_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := setweight(to_tsvector('pg_catalog.english', coalesce(NEW.title, '')), 'A') ||
+                         setweight(to_tsvector('pg_catalog.english', coalesce(NEW.text, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER core_notemodel_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, text ON core_notemodel
+    FOR EACH ROW EXECUTE PROCEDURE core_notemodel_search_vector_update();
+
+UPDATE core_notemodel SET title = title;
+
+CREATE INDEX core_notemodel_search_vector_idx ON core_notemodel USING gin (search_vector);
+"""
+
+DROP_SEARCH_TRIGGER = """
+DROP INDEX IF EXISTS core_notemodel_search_vector_idx;
+DROP TRIGGER IF EXISTS core_notemodel_search_vector_trigger ON core_notemodel;
+DROP FUNCTION IF EXISTS core_notemodel_search_vector_update();
+"""
+
+
+def create_search_trigger(apps, schema_editor):
+    """the search vector is only maintained on PostgreSQL"""
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_SEARCH_TRIGGER)
+
+
+def drop_search_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_SEARCH_TRIGGER)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notemodel',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_trigger, drop_search_trigger),
+    ]
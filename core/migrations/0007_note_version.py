@@ -0,0 +1,23 @@
+# Generated by Django 3.0.7 on 2026-10-17 12:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_note_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notemodel',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='notemodel',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 3.0.7 on 2026-10-17 12:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def record_existing_rows(apps, schema_editor):
+    """records a change for every existing notebook, note and attachment,
+    so the clients that sync from the start of the feed get all of them"""
+
+    ChangeModel = apps.get_model('core', 'ChangeModel')
+    sources = [
+        ('notebook', apps.get_model('core', 'NoteBookModel').objects.values_list('id', 'user_id')),
+        ('note', apps.get_model('core', 'NoteModel').objects.values_list('id', 'notebook__user_id')),
+        ('attachment', apps.get_model('core', 'NoteAttachmentModel').objects
+         .values_list('id', 'note__notebook__user_id')),
+    ]
+    for kind, rows in sources:
+        changes = (ChangeModel(kind=kind, object_id=object_id, user_id=user_id)
+                   for object_id, user_id in rows.order_by('id').iterator())
+        while True:
+            batch = [change for _, change in zip(range(500), changes)]
+            if not batch:
+                break
+            ChangeModel.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_note_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeModel',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('notebook', 'NoteBook'), ('note', 'Note'), ('attachment', 'Attachment')], max_length=10)),
+                ('object_id', models.PositiveIntegerField()),
+                ('deleted', models.BooleanField(default=False)),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='changes', to='core.UserProfileModel')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='changemodel',
+            index=models.Index(fields=['user', 'id'], name='core_change_user_id_a17d0a_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='changemodel',
+            unique_together={('kind', 'object_id')},
+        ),
+        migrations.RunPython(record_existing_rows, migrations.RunPython.noop),
+    ]
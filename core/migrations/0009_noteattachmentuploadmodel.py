@@ -0,0 +1,26 @@
+# Generated by Django 3.0.7 on 2026-10-17 12:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_changemodel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NoteAttachmentUploadModel',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('filename', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('offset', models.BigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('note', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='uploads', to='core.NoteModel')),
+            ],
+        ),
+    ]
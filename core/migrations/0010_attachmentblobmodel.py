@@ -0,0 +1,45 @@
+# Generated by Django 3.0.7 on 2026-10-17 12:35
+
+import core.models
+import core.storage
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_existing_references(apps, schema_editor):
+    """counts the references of the existing attachments to their files,
+    the files keep their names until the dedupe_attachments command
+    renames them by their content"""
+
+    AttachmentBlobModel = apps.get_model('core', 'AttachmentBlobModel')
+    counts = apps.get_model('core', 'NoteAttachmentModel').objects.exclude(file='') \
+        .values_list('file').annotate(references=Count('id')).order_by('file')
+    blobs = (AttachmentBlobModel(name=name, references=references) for name, references in counts.iterator())
+    while True:
+        batch = [blob for _, blob in zip(range(500), blobs)]
+        if not batch:
+            break
+        AttachmentBlobModel.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_noteattachmentuploadmodel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AttachmentBlobModel',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('references', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='noteattachmentmodel',
+            name='file',
+            field=models.FileField(storage=core.storage.ContentAddressedStorage(), upload_to=core.models.attachment_upload, validators=[core.models.filesize]),
+        ),
+        migrations.RunPython(count_existing_references, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.0.7 on 2026-10-17 12:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_attachmentblobmodel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileDeletionModel',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('queued_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-17 12:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_filedeletionmodel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofilemodel',
+            name='thumbnails_of',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+    ]
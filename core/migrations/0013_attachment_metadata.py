@@ -0,0 +1,38 @@
+# Generated by Django 3.0.7 on 2026-10-17 12:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_userprofilemodel_thumbnails_of'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='noteattachmentmodel',
+            name='content_type',
+            field=models.CharField(blank=True, editable=False, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='noteattachmentmodel',
+            name='has_preview',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='noteattachmentmodel',
+            name='height',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='noteattachmentmodel',
+            name='size',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='noteattachmentmodel',
+            name='width',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+    ]
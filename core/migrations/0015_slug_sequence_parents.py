@@ -0,0 +1,59 @@
+# Generated by Django 3.0.7 on 2026-10-17 14:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# the scopes of the sequences, the label of the slugged model and the parent field, with the parent model
+SEQUENCE_PARENTS = (('core.notebookmodel', 'user', 'UserProfileModel'),
+                    ('core.notemodel', 'notebook', 'NoteBookModel'),
+                    ('core.noteattachmentmodel', 'note', 'NoteModel'))
+
+
+def link_sequences_to_parents(apps, schema_editor):
+    """sets the parents of the existing sequences from their scopes,
+    the sequences of the parents that were already deleted are deleted"""
+
+    SlugSequenceModel = apps.get_model('core', 'SlugSequenceModel')
+    for label, parent, parent_model in SEQUENCE_PARENTS:
+        Parent = apps.get_model('core', parent_model)
+        sequences = SlugSequenceModel.objects.filter(scope__startswith=label + ':').order_by('pk').only('scope')
+        last = 0
+        while True:
+            batch = list(sequences.filter(pk__gt=last)[:500])
+            if not batch:
+                break
+            last = batch[-1].pk
+            for sequence in batch:
+                setattr(sequence, parent + '_id', int(sequence.scope.rpartition(':')[2]))
+            existing = set(Parent.objects.filter(pk__in={getattr(sequence, parent + '_id') for sequence in batch})
+                           .values_list('pk', flat=True))
+            SlugSequenceModel.objects.filter(pk__in=[sequence.pk for sequence in batch
+                                                     if getattr(sequence, parent + '_id') not in existing]).delete()
+            SlugSequenceModel.objects.bulk_update([sequence for sequence in batch
+                                                   if getattr(sequence, parent + '_id') in existing], [parent])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_authtokenmodel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='slugsequencemodel',
+            name='note',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.NoteModel'),
+        ),
+        migrations.AddField(
+            model_name='slugsequencemodel',
+            name='notebook',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.NoteBookModel'),
+        ),
+        migrations.AddField(
+            model_name='slugsequencemodel',
+            name='user',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.UserProfileModel'),
+        ),
+        migrations.RunPython(link_sequences_to_parents, migrations.RunPython.noop),
+    ]
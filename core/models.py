@@ -1,10 +1,19 @@
 #  Copyright (c) Code Written and Tested by Ahmed Emad in 13/03/2020, 20:02.
 
+import hashlib
+import os
 import uuid
+from collections import Counter
 
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.postgres.search import SearchVectorField
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.core.files import File
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
+
+from core.storage import ContentAddressedStorage
 
 
 def users_upload(instance, filename):
@@ -20,57 +29,209 @@ def users_upload(instance, filename):
     return 'users/{0}{1}'.format(uuid.uuid4().hex, filename)
 
 
+def content_hash(file):
+    """Returns the sha256 of the content of a file. Uploaded files are hashed
+    while they are received by the hashing upload handlers, other
+    files are read once and their hash is kept on them."""
+
+    digest = getattr(file, 'sha256', None)
+    if digest is None:
+        sha256 = hashlib.sha256()
+        for chunk in file.chunks():
+            sha256.update(chunk)
+        digest = file.sha256 = sha256.hexdigest()
+    return digest
+
+
+# the longest format kept in the names of the attachment files, so that
+# they fit the 100 characters of the file and the blob name fields
+MAX_FORMAT_LENGTH = 100 - len('attachments/') - 64
+
+
+def content_name(file, filename):
+    """Returns the path of an attachment file from the hash of its content
+    and the format of its name, files with the same content and format
+    have the same path so they are stored once. The formats that are
+    too long are cut."""
+
+    return 'attachments/{0}{1}'.format(content_hash(file), os.path.splitext(filename)[1][:MAX_FORMAT_LENGTH])
+
+
+def preview_name(name):
+    """Returns the path of the preview of an attachment file, it's named by
+    the file, so the attachments with the same content share it."""
+
+    return 'previews/{0}.webp'.format(os.path.splitext(os.path.basename(name))[0])
+
+
 def attachment_upload(instance, filename):
-    """Gives a unique path to the saved attachment file in models.
+    """Gives the content addressed path to the saved attachment file in models.
     Arguments:
-        instance: the model itself, it is not used in this
-                  function but it's required by django.
+        instance: the model itself, its file is hashed to get the path.
         filename: the name of the file sent by user, it's
                   used here to get the format of the file.
     Returns:
-        The unique path that the file will be stored in the DB.
+        The path that the file will be stored in the DB,
+        it's the same for files with the same content.
     """
-    return 'attachments/{0}{1}'.format(uuid.uuid4().hex, filename)
+    return content_name(instance.file.file, filename)
+
+
+class TrackedFieldsModel(models.Model):
+    """An abstract Model that remembers the values its tracked fields
+    had in the database to tell which of them were changed before saving."""
+
+    tracked_fields = ()
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_values = instance._tracked_values()
+        return instance
+
+    def _tracked_values(self):
+        """returns the current values of the loaded tracked fields"""
+        values = {}
+        for name in self.tracked_fields:
+            field = self._meta.get_field(name)
+            if field.attname in self.__dict__:  # deferred fields are not loaded
+                values[name] = field.get_prep_value(field.value_from_object(self))
+        return values
+
+    def has_changed(self, *fields):
+        """Checks if any of the given tracked fields changed
+        since the instance was loaded from or saved to the database.
+        Arguments:
+            fields: the names of the tracked fields to check.
+        Returns:
+            True if any of the fields changed or the instance
+            was never loaded from the database, if not, False.
+        """
+        saved_values = getattr(self, '_saved_values', None)
+        if self.pk is None or saved_values is None:
+            return True
+        current_values = self._tracked_values()
+        return any(name not in saved_values or current_values.get(name) != saved_values[name]
+                   for name in fields)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._saved_values = self._tracked_values()
 
-class UserProfileModel(models.Model):
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using, fields)
+        self._saved_values = self._tracked_values()
+
+
+class UserProfileModel(TrackedFieldsModel):
     """The Model of the User Profile."""
 
+    tracked_fields = ('profile_photo',)
+
     account = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     profile_photo = models.ImageField(upload_to=users_upload, null=True)
+    # the name of the photo that the thumbnails were generated for
+    thumbnails_of = models.CharField(max_length=100, blank=True, default='')
 
     def __str__(self):
         return self.account.username
 
 
-class NoteBookModel(models.Model):
+class SlugSequenceModel(models.Model):
+    """The Model of the slug sequences, it keeps the last number
+    given to a slug base inside a parent so that the next unique
+    slug is allocated without probing the taken ones. The foreign
+    key to the parent is named like the parent field of the slugged
+    model, so the sequences are deleted with their parent."""
+
+    scope = models.CharField(max_length=100)
+    base = models.CharField(max_length=255)
+    last = models.PositiveIntegerField(default=0)
+    user = models.ForeignKey(UserProfileModel, on_delete=models.CASCADE, null=True, related_name='+')
+    notebook = models.ForeignKey('NoteBookModel', on_delete=models.CASCADE, null=True, related_name='+')
+    note = models.ForeignKey('NoteModel', on_delete=models.CASCADE, null=True, related_name='+')
+
+    class Meta:
+        unique_together = ("scope", "base")
+
+    def __str__(self):
+        return '{0} {1}'.format(self.scope, self.base)
+
+
+class NoteBookModel(TrackedFieldsModel):
     """The Model of the NoteBooks."""
 
+    tracked_fields = ('user', 'title')
+
     slug = models.SlugField(max_length=255)
     user = models.ForeignKey(UserProfileModel, on_delete=models.CASCADE, related_name='notebooks')
     title = models.CharField(max_length=255)
 
     class Meta:
         unique_together = ("user", "slug")
+        indexes = [models.Index(fields=['user', 'id'])]  # for the cursor pagination
 
     def __str__(self):
         return self.title
 
 
-class NoteModel(models.Model):
+class NoteManager(models.Manager):
+    """The Manager of the Note, it doesn't load the search
+    vector of the notes which is as big as their text."""
+
+    def get_queryset(self):
+        return super().get_queryset().defer('search_vector')
+
+    def touch(self, *note_ids):
+        """Increases the versions of notes without saving them,
+        for the changes of their attachments which are part of them.
+        Arguments:
+            note_ids: the ids of the notes that changed.
+        """
+        return self.filter(pk__in=note_ids).update(version=models.F('version') + 1, updated_at=timezone.now())
+
+
+class NoteModel(TrackedFieldsModel):
     """The Model of the Note."""
 
+    tracked_fields = ('notebook', 'title')
+
     slug = models.SlugField(max_length=255)
     notebook = models.ForeignKey(NoteBookModel, on_delete=models.CASCADE, related_name='notes')
     title = models.CharField(max_length=255)
     text = models.TextField(blank=True)
+    # kept up to date from the title and text by a trigger on PostgreSQL,
+    # its GIN index is created by the migration too.
+    search_vector = SearchVectorField(null=True, editable=False)
+    # increased on every save, the note's ETag is made from it
+    version = models.PositiveIntegerField(default=1, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = NoteManager()
 
     class Meta:
         unique_together = ("notebook", "slug")
+        indexes = [models.Index(fields=['notebook', 'id'])]  # for the cursor pagination
 
     def __str__(self):
         return self.title
 
+    @property
+    def etag(self):
+        """the strong ETag of the note, it changes whenever the note is saved"""
+        return '"%s-%s"' % (self.pk, self.version)
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None and not self._state.adding:
+            self.version += 1
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'version', 'updated_at'}
+        super().save(*args, **kwargs)
+
 
 def filesize(value):
     """Model Validator for file size limit"""
@@ -79,13 +240,223 @@ def filesize(value):
         raise ValidationError('File too large. Size should not exceed 2 MB.')
 
 
-class NoteAttachmentModel(models.Model):
+class AttachmentBlobManager(models.Manager):
+    """The manager of the reference counts of the attachment files"""
+
+    def reference(self, name):
+        """Adds a reference to an attachment file, its row is
+        created by its first reference.
+        Arguments:
+            name: the name of the file in the storage.
+        """
+        while True:
+            if self.filter(name=name).update(references=models.F('references') + 1):
+                return
+            # a file that is referenced again isn't deleted, if the worker is deleting it
+            # right now this waits for it, and the file is stored again after that
+            FileDeletionModel.objects.cancel(name, preview_name(name))
+            try:
+                with transaction.atomic():
+                    self.create(name=name, references=1)
+                return
+            except IntegrityError:
+                continue  # created by another transaction in the meantime
+
+    def release(self, names):
+        """Removes references from attachment files, a reference for every
+        time a name is given, and deletes the rows of the files that
+        aren't referenced anymore. It runs three queries for any number of names.
+        Arguments:
+            names: the names of the files in the storage.
+        Returns:
+            the names of the files that aren't referenced anymore.
+        """
+        counts = Counter(names)
+        if not counts:
+            return []
+        self.filter(name__in=counts).update(references=models.F('references') - models.Case(
+            *[models.When(name=name, then=models.Value(count)) for name, count in counts.items()],
+            output_field=models.PositiveIntegerField()))
+        unreferenced = list(self.filter(name__in=counts, references=0).values_list('name', flat=True))
+        if unreferenced:
+            self.filter(name__in=unreferenced).delete()
+        return unreferenced
+
+
+class AttachmentBlobModel(models.Model):
+    """The Model of the reference counts of the attachment files,
+    the attachments with the same content share their file which is
+    deleted when the last attachment that references it is deleted."""
+
+    name = models.CharField(max_length=100, primary_key=True)
+    references = models.PositiveIntegerField(default=0)
+
+    objects = AttachmentBlobManager()
+
+    def __str__(self):
+        return '{0} {1}'.format(self.name, self.references)
+
+
+class FileDeletionManager(models.Manager):
+    """The manager of the queue of the attachment files to delete"""
+
+    def queue(self, names):
+        """Queues attachment files to be deleted by the worker, they're
+        queued in the transaction that stopped referencing them,
+        so they aren't deleted if it's rolled back.
+        Arguments:
+            names: the names of the files in the storage.
+        """
+        if names:
+            self.bulk_create([self.model(name=name) for name in names], ignore_conflicts=True)
+
+    def cancel(self, *names):
+        """Removes files that are referenced again from the queue.
+        Arguments:
+            names: the names of the files in the storage.
+        """
+        self.filter(name__in=names).delete()
+
+    def delete_files(self, batch_size):
+        """Deletes a batch of the queued files from the storage, the rows
+        of the batch are locked until the files are deleted, and the
+        rows locked by other workers are skipped.
+        Arguments:
+            batch_size: the maximum number of files to delete.
+        Returns:
+            the number of deleted files.
+        """
+        storage = NoteAttachmentModel._meta.get_field('file').storage
+        with transaction.atomic():
+            names = list(self.select_for_update(skip_locked=True).order_by('queued_at')
+                         .values_list('name', flat=True)[:batch_size])
+            for name in names:
+                storage.delete(name)
+            if names:
+                self.filter(name__in=names).delete()
+        return len(names)
+
+
+class FileDeletionModel(models.Model):
+    """The Model of the queue of the attachment files that aren't
+    referenced anymore, the files are deleted by the
+    delete_queued_files command outside of the requests."""
+
+    name = models.CharField(max_length=100, primary_key=True)
+    queued_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    objects = FileDeletionManager()
+
+    def __str__(self):
+        return self.name
+
+
+class AuthTokenModel(models.Model):
+    """The Model of the refresh tokens of the API clients that log in with
+    tokens. A client gets its id and a secret, only the hash of the secret
+    is stored and it's replaced at every refresh. The access tokens have its
+    id, so deleting it revokes them before they expire."""
+
+    id = models.CharField(max_length=32, primary_key=True)
+    account = models.ForeignKey(User, on_delete=models.CASCADE, related_name='auth_tokens')
+    secret_hash = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return '{0} {1}'.format(self.account_id, self.id)
+
+
+class NoteAttachmentModel(TrackedFieldsModel):
     """an alias to filefield to enable
     having multiple file attachments in a Note"""
 
+    tracked_fields = ('note', 'file')
+
     slug = models.SlugField(max_length=255)
     note = models.ForeignKey(NoteModel, on_delete=models.CASCADE, related_name='attachments')
-    file = models.FileField(upload_to=attachment_upload, validators=[filesize])
+    file = models.FileField(upload_to=attachment_upload, validators=[filesize], storage=ContentAddressedStorage())
+    # the metadata of the file, they're read by the background tasks after it's saved
+    content_type = models.CharField(max_length=100, blank=True, editable=False)
+    size = models.BigIntegerField(null=True, editable=False)
+    width = models.PositiveIntegerField(null=True, editable=False)
+    height = models.PositiveIntegerField(null=True, editable=False)
+    has_preview = models.BooleanField(default=False, editable=False)
 
     class Meta:
         unique_together = ("note", "slug")
+
+
+class PartFile(File):
+    """The opened part file of a finished upload with the name of the
+    uploaded file, the storage moves it to the attachment's path
+    instead of copying it"""
+
+    def __init__(self, file, name):
+        super().__init__(file, name)
+        self.path = file.name
+
+    def temporary_file_path(self):
+        return self.path
+
+
+class NoteAttachmentUploadModel(models.Model):
+    """An upload of a note attachment that is sent in chunks.
+    The received bytes are written to its part file until its offset
+    reaches its size, then it's finished into an attachment.
+    Its id is random as it's all that is needed to resume the upload."""
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    note = models.ForeignKey(NoteModel, on_delete=models.CASCADE, related_name='uploads')
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '{0} {1}/{2}'.format(self.filename, self.offset, self.size)
+
+    @property
+    def path(self):
+        """the path of the part file that the received bytes are written to"""
+        return os.path.join(settings.ATTACHMENT_UPLOAD_DIR, '{0}.part'.format(self.id.hex))
+
+    def finish(self):
+        """Creates the attachment of the complete upload from its part file
+        and deletes the upload.
+        Returns:
+            the created note attachment.
+        """
+        with open(self.path, 'rb') as part:
+            attachment = NoteAttachmentModel(note=self.note, file=PartFile(part, self.filename))
+            attachment.save()
+        self.delete()
+        return attachment
+
+
+class ChangeModel(models.Model):
+    """The Model of the change feed, it keeps the last change of
+    every notebook, note and attachment, deleted ones included.
+    Its id is the position of the change in the feed, every change
+    of an object replaces its row with a new one at the end."""
+
+    NOTEBOOK = 'notebook'
+    NOTE = 'note'
+    ATTACHMENT = 'attachment'
+    KIND_CHOICES = ((NOTEBOOK, 'NoteBook'), (NOTE, 'Note'), (ATTACHMENT, 'Attachment'))
+
+    id = models.BigAutoField(primary_key=True)
+    # no constraint as the changes of a deleted user are recorded before
+    # its profile is deleted, they are deleted after it by a signal.
+    user = models.ForeignKey(UserProfileModel, on_delete=models.DO_NOTHING, db_constraint=False,
+                             related_name='changes')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.PositiveIntegerField()
+    deleted = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ("kind", "object_id")
+        indexes = [models.Index(fields=['user', 'id'])]  # for reading the feed since a change
+
+    def __str__(self):
+        return '{0} {1} {2}'.format(self.kind, self.object_id, 'deleted' if self.deleted else 'saved')
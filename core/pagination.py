@@ -0,0 +1,54 @@
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+
+
+class KeysetPagination(CursorPagination):
+    """Cursor pagination ordered by the primary key.
+    Every page is fetched with an indexed 'id > last id' query,
+    so deep pages cost the same as the first one and no COUNT(*) is run.
+    It's used by the list views when the request has a 'cursor'
+    query parameter, which is empty for the first page.
+    """
+
+    ordering = 'id'
+    page_size_query_param = 'limit'
+    max_page_size = 100
+
+    def __init__(self, page_size):
+        self.page_size = page_size
+
+    @classmethod
+    def is_requested(cls, request):
+        """Checks if the request asks for cursor pagination."""
+        return cls.cursor_query_param in request.query_params
+
+
+class SearchPagination(KeysetPagination):
+    """Cursor pagination of the search results ordered by their score,
+    notes with the same score are ordered by the newest first."""
+
+    ordering = ('-score', '-id')
+
+
+class StreamingLimitOffsetPagination(LimitOffsetPagination):
+    """Limit and offset pagination that returns the page as a sliced
+    queryset instead of a list, so the rows of the page can be
+    streamed from the database cursor as they are rendered."""
+
+    def __init__(self, default_limit, max_limit):
+        self.default_limit = default_limit
+        self.max_limit = max_limit
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = self.get_count(queryset)
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+
+        self.offset = self.get_offset(request)
+        self.request = request
+        if self.count > self.limit and self.template is not None:
+            self.display_page_controls = True
+
+        if self.count == 0 or self.offset > self.count:
+            return queryset.none()
+        return queryset[self.offset:self.offset + self.limit]
@@ -0,0 +1,107 @@
+import logging
+
+from django.conf import settings
+from django.contrib.auth import get_user_model, hashers
+from django.contrib.auth.backends import ModelBackend
+from django.core.exceptions import PermissionDenied
+from django.utils.translation import gettext_lazy as _
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from core.tasks import BoundedExecutor, Overloaded
+
+logger = logging.getLogger(__name__)
+
+# the hashers of hashlib release the GIL, so the threads of the pool
+# bound the cores that the password hashing takes from the requests
+_pool = BoundedExecutor(settings.PASSWORD_HASHING_WORKERS, settings.PASSWORD_HASHING_QUEUE,
+                        thread_name_prefix='password-hashing', timeout=settings.PASSWORD_HASHING_TIMEOUT)
+
+
+class PasswordHashingBusy(APIException):
+    """Raised when too many passwords are waiting to be hashed,
+    the client gets HTTP 503 with a Retry-After header"""
+
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = _('Too many logins at once, try again in a moment.')
+    default_code = 'password_hashing_busy'
+    wait = 1
+
+
+def _hash(func, *args):
+    """runs a password hashing function in the pool"""
+
+    try:
+        return _pool.run(func, *args)
+    except Overloaded:
+        logger.warning('Password hashing is full, %(running)d running and %(waiting)d waiting', _pool.stats())
+        raise PasswordHashingBusy
+
+
+def _check(password, encoded):
+    """returns if the password is right and if its hash must be upgraded,
+    the upgrade is saved by the caller as the pool doesn't use the database"""
+
+    upgrades = []
+    return hashers.check_password(password, encoded, setter=upgrades.append), bool(upgrades)
+
+
+def make_password(password):
+    """Returns the hash of a password, hashed in the pool.
+    Raises:
+        PasswordHashingBusy if the pool is full.
+    """
+    return _hash(hashers.make_password, password)
+
+
+def set_password(user, password):
+    """Sets the password of a user like User.set_password, hashed in the pool.
+    Raises:
+        PasswordHashingBusy if the pool is full.
+    """
+    user.password = make_password(password)
+    user._password = password  # for the password validators after the user is saved
+
+
+def check_password(user, password):
+    """Checks the password of a user like User.check_password, hashed in the
+    pool, the hash is upgraded if the hasher or its iterations changed.
+    Raises:
+        PasswordHashingBusy if the pool is full.
+    """
+    is_correct, must_upgrade = _hash(_check, password, user.password)
+    if is_correct and must_upgrade:
+        set_password(user, password)
+        user._password = None
+        user.save(update_fields=['password'])
+    return is_correct
+
+
+def hashing_stats():
+    """returns the counters of the password hashing pool"""
+    return _pool.stats()
+
+
+class PooledModelBackend(ModelBackend):
+    """The model backend of django that hashes the passwords in the bounded
+    pool, the logins, the signups and the basic authentication share it, so
+    a burst of logins can't take all the threads and cores of the server.
+    The model backend of django stays after it in AUTHENTICATION_BACKENDS for
+    the sessions it logged in, the failed logins end here so it never hashes
+    their passwords again outside the pool."""
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        user_model = get_user_model()
+        if username is None:
+            username = kwargs.get(user_model.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = user_model._default_manager.get_by_natural_key(username)
+        except user_model.DoesNotExist:
+            # hashing anyway so the missing users take as long as the wrong passwords
+            make_password(password)
+            raise PermissionDenied
+        if check_password(user, password) and self.user_can_authenticate(user):
+            return user
+        raise PermissionDenied
@@ -1,8 +1,13 @@
 #  Copyright (c) Code Written and Tested by Ahmed Emad in 12/03/2020, 21:35.
-from django.urls import resolve
 from rest_framework import permissions
 
 
+def has_profile(request):
+    """Checks if the user is authenticated and has a valid profile,
+    the authentication loads the profile with the user so it runs no queries."""
+    return request.user.is_authenticated and hasattr(request.user, 'profile')
+
+
 class UserProfilePermissions(permissions.BasePermission):
     """The Permission class used by UserProfileView."""
 
@@ -14,11 +19,9 @@ class UserProfilePermissions(permissions.BasePermission):
         """
         if request.method in self.safe_methods:
             return True
-        if request.method == 'GET' and resolve(request.path).url_name == 'signup':  # for debugging purposes
-            return True
-        if request.user.is_authenticated and hasattr(request.user, 'profile'):
+        if request.method == 'GET' and request.resolver_match.url_name == 'signup':  # for debugging purposes
             return True
-        return False
+        return has_profile(request)
 
 
 class NoteBookPermissions(permissions.BasePermission):
@@ -26,9 +29,7 @@ class NoteBookPermissions(permissions.BasePermission):
 
     def has_permission(self, request, view):
         """Checks if the user is authenticated and has a valid profile."""
-        if request.user.is_authenticated and hasattr(request.user, 'profile'):
-            return True
-        return False
+        return has_profile(request)
 
 
 class NotePermissions(permissions.BasePermission):
@@ -36,9 +37,7 @@ class NotePermissions(permissions.BasePermission):
 
     def has_permission(self, request, view):
         """Checks if the user is authenticated and has a valid profile."""
-        if request.user.is_authenticated and hasattr(request.user, 'profile'):
-            return True
-        return False
+        return has_profile(request)
 
 
 class NoteAttachmentPermissions(permissions.BasePermission):
@@ -46,6 +45,4 @@ class NoteAttachmentPermissions(permissions.BasePermission):
 
     def has_permission(self, request, view):
         """Checks if the user is authenticated and has a valid profile."""
-        if request.user.is_authenticated and hasattr(request.user, 'profile'):
-            return True
-        return False
+        return has_profile(request)
@@ -0,0 +1,86 @@
+"""Reads the metadata and renders the previews of the attachment files.
+It runs in the worker processes of the background tasks, so
+it doesn't use Django and its models."""
+
+import io
+import logging
+import mimetypes
+import os
+
+from PIL import Image, ImageOps
+
+try:
+    import fitz
+except ImportError:  # PyMuPDF is in the requirements, without it the PDFs have no previews
+    fitz = None
+
+logger = logging.getLogger(__name__)
+
+# the EXIF orientations of the photos that are turned on their sides
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def _first_pdf_page(path, size):
+    """renders the first page of a PDF that fits in a square of the size"""
+
+    with fitz.open(path) as document:
+        page = document[0]
+        zoom = size / max(page.rect.width, page.rect.height)
+        pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        return Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+
+
+def _open_image(path, size, metadata):
+    """opens an image, adds its type and dimensions to the metadata
+    and returns it decoded at the smallest scale bigger than the size"""
+
+    with Image.open(path) as image:
+        metadata['content_type'] = Image.MIME.get(image.format, metadata['content_type'])
+        width, height = image.size
+        if image.getexif().get(0x0112) in ROTATED_ORIENTATIONS:
+            width, height = height, width
+        metadata['width'], metadata['height'] = width, height
+        image.draft('RGB', (size, size))
+        return ImageOps.exif_transpose(image)
+
+
+def read_attachment(path, size, quality):
+    """Reads the metadata of an attachment file, and renders the preview
+    of the images and the first page of the PDFs.
+    Arguments:
+        path: the path of the file.
+        size: the size of the square that the preview fits in.
+        quality: the WebP quality of the preview.
+    Returns:
+        a tuple of the metadata dict, with the content_type, size, width
+        and height of the file, and the WebP bytes of the preview,
+        which is None for the files that have no preview.
+    """
+    metadata = {'content_type': mimetypes.guess_type(path)[0] or 'application/octet-stream',
+                'size': os.path.getsize(path), 'width': None, 'height': None}
+    with open(path, 'rb') as file:
+        is_pdf = file.read(5) == b'%PDF-'
+
+    image = None
+    if is_pdf:
+        metadata['content_type'] = 'application/pdf'
+        if fitz is None:
+            logger.warning('PyMuPDF is not installed, the PDF %s has no preview', path)
+        else:
+            try:
+                image = _first_pdf_page(path, size)
+            except RuntimeError:  # a broken PDF
+                pass
+    else:
+        try:
+            image = _open_image(path, size, metadata)
+        except (OSError, Image.DecompressionBombError):  # not an image, or too big to be decoded
+            pass
+    if image is None:
+        return metadata, None
+
+    image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    image.thumbnail((size, size), Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, 'WEBP', quality=quality, method=4)
+    return metadata, buffer.getvalue()
@@ -0,0 +1,40 @@
+import json
+
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # orjson is in the requirements, the json module is used without it
+    orjson = None
+
+_encoder = JSONEncoder()
+
+
+def json_dumps(data):
+    """Returns the compact UTF-8 JSON of the data, the same JSON that
+    the JSONRenderer of DRF gives, with orjson if it's installed.
+    The types orjson doesn't know, like lazy translations,
+    are converted by the JSON encoder of DRF.
+    """
+    if orjson is not None:
+        content = orjson.dumps(data, default=_encoder.default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z)
+    else:
+        content = json.dumps(data, cls=JSONEncoder, ensure_ascii=False, allow_nan=False,
+                             separators=(',', ':')).encode()
+    # like DRF, the line separators are escaped as they aren't valid in javascript strings
+    if b'\xe2\x80\xa8' in content or b'\xe2\x80\xa9' in content:
+        content = content.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+    return content
+
+
+class FastJSONRenderer(JSONRenderer):
+    """JSON renderer that renders with json_dumps, requests
+    for indented JSON are rendered by the JSONRenderer of DRF."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return json_dumps(data)
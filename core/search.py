@@ -0,0 +1,411 @@
+import bisect
+import functools
+import heapq
+import html
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import uuid
+from collections import defaultdict
+
+try:
+    import fcntl
+except ImportError:  # not POSIX, the journal can only be shared by the threads of one process
+    fcntl = None
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.core.signals import setting_changed
+from django.db import connection
+from django.db.models import F, Func, IntegerField, TextField, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from core.models import NoteBookModel, NoteModel
+
+SEARCH_CONFIG = 'english'
+
+JOURNAL_HEADER_SIZE = len('["compacted","{0}"]\n'.format(uuid.uuid4().hex))
+
+
+# the delimiters of the matched words in the headlines, they're replaced
+# by <mark> tags after the text is escaped, as ts_headline escapes nothing
+HEADLINE_START, HEADLINE_STOP = '\x02', '\x03'
+
+
+class SearchHeadline(Func):
+    """The ts_headline function of PostgreSQL, it returns
+    the fragments of a document that match a search query
+    with the matched words between HEADLINE_START and HEADLINE_STOP."""
+
+    function = 'ts_headline'
+    template = "%(function)s('pg_catalog.{0}', %(expressions)s, " \
+               "'StartSel={1}, StopSel={2}, MaxFragments=2, MaxWords=20, MinWords=5')".format(
+                   SEARCH_CONFIG, HEADLINE_START, HEADLINE_STOP)
+    output_field = TextField()
+
+
+class SearchBackend:
+    """The interface of the note search backends.
+    A backend finds the notes of a user that match some words, and
+    it's told about every saved and deleted note to keep its index.
+    """
+
+    def search(self, user, text):
+        """Searches the titles and texts of all notes of a user.
+        Arguments:
+            user: the user profile that the notes belong to.
+            text: the words to search for.
+        Returns:
+            A queryset of the matched notes with their notebook's slug
+            and their score, an integer rank that orders the results.
+        """
+        raise NotImplementedError
+
+    def highlight(self, notes, text):
+        """Gives every note of a results page its snippet, a fragment
+        of its text with the matched words inside <mark> tags."""
+
+    def index_notes(self, notes):
+        """Adds saved notes to the index or updates them."""
+
+    def index_note(self, note):
+        """Adds a saved note to the index or updates it."""
+        self.index_notes([note])
+
+    def remove_note(self, note_id):
+        """Removes a deleted note from the index by its id,
+        as deleted instances lose their primary key."""
+
+
+class PostgresSearchBackend(SearchBackend):
+    """The search backend that uses the full text search of PostgreSQL,
+    the notes are indexed by a trigger on their search_vector column."""
+
+    def search(self, user, text):
+        query = SearchQuery(text, config=SEARCH_CONFIG)
+        rank = SearchRank(F('search_vector'), query)
+        return NoteModel.objects.filter(notebook__user=user, search_vector=query) \
+            .annotate(score=Cast(rank * 1000000, IntegerField()),  # in millionths so it's exact in cursors
+                      notebook_slug=F('notebook__slug'),
+                      snippet=SearchHeadline(F('text'), query)) \
+            .only('slug', 'title')
+
+    def highlight(self, notes, text):
+        # the headlines are raw text, the text is escaped before the words are marked
+        for note in notes:
+            note.snippet = html.escape(note.snippet).replace(HEADLINE_START, '<mark>') \
+                .replace(HEADLINE_STOP, '</mark>')
+
+
+def tokenize(text):
+    """splits a text into its lower case words"""
+    return re.findall(r'\w+', text.lower())
+
+
+class InvertedIndexBackend(SearchBackend):
+    """The search backend that keeps an inverted index of the notes in
+    the process memory, for the databases that have no full text search.
+
+    The changes are appended to a journal file that every process
+    replays before searching, so all the workers share the same index
+    and it survives restarts. The journal is compacted when it grows
+    to many times the size of the entries of the indexed notes, so
+    the saves of a long note don't grow it without bound.
+
+    The search words are all required, a word ending with '*'
+    matches the words that start with it, and words inside double
+    quotes match only if they are next to each other.
+    """
+
+    max_results = 200
+    title_weight = 4
+    snippet_words = 20
+    compaction_slack = 1024 * 1024  # bytes of stale entries the journal keeps at least
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        """empties the index in memory"""
+        self._documents = {}  # note id -> (user id, title length, tokens)
+        self._postings = {}  # token -> {user id: {note id: positions}}
+        self._vocabulary = []  # sorted tokens for the prefix queries
+        self._sizes = {}  # note id -> bytes of its entry in the journal
+        self._size = 0  # bytes of the entries of the indexed notes
+        self._journal_id = None
+        self._offset = 0
+
+    def _add(self, note_id, user_id, title_length, tokens):
+        self._remove(note_id)
+        self._documents[note_id] = (user_id, title_length, tokens)
+        positions = defaultdict(list)
+        for position, token in enumerate(tokens):
+            positions[token].append(position)
+        for token, token_positions in positions.items():
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = {}
+                bisect.insort(self._vocabulary, token)
+            postings.setdefault(user_id, {})[note_id] = token_positions
+
+    def _remove(self, note_id):
+        document = self._documents.pop(note_id, None)
+        if document is None:
+            return
+        user_id = document[0]
+        for token in set(document[2]):
+            postings = self._postings[token]
+            del postings[user_id][note_id]
+            if not postings[user_id]:
+                del postings[user_id]
+            if not postings:
+                del self._postings[token]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+
+    def _apply(self, entry, size):
+        if entry[0] == 'index':
+            self._add(*entry[1:])
+        else:
+            self._remove(entry[1])
+        self._size += size - self._sizes.pop(entry[1], 0)
+        if entry[0] == 'index':
+            self._sizes[entry[1]] = size
+
+    @staticmethod
+    def _identify(journal):
+        """returns what tells a journal apart from the ones that replaced it, a compacted
+        journal starts with a random header as it may reuse the inode of the old one"""
+        stat = os.fstat(journal.fileno())
+        journal.seek(0)
+        return stat.st_dev, stat.st_ino, journal.read(JOURNAL_HEADER_SIZE)
+
+    def _sync(self, journal):
+        """replays the entries appended to the journal by other processes,
+        or all of it if it was compacted since it was last read"""
+        journal_id = self._identify(journal)
+        if journal_id != self._journal_id or os.fstat(journal.fileno()).st_size < self._offset:
+            self._reset()
+            self._journal_id = journal_id
+        journal.seek(self._offset)
+        for line in journal:
+            if not line.endswith(b'\n'):
+                break  # still being written
+            entry = json.loads(line)
+            if entry[0] != 'compacted':
+                self._apply(entry, len(line))
+            self._offset += len(line)
+
+    def _open(self, exclusive):
+        """opens and locks the journal, it may have been replaced by a
+        compaction between opening and locking it so it's checked again"""
+        while True:
+            journal = open(self.path, 'a+b')
+            if fcntl is not None:
+                fcntl.flock(journal, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                if os.fstat(journal.fileno()).st_ino == os.stat(self.path).st_ino:
+                    return journal
+            except FileNotFoundError:
+                pass
+            journal.close()
+
+    def _write(self, entries):
+        """applies entries to the index and appends them to the journal"""
+        with self._lock:
+            if self.path is None:
+                for entry in entries:
+                    self._apply(entry, 0)
+                return
+            with self._open(exclusive=True) as journal:
+                self._sync(journal)
+                lines = [json.dumps(entry, separators=(',', ':')).encode() + b'\n' for entry in entries]
+                journal.seek(0, os.SEEK_END)
+                journal.write(b''.join(lines))
+                journal.flush()
+                for entry, line in zip(entries, lines):
+                    self._apply(entry, len(line))
+                    self._offset += len(line)
+                if self._offset > 2 * self._size + self.compaction_slack:
+                    self._compact()
+
+    def _compact(self):
+        """rewrites the journal with only the indexed notes"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        self._sizes = {}
+        with tempfile.NamedTemporaryFile('w+b', dir=directory, delete=False) as compacted:
+            compacted.write(json.dumps(('compacted', uuid.uuid4().hex), separators=(',', ':')).encode() + b'\n')
+            for note_id, document in self._documents.items():
+                line = json.dumps(('index', note_id) + document, separators=(',', ':')).encode() + b'\n'
+                compacted.write(line)
+                self._sizes[note_id] = len(line)
+            compacted.flush()
+            self._offset = compacted.tell()
+            self._journal_id = self._identify(compacted)
+        os.replace(compacted.name, self.path)
+        self._size = sum(self._sizes.values())
+
+    def refresh(self):
+        """reads the changes other processes made to the index"""
+        with self._lock:
+            if self.path is None or not os.path.exists(self.path):
+                return
+            with self._open(exclusive=False) as journal:
+                self._sync(journal)
+
+    def index_notes(self, notes):
+        # the users of the notes whose notebook isn't loaded are read in one query
+        notebook_ids = {note.notebook_id for note in notes if not NoteModel.notebook.is_cached(note)}
+        user_ids = dict(NoteBookModel.objects.filter(pk__in=notebook_ids).values_list('pk', 'user_id')) \
+            if notebook_ids else {}
+        entries = []
+        for note in notes:
+            user_id = note.notebook.user_id if NoteModel.notebook.is_cached(note) else user_ids[note.notebook_id]
+            title = tokenize(note.title)
+            entries.append(('index', note.pk, user_id, len(title), title + tokenize(note.text)))
+        self._write(entries)
+
+    def remove_note(self, note_id):
+        self._write([('remove', note_id)])
+
+    def rebuild(self, notes):
+        """replaces the whole index with the given notes,
+        they are tuples of the note id, user id, title and text"""
+        with self._lock:
+            self._reset()
+            for note_id, user_id, title, text in notes:
+                title_tokens = tokenize(title)
+                self._add(note_id, user_id, len(title_tokens), title_tokens + tokenize(text))
+            if self.path is not None:
+                with self._open(exclusive=True):
+                    self._compact()
+
+    @staticmethod
+    def parse(text):
+        """splits the search words into terms, every term is a
+        tuple of its tokens and whether it's a prefix"""
+        terms = []
+        for phrase, word in re.findall(r'"([^"]*)"|(\S+)', text):
+            if phrase:
+                tokens = tokenize(phrase)
+                if tokens:
+                    terms.append((tuple(tokens), False))
+            else:
+                tokens = tokenize(word)
+                terms.extend(((token,), False) for token in tokens[:-1])
+                if tokens:
+                    terms.append(((tokens[-1],), word.endswith('*')))
+        return terms
+
+    def _user_postings(self, token, user_id):
+        return self._postings.get(token, {}).get(user_id, {})
+
+    def _term_positions(self, term, user_id):
+        """returns the sorted positions of a term in every note of a user that has it"""
+        tokens, prefix = term
+        if prefix:
+            matches = defaultdict(list)
+            start = bisect.bisect_left(self._vocabulary, tokens[0])
+            for token in self._vocabulary[start:]:
+                if not token.startswith(tokens[0]):
+                    break
+                for note_id, positions in self._user_postings(token, user_id).items():
+                    matches[note_id].extend(positions)
+            for positions in matches.values():
+                positions.sort()
+            return matches
+
+        matches = self._user_postings(tokens[0], user_id)
+        for offset, token in enumerate(tokens[1:], 1):
+            postings = self._user_postings(token, user_id)
+            phrases = {}
+            for note_id, positions in matches.items():
+                following = set(postings.get(note_id, ()))
+                title_length = self._documents[note_id][1]
+                positions = [position for position in positions if position + offset in following and
+                             (position < title_length) == (position + offset < title_length)]
+                if positions:
+                    phrases[note_id] = positions
+            matches = phrases
+        return matches
+
+    def search(self, user, text):
+        self.refresh()
+        with self._lock:
+            scores = None
+            for term in self.parse(text):
+                matches = self._term_positions(term, user.pk)
+                if scores is not None:
+                    matches = {note_id: matches[note_id] for note_id in scores if note_id in matches}
+                idf = math.log(1 + len(self._documents) / (1 + len(matches)))
+                title_bonus = self.title_weight - 1
+                term_scores = {}
+                for note_id, positions in matches.items():
+                    # the title is at the start of the tokens, so its matches come first
+                    title_matches = bisect.bisect_left(positions, self._documents[note_id][1])
+                    term_scores[note_id] = idf * (len(positions) + title_bonus * title_matches)
+                if scores is not None:
+                    term_scores = {note_id: score + scores[note_id] for note_id, score in term_scores.items()}
+                scores = term_scores
+
+        ranked = heapq.nlargest(self.max_results, (scores or {}).items(), key=lambda item: (item[1], item[0]))
+        queryset = NoteModel.objects.filter(notebook__user=user, pk__in=[note_id for note_id, _ in ranked])
+        if not ranked:
+            return queryset.annotate(score=Value(0, IntegerField()), notebook_slug=F('notebook__slug'))
+        # one CASE of raw SQL, as the ORM takes long to build hundreds of When
+        column = '{0}.{1}'.format(connection.ops.quote_name(NoteModel._meta.db_table),
+                                  connection.ops.quote_name(NoteModel._meta.pk.column))
+        score = RawSQL('CASE {0} {1} END'.format(column, ' '.join(['WHEN %s THEN %s'] * len(ranked))),
+                       [value for note_id, score in ranked for value in (note_id, int(score * 1000000))],
+                       output_field=IntegerField())
+        return queryset.annotate(score=score, notebook_slug=F('notebook__slug')).only('slug', 'title', 'text')
+
+    def highlight(self, notes, text):
+        terms = self.parse(text)
+        words = {token for tokens, prefix in terms if not prefix for token in tokens}
+        prefixes = tuple(tokens[0] for tokens, prefix in terms if prefix)
+
+        for note in notes:
+            matches = list(re.finditer(r'\w+', note.text))
+            marked = [i for i, match in enumerate(matches) if match.group().lower() in words or
+                      (prefixes and match.group().lower().startswith(prefixes))]
+            if not marked:
+                note.snippet = html.escape(' '.join(match.group() for match in matches[:self.snippet_words]))
+                continue
+            first = max(marked[0] - self.snippet_words // 4, 0)
+            window = matches[first:first + self.snippet_words]
+            marked = set(marked)
+            parts = []
+            for i, match in enumerate(window, first):
+                word = html.escape(match.group())
+                parts.append('<mark>{0}</mark>'.format(word) if i in marked else word)
+            note.snippet = ' '.join(parts)
+
+
+@functools.lru_cache(maxsize=None)
+def get_search_backend():
+    """Returns the search backend of the SEARCH_BACKEND setting,
+    by default it's the PostgreSQL full text search if the database
+    is PostgreSQL, if not, it's the in-process inverted index."""
+
+    if settings.SEARCH_BACKEND:
+        return import_string(settings.SEARCH_BACKEND)()
+    if connection.vendor == 'postgresql':
+        return PostgresSearchBackend()
+    return InvertedIndexBackend(path=settings.SEARCH_INDEX_PATH)
+
+
+@receiver(setting_changed)
+def reset_search_backend(setting, **kwargs):
+    """The receiver called when a setting is changed in the tests
+    to use a new search backend if the search settings changed"""
+
+    if setting in ('SEARCH_BACKEND', 'SEARCH_INDEX_PATH'):
+        get_search_backend.cache_clear()
@@ -1,13 +1,23 @@
 #  Copyright (c) Code Written and Tested by Ahmed Emad in 13/03/2020, 20:02.
 
+import os
+
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.auth.password_validation import validate_password
 from django.contrib.auth.validators import UnicodeUsernameValidator
+from django.db.models import F, Window
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import RowNumber
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
 
-from core.models import UserProfileModel, NoteModel, NoteBookModel, NoteAttachmentModel
+from core.models import UserProfileModel, NoteModel, NoteBookModel, NoteAttachmentModel, NoteAttachmentUploadModel
+from core.passwords import set_password
+from core.downloads import download_url
+from core.thumbnails import profile_photo_url, profile_photo_urls, attachment_preview_url
 
 
 class UserProfileSerializer(serializers.ModelSerializer):
@@ -28,17 +38,28 @@ class UserProfileSerializer(serializers.ModelSerializer):
                                      })
     password = serializers.CharField(source='account.password', write_only=True, label=_('password'),
                                      max_length=128, validators=[validate_password])
+    profile_photo_thumbnails = serializers.SerializerMethodField()
 
     class Meta:
         model = UserProfileModel
-        fields = ('first_name', 'last_name', 'username', 'password', 'profile_photo')
+        fields = ('first_name', 'last_name', 'username', 'password', 'profile_photo', 'profile_photo_thumbnails')
+
+    def get_profile_photo_thumbnails(self, instance):
+        """returns the URLs of the profile photo at every thumbnail size"""
+        return profile_photo_urls(instance, self.context.get('request'))
+
+    def to_representation(self, instance):
+        """returns the profile with the URL that its photo is downloaded from"""
+        data = super().to_representation(instance)
+        data['profile_photo'] = profile_photo_url(instance, self.context.get('request'))
+        return data
 
     def create(self, validated_data):
         """Creates a new user profile from the request's data"""
 
         account_data = validated_data.pop('account')
         account = User(**account_data)
-        account.set_password(account.password)
+        set_password(account, account.password)
         account.save()
 
         user_profile = UserProfileModel.objects.create(account=account, **validated_data)
@@ -56,22 +77,71 @@ class UserProfileSerializer(serializers.ModelSerializer):
         account.last_name = account_data.get('last_name', account.last_name)
         account.username = account_data.get('username', account.username)
         if account_data.get('password', None) is not None:
-            account.set_password(account_data.get('password'))
+            set_password(account, account_data.get('password'))
         account.save()
 
         return instance
 
 
+def attachment_download_url(notebook_slug, note_slug, slug, request=None):
+    """returns the URL that the file of an attachment is downloaded from"""
+    return download_url('core:attachments-download', request, notebook_slug=notebook_slug, note_slug=note_slug,
+                        slug=slug)
+
+
 class NoteAttachmentSerializer(serializers.ModelSerializer):
-    """The serializer for the note attachment model"""
+    """The serializer for the note attachment model, the metadata
+    and the preview are null until they're made in the background"""
+
+    preview = serializers.SerializerMethodField()
 
     class Meta:
         model = NoteAttachmentModel
-        fields = ('slug', 'file')
+        fields = ('slug', 'file', 'content_type', 'size', 'width', 'height', 'preview')
         extra_kwargs = {
             'slug': {'read_only': True}
         }
 
+    def get_preview(self, instance):
+        """returns the URL of the preview of the attachment's file"""
+        note = instance.note
+        return attachment_preview_url(note.notebook.slug, note.slug, instance.slug, instance.has_preview,
+                                      self.context.get('request'))
+
+    def to_representation(self, instance):
+        """returns the attachment with the URL that its file is downloaded from"""
+        data = super().to_representation(instance)
+        data['file'] = attachment_download_url(instance.note.notebook.slug, instance.note.slug, instance.slug,
+                                               self.context.get('request'))
+        return data
+
+
+class NoteAttachmentUploadSerializer(serializers.ModelSerializer):
+    """The serializer for starting a chunked upload of a note attachment"""
+
+    class Meta:
+        model = NoteAttachmentUploadModel
+        fields = ('id', 'filename', 'size', 'offset')
+        read_only_fields = ('id', 'offset')
+        extra_kwargs = {
+            'size': {'min_value': 1}
+        }
+
+    def validate_filename(self, filename):
+        """removes the directories from the file name"""
+        filename = os.path.basename(filename)
+        if not filename:
+            raise serializers.ValidationError('The file name must not be empty.')
+        return filename
+
+    def validate_size(self, size):
+        """checks that the file is not larger than the upload limit"""
+        limit = settings.ATTACHMENT_UPLOAD_MAX_SIZE
+        if size > limit:
+            raise serializers.ValidationError(
+                'File too large. Size should not exceed {0} MB.'.format(limit // (1000 * 1000)))
+        return size
+
 
 class NoteDetailSerializer(serializers.ModelSerializer):
     """The Detailed serializer for the note model"""
@@ -94,14 +164,271 @@ class NoteSerializer(serializers.ModelSerializer):
         fields = ('slug', 'title')
 
 
+class NoteSearchSerializer(serializers.ModelSerializer):
+    """The read-only serializer for the note search results"""
+
+    notebook = serializers.CharField(source='notebook_slug', read_only=True)
+    rank = serializers.SerializerMethodField()
+    snippet = serializers.CharField(read_only=True)
+
+    class Meta:
+        model = NoteModel
+        fields = ('notebook', 'slug', 'title', 'rank', 'snippet')
+
+    def get_rank(self, note):
+        """returns the rank of the note from its score"""
+        return note.score / 1000000
+
+
+class TextEditSerializer(serializers.Serializer):
+    """The serializer for an edit of a note text, it deletes a number
+    of UTF-16 code units at a position and inserts a text in their place"""
+
+    position = serializers.IntegerField(min_value=0)
+    delete = serializers.IntegerField(min_value=0, default=0)
+    insert = serializers.CharField(default='', allow_blank=True, trim_whitespace=False)
+
+
+class NoteTextEditsSerializer(serializers.Serializer):
+    """The serializer for patching a note text with a list of edits,
+    the positions are in the text the edits are made to, which is
+    given in the context, and the patched text is validated as text.
+    The positions and the deleted lengths are in UTF-16 code units
+    like the string indexes of javascript, not in characters."""
+
+    text_edits = serializers.ListField(child=TextEditSerializer(), min_length=1, max_length=1000)
+
+    @cached_property
+    def text_units(self):
+        """the text in UTF-16, every code unit is 2 bytes"""
+        return self.context['text'].encode('utf-16-le', 'surrogatepass')
+
+    def is_boundary(self, position):
+        """returns whether a position is not in the middle of a surrogate pair"""
+        units = self.text_units
+        if position * 2 >= len(units):
+            return True
+        return not 0xDC00 <= int.from_bytes(units[position * 2:position * 2 + 2], 'little') <= 0xDFFF
+
+    def validate_text_edits(self, edits):
+        """checks that the edits are in order, don't overlap
+        and don't split the characters that take two code units"""
+        end = 0
+        for edit in edits:
+            if edit['position'] < end:
+                raise serializers.ValidationError('Edits must be sorted by position and must not overlap.')
+            end = edit['position'] + edit['delete']
+            if not self.is_boundary(edit['position']) or not self.is_boundary(end):
+                raise serializers.ValidationError('Edits must not split a surrogate pair.')
+        if end * 2 > len(self.text_units):
+            raise serializers.ValidationError('Edits must be inside the text.')
+        return edits
+
+    def validate(self, data):
+        """applies the edits to the text"""
+        units = self.text_units
+        parts = []
+        start = 0
+        for edit in data['text_edits']:
+            parts.append(units[start * 2:edit['position'] * 2].decode('utf-16-le', 'surrogatepass'))
+            parts.append(edit['insert'])
+            start = edit['position'] + edit['delete']
+        parts.append(units[start * 2:].decode('utf-16-le', 'surrogatepass'))
+        data['text'] = ''.join(parts)
+        return data
+
+
+class NoteSlugsSerializer(serializers.Serializer):
+    """The serializer for the list of note slugs of the bulk operations"""
+
+    slugs = serializers.ListField(child=serializers.SlugField(max_length=255),
+                                  min_length=1, max_length=1000)
+
+
+class NoteMoveSerializer(NoteSlugsSerializer):
+    """The serializer for moving a list of notes to another notebook"""
+
+    notebook = serializers.SlugField(max_length=255)
+
+
 class NoteBookSerializer(serializers.ModelSerializer):
     """The serializer for the notebook model"""
 
     notes = NoteSerializer(many=True, read_only=True)
+    notes_count = serializers.SerializerMethodField()
 
     class Meta:
         model = NoteBookModel
-        fields = ('slug', 'title', 'notes')
+        fields = ('slug', 'title', 'notes_count', 'notes')
         extra_kwargs = {
             'slug': {'read_only': True}
         }
+
+    def get_notes_count(self, notebook):
+        """returns the number of notes in the notebook,
+        it's annotated on the notebooks of the list view"""
+        if hasattr(notebook, 'notes_count'):
+            return notebook.notes_count
+        return notebook.notes.count()
+
+
+class NoteBookSyncSerializer(serializers.ModelSerializer):
+    """The read-only serializer for the notebooks of the change feed"""
+
+    class Meta:
+        model = NoteBookModel
+        fields = ('id', 'slug', 'title')
+
+
+class NoteSyncSerializer(serializers.ModelSerializer):
+    """The read-only serializer for the notes of the change feed,
+    notes refer to their notebook by its id as its slug can change"""
+
+    class Meta:
+        model = NoteModel
+        fields = ('id', 'notebook', 'slug', 'title', 'text')
+
+
+class NoteAttachmentSyncSerializer(NoteAttachmentSerializer):
+    """The read-only serializer for the attachments of the change feed"""
+
+    class Meta(NoteAttachmentSerializer.Meta):
+        fields = ('id', 'note', 'slug', 'file', 'content_type', 'size', 'width', 'height', 'preview')
+
+
+class ValuesSerializer:
+    """A lean read-only serializer for the rows of values() querysets.
+    It gives the same output as the model serializer it stands for,
+    without the field machinery of DRF, as the rows are already dicts
+    of plain values. Like DRF serializers, it serializes a row
+    or a list of rows with many=True.
+    """
+
+    fields = ()
+    columns = ()  # the columns of the rows, the fields by default
+    nested = {}  # field: the values serializer of its list of related rows
+
+    def __init__(self, instance, many=False, context=None):
+        self.instance = instance
+        self.many = many
+        self.context = context or {}
+
+    @classmethod
+    def values(cls, queryset):
+        """returns the rows of a queryset with the columns the serializer needs"""
+        return queryset.values(*(cls.columns or cls.fields))
+
+    def to_representation(self, row):
+        """returns the output of a row"""
+        data = {field: row[field] for field in self.fields}
+        for field, serializer_class in self.nested.items():
+            data[field] = serializer_class(data[field], many=True, context=self.context).data
+        return data
+
+    @property
+    def data(self):
+        if self.many:
+            return [self.to_representation(row) for row in self.instance]
+        return self.to_representation(self.instance)
+
+
+def first_rows(queryset, related_field, limit):
+    """Limits a queryset to the first rows of every value of a foreign key
+    in the order of the queryset. The rows are numbered by a window function
+    in one pass over the rows that match the queryset, so its filters bound
+    the rows it reads, instead of a subquery that runs for every row.
+    Arguments:
+        queryset: the ordered queryset of the rows.
+        related_field: the foreign key the rows are grouped by.
+        limit: the number of rows kept for every value of the foreign key.
+    Returns:
+        the queryset filtered on the ids of the first rows.
+    """
+    ordering = [F(name[1:]).desc() if name.startswith('-') else F(name).asc()
+                for name in queryset.query.order_by]
+    ranked = queryset.order_by().annotate(related_rank=Window(
+        RowNumber(), partition_by=[F(related_field)], order_by=ordering)).values('pk', 'related_rank')
+    sql, params = ranked.query.sql_with_params()
+    column = queryset.model._meta.pk.column
+    # django can't filter on a window function, so the numbered rows are read from a subquery
+    return queryset.filter(pk__in=RawSQL('SELECT ranked.{0} FROM ({1}) ranked WHERE ranked.related_rank <= %s'
+                                         .format(column, sql), params + (limit,)))
+
+
+def add_related_rows(rows, field, queryset, related_field, serializer_class, limit=None):
+    """Fetches the related rows of a list of rows in one query, and
+    adds them to every row as a list under the given field.
+    Arguments:
+        rows: the rows, they must have their ids.
+        field: the field the related rows are added under.
+        queryset: the queryset of the related rows.
+        related_field: the foreign key of the related rows to the rows.
+        serializer_class: the values serializer of the related rows.
+        limit: the number of related rows added to every row, all of them if it's None.
+    """
+    related_rows = {row['id']: [] for row in rows}
+    queryset = queryset.filter(**{related_field + '__in': list(related_rows)})
+    if limit is not None:
+        queryset = first_rows(queryset, related_field, limit)
+    for related_row in queryset.values(related_field, *(serializer_class.columns or serializer_class.fields)):
+        related_rows[related_row[related_field]].append(related_row)
+    for row in rows:
+        row[field] = related_rows[row['id']]
+    return rows
+
+
+class NoteAttachmentValuesSerializer(ValuesSerializer):
+    """The lean version of NoteAttachmentSerializer"""
+
+    fields = ('slug', 'file', 'content_type', 'size', 'width', 'height', 'preview')
+    columns = ('slug', 'note__slug', 'note__notebook__slug', 'content_type', 'size', 'width', 'height',
+               'has_preview')
+
+    def to_representation(self, row):
+        """returns the output of a row with the urls of its file and of its preview"""
+        request = self.context.get('request')
+        notebook_slug, note_slug = row['note__notebook__slug'], row['note__slug']
+        return {'slug': row['slug'],
+                'file': attachment_download_url(notebook_slug, note_slug, row['slug'], request),
+                'content_type': row['content_type'], 'size': row['size'],
+                'width': row['width'], 'height': row['height'],
+                'preview': attachment_preview_url(notebook_slug, note_slug, row['slug'], row['has_preview'],
+                                                  request)}
+
+
+class NoteDetailValuesSerializer(ValuesSerializer):
+    """The lean version of NoteDetailSerializer, the attachments
+    are added to the rows by add_attachments"""
+
+    fields = ('slug', 'title', 'text', 'attachments')
+    columns = ('id', 'slug', 'title', 'text')
+    nested = {'attachments': NoteAttachmentValuesSerializer}
+
+    @staticmethod
+    def add_attachments(rows):
+        """adds the attachments of every note row in one query"""
+        return add_related_rows(rows, 'attachments', NoteAttachmentModel.objects.order_by('id'), 'note',
+                                NoteAttachmentValuesSerializer)
+
+
+class NoteValuesSerializer(ValuesSerializer):
+    """The lean version of NoteSerializer, the ids are
+    for the cursor pagination of the rows"""
+
+    fields = ('slug', 'title')
+    columns = ('id', 'slug', 'title')
+
+
+class NoteBookValuesSerializer(ValuesSerializer):
+    """The lean version of NoteBookSerializer for the notebook rows
+    annotated with their notes_count, the notes are added to
+    the rows by add_notes"""
+
+    fields = ('slug', 'title', 'notes_count', 'notes')
+    columns = ('id', 'slug', 'title', 'notes_count')
+    nested = {'notes': NoteValuesSerializer}
+
+    @staticmethod
+    def add_notes(rows, queryset, limit=None):
+        """adds the first notes of the queryset to every notebook row in one query"""
+        return add_related_rows(rows, 'notes', queryset, 'notebook', NoteValuesSerializer, limit)
@@ -0,0 +1,73 @@
+from django.contrib.sessions.backends import db
+from django.contrib.sessions.backends.base import CreateError
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+from django.contrib.sessions.models import Session
+from django.utils import timezone
+
+from core.tasks import run_in_background
+
+
+def delete_expired_sessions(batch_size):
+    """Deletes a batch of the expired sessions of the database, so
+    sweeping a big table doesn't lock it in one long delete.
+    Arguments:
+        batch_size: the number of sessions deleted at most.
+    Returns:
+        the number of deleted sessions.
+    """
+    keys = list(Session.objects.filter(expire_date__lt=timezone.now())
+                .values_list('session_key', flat=True)[:batch_size])
+    if not keys:
+        return 0
+    count, _ = Session.objects.filter(session_key__in=keys).delete()
+    return count
+
+
+def _write_session(session_key):
+    """writes the session in the cache to the database in the background"""
+
+    store = SessionStore(session_key)
+    data = store._cache.get(store.cache_key)
+    if data is None:
+        return  # it was deleted or expired before it was written
+    store._session_cache = data
+    store.create_model_instance(data).save()
+    if store._cache.get(store.cache_key) is None:
+        # it was deleted while it was written, the cache is deleted
+        # first, so the row of a logged out session never stays
+        Session.objects.filter(session_key=session_key).delete()
+
+
+class SessionStore(CachedDBStore):
+    """Sessions that are read from and written to the cache, with the
+    database behind it. The database is only read when the session isn't
+    in the cache, and the writes are done by the background threads after
+    the response, they write the latest data of the cache. A logout deletes
+    the session from both at once, a session the cache lost before it was
+    written is lost as well.
+    """
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        data = self._get_session(no_load=must_create)
+        if must_create:
+            # a new key is unique in the cache, the database has it before long
+            if not self._cache.add(self.cache_key, data, self.get_expiry_age()):
+                raise CreateError
+        else:
+            self._cache.set(self.cache_key, data, self.get_expiry_age())
+        run_in_background(_write_session, self.session_key)
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        self._cache.delete(self.cache_key_prefix + session_key)
+        db.SessionStore.delete(self, session_key)
+
+    @classmethod
+    def clear_expired(cls, batch_size=1000):
+        while delete_expired_sessions(batch_size) == batch_size:
+            pass
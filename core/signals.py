@@ -2,12 +2,25 @@
 
 import os
 import re
+import threading
+from collections import Counter, namedtuple
+from contextlib import contextmanager
 
-from django.db.models.signals import post_delete, pre_save
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from django.utils.text import slugify
 
-from core.models import UserProfileModel, NoteModel, NoteBookModel, NoteAttachmentModel
+from core.authentication import forget_user
+from core.models import UserProfileModel, NoteModel, NoteBookModel, NoteAttachmentModel, SlugSequenceModel, \
+    ChangeModel, NoteAttachmentUploadModel, AttachmentBlobModel, FileDeletionModel, AuthTokenModel, preview_name
+from core.search import get_search_backend
+from core.tasks import run_in_background
+from core.thumbnails import generate_profile_photo_thumbnails, generate_attachment_preview
+from core.tokens import forget_token
 
 
 def _slug_strip(value):
@@ -15,31 +28,178 @@ def _slug_strip(value):
     return re.sub(r'^%s+|%s+$' % ('-', '-'), '', value)
 
 
+def _slug_candidate(base, number):
+    """returns the slug with the given number in the sequence of base,
+    the first slug is the base itself and the others end with '-number'"""
+
+    if number == 1 and base:
+        return base
+
+    end = '-%s' % number
+    slug = base
+    if len(slug) + len(end) > 255:
+        slug = slug[:255 - len(end)]
+        slug = _slug_strip(slug)
+    return '%s%s' % (slug, end)
+
+
+def _slug_number(base, slug):
+    """returns the number of the slug in the sequence of base,
+    or None if the slug isn't part of that sequence"""
+
+    if slug == base and base:
+        return 1
+    match = re.search(r'-(\d+)$', slug, re.ASCII)
+    if match and _slug_candidate(base, int(match.group(1))) == slug:
+        return int(match.group(1))
+    return None
+
+
+def _highest_slug_number(slugs, base):
+    """returns the highest number already taken in the sequence of base,
+    it's used once to seed the sequence of a base from the existing slugs"""
+
+    highest = 0 if base else 1  # an empty slug is never valid
+    for slug in slugs:
+        highest = max(highest, _slug_number(base, slug) or 0)
+
+    return highest
+
+
+def _slug_prefix(base):
+    """returns the prefix shared by all the slugs in the sequence of base"""
+    return _slug_strip(base[:240])
+
+
+def allocate_slugs(queryset, parent, parent_id, base, count=1):
+    """reserves count numbers in the slug sequence of base inside the
+    parent of the queryset's model and returns their slugs, the sequence
+    row is locked while it's incremented so concurrent inserts wait for
+    each other instead of colliding on the same slug"""
+
+    scope = slug_scope(queryset.model, parent_id)
+    with transaction.atomic():
+        sequences = SlugSequenceModel.objects.select_for_update()
+        sequence = sequences.filter(scope=scope, base=base).first()
+        if sequence is None:
+            sequence, _ = SlugSequenceModel.objects.get_or_create(
+                scope=scope, base=base,
+                defaults={parent + '_id': parent_id, 'last': _highest_slug_number(
+                    queryset.filter(slug__startswith=_slug_prefix(base)).values_list('slug', flat=True), base)})
+            sequence = sequences.get(pk=sequence.pk)
+
+        first = sequence.last + 1
+        sequence.last += count
+        sequence.save(update_fields=['last'])
+
+    return [_slug_candidate(base, number) for number in range(first, first + count)]
+
+
+def slug_scope(model, parent_id):
+    """returns the key of the slug sequences of a model inside a parent"""
+
+    return '%s:%s' % (model._meta.label_lower, parent_id)
+
+
 def unique_slugify(instance, parent, value):
     """function used to give a unique slug to an instance"""
 
     slug = slugify(value)
     slug = slug[:255]  # limit its len to max_length of slug field
 
-    slug = _slug_strip(slug)
-    original_slug = slug
+    base = _slug_strip(slug)
 
-    queryset = instance.__class__.objects.filter(**{parent: getattr(instance, parent)}).all()
+    parent_id = getattr(instance, instance._meta.get_field(parent).attname)
+    queryset = instance.__class__.objects.filter(**{parent: parent_id})
 
     if instance.pk:
         queryset = queryset.exclude(pk=instance.pk)
+        if instance.slug and _slug_number(base, instance.slug):
+            # the slug still belongs to the sequence of its value
+            if not instance.has_changed(parent) or not queryset.filter(slug=instance.slug).exists():
+                return instance.slug
+
+    while True:
+        slug, = allocate_slugs(queryset, parent, parent_id, base)
+        # the slug is taken only if it was given by hand or came from another
+        # base that ends with a number, which rarely happens
+        if not queryset.filter(slug=slug).exists():
+            return slug
+
+
+def bulk_unique_slugify(model, parent, parent_id, values, reserved=()):
+    """function used to give unique slugs to many new instances
+    of a model inside the same parent, all the slugs are given
+    in memory against one fetch of the taken slugs.
+    Arguments:
+        model: the model of the new instances.
+        parent: the name of the parent foreign key field.
+        parent_id: the primary key of the parent.
+        values: the values that the slugs are made from.
+        reserved: slugs that can't be given even though they
+                  are not taken yet inside the parent.
+    Returns:
+        A list of unique slugs in the same order as the values.
+    """
+
+    bases = [_slug_strip(slugify(value)[:255]) for value in values]
+    counts = Counter(bases)
+    scope = slug_scope(model, parent_id)
+    sequences = SlugSequenceModel.objects.select_for_update().filter(scope=scope, base__in=counts)
+
+    with transaction.atomic():
+        locked = {sequence.base: sequence for sequence in sequences}
+        taken = set(model.objects.filter(**{parent: parent_id}).values_list('slug', flat=True))
+        taken.update(reserved)
+
+        missing = [SlugSequenceModel(scope=scope, base=base, last=_highest_slug_number(taken, base),
+                                     **{parent + '_id': parent_id})
+                   for base in counts if base not in locked]
+        if missing:
+            SlugSequenceModel.objects.bulk_create(missing, ignore_conflicts=True)
+            locked = {sequence.base: sequence for sequence in sequences.all()}
+
+        slugs = {}
+        for base, count in counts.items():
+            sequence = locked[base]
+            slugs[base] = []
+            while len(slugs[base]) < count:
+                sequence.last += 1
+                slug = _slug_candidate(base, sequence.last)
+                if slug not in taken:
+                    taken.add(slug)
+                    slugs[base].append(slug)
+            slugs[base].reverse()
+
+        SlugSequenceModel.objects.bulk_update(locked.values(), ['last'])
+
+    return [slugs[base].pop() for base in bases]
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_cached_user(sender, **kwargs):
+    """The receiver called after a user is saved or deleted
+    to remove it from the cache of the authentication"""
+
+    forget_user(kwargs['instance'].pk)
+
+
+@receiver(post_save, sender=UserProfileModel)
+@receiver(post_delete, sender=UserProfileModel)
+def forget_cached_profile(sender, **kwargs):
+    """The receiver called after a user profile is saved or deleted
+    to remove its user from the cache of the authentication"""
+
+    forget_user(kwargs['instance'].account_id)
 
-    _next = 2
-    while not slug or queryset.filter(slug=slug):
-        slug = original_slug
-        end = '-%s' % _next
-        if len(slug) + len(end) > 255:
-            slug = slug[:255 - len(end)]
-            slug = _slug_strip(slug)
-        slug = '%s%s' % (slug, end)
-        _next += 1
 
-    return slug
+@receiver(post_delete, sender=AuthTokenModel)
+def revoke_access_tokens(sender, **kwargs):
+    """The receiver called after a refresh token is deleted
+    to revoke the access tokens that were made with it"""
+
+    forget_token(kwargs['instance'].pk)
 
 
 @receiver(post_delete, sender=UserProfileModel)
@@ -50,39 +210,383 @@ def delete_user_account(sender, **kwargs):
     kwargs['instance'].account.delete()
 
 
+@receiver(post_save, sender=UserProfileModel)
+def generate_thumbnails(sender, **kwargs):
+    """The receiver called after a user profile is saved to generate
+    the thumbnails of its photo in the background when it changed"""
+
+    profile = kwargs['instance']
+    if profile.profile_photo and profile.has_changed('profile_photo'):
+        run_in_background(generate_profile_photo_thumbnails, profile.pk, profile.profile_photo.name)
+
+
 @receiver(pre_save, sender=NoteBookModel)
 def add_slug_to_notebook(sender, **kwargs):
     """The receiver called before a notebook is saved
-    to give it a unique slug"""
+    to give it a unique slug when its title or parent changed"""
 
     notebook = kwargs['instance']
-    notebook.slug = unique_slugify(notebook, 'user', notebook.title)
+    if notebook.has_changed('user', 'title'):
+        notebook.slug = unique_slugify(notebook, 'user', notebook.title)
 
 
 @receiver(pre_save, sender=NoteModel)
 def add_slug_to_note(sender, **kwargs):
     """The receiver called before a note is saved
-    to give it a unique slug"""
+    to give it a unique slug when its title or parent changed"""
 
     note = kwargs['instance']
-    note.slug = unique_slugify(note, 'notebook', note.title)
+    if note.has_changed('notebook', 'title'):
+        note.slug = unique_slugify(note, 'notebook', note.title)
+
+
+@receiver(post_save, sender=NoteModel)
+def index_note(sender, **kwargs):
+    """The receiver called after a note is saved
+    to update it in the search index after commit"""
+
+    note = kwargs['instance']
+    backend = get_search_backend()
+    transaction.on_commit(lambda: backend.index_note(note))
+
+
+@receiver(post_delete, sender=NoteModel)
+def remove_note_from_index(sender, **kwargs):
+    """The receiver called after a note is deleted
+    to remove it from the search index after commit"""
+
+    note_id = kwargs['instance'].pk  # the instance loses it when the delete ends
+    backend = get_search_backend()
+    transaction.on_commit(lambda: backend.remove_note(note_id))
+
+
+_tree_invalidations = threading.local()
+
+
+def notebook_tree_key(user_id):
+    """returns the cache key of the notebook tree of a user profile"""
+    return 'notebook-tree:%s' % user_id
+
+
+def _delete_notebook_trees(user_ids):
+    """deletes the cached trees of the users and of the owners of
+    all the notebooks that are waiting for their trees to be deleted"""
+
+    notebook_ids = getattr(_tree_invalidations, 'notebook_ids', None)
+    if notebook_ids:
+        _tree_invalidations.notebook_ids = set()
+        user_ids = user_ids.union(NoteBookModel.objects.filter(pk__in=notebook_ids)
+                                  .values_list('user_id', flat=True))
+    if user_ids:
+        cache.delete_many([notebook_tree_key(user_id) for user_id in user_ids])
+
+
+def invalidate_notebook_trees(user_ids=(), notebook_ids=()):
+    """Deletes the cached notebook trees after the transaction commits.
+    The owners of the notebooks are looked up in one query when the
+    first deletion of the transaction runs, so deleting many notes
+    of the same notebook doesn't look up its owner for every note.
+    Arguments:
+        user_ids: the ids of the profiles whose trees changed.
+        notebook_ids: the ids of the notebooks whose owners' trees changed.
+    """
+    if notebook_ids:
+        if getattr(_tree_invalidations, 'notebook_ids', None) is None:
+            _tree_invalidations.notebook_ids = set()
+        _tree_invalidations.notebook_ids.update(notebook_ids)
+    user_ids = set(user_ids)
+    transaction.on_commit(lambda: _delete_notebook_trees(user_ids))
+
+
+def _invalidate_note_tree(note):
+    if NoteModel.notebook.is_cached(note):
+        invalidate_notebook_trees(user_ids=[note.notebook.user_id])
+    else:
+        invalidate_notebook_trees(notebook_ids=[note.notebook_id])
+
+
+@receiver(post_save, sender=NoteBookModel)
+def invalidate_tree_of_saved_notebook(sender, **kwargs):
+    """The receiver called after a notebook is saved to
+    delete the cached tree of its user if its title changed"""
+
+    notebook = kwargs['instance']
+    if notebook.has_changed('user', 'title'):
+        invalidate_notebook_trees(user_ids=[notebook.user_id])
+
+
+@receiver(post_delete, sender=NoteBookModel)
+def invalidate_tree_of_deleted_notebook(sender, **kwargs):
+    """The receiver called after a notebook is deleted
+    to delete the cached tree of its user"""
+
+    invalidate_notebook_trees(user_ids=[kwargs['instance'].user_id])
+
+
+@receiver(post_save, sender=NoteModel)
+def invalidate_tree_of_saved_note(sender, **kwargs):
+    """The receiver called after a note is saved to delete the
+    cached tree of its user if its title or notebook changed"""
+
+    note = kwargs['instance']
+    if note.has_changed('notebook', 'title'):
+        _invalidate_note_tree(note)
+
+
+@receiver(post_delete, sender=NoteModel)
+def invalidate_tree_of_deleted_note(sender, **kwargs):
+    """The receiver called after a note is deleted
+    to delete the cached tree of its user"""
+
+    _invalidate_note_tree(kwargs['instance'])
 
 
 @receiver(pre_save, sender=NoteAttachmentModel)
 def add_slug_to_note_attachment(sender, **kwargs):
     """The receiver called before a note attachment is saved
-    to give it a unique slug"""
+    to give it a unique slug when its file or note changed"""
+
+    attachment = kwargs['instance']
+    if attachment.has_changed('note', 'file'):
+        attachment.slug = unique_slugify(attachment, 'note', attachment.file.name)
+
+
+_file_batches = threading.local()
+
+
+def _delete_files(paths):
+    """deletes the given files from the filesystem if they exist"""
+
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def _release_attachment_files(names):
+    """releases the references of attachments to their files and queues the
+    files that aren't referenced anymore and their previews to be deleted by the worker"""
+
+    names = AttachmentBlobModel.objects.release(names)
+    FileDeletionModel.objects.queue(names + [preview_name(name) for name in names])
+
+
+@contextmanager
+def batched_file_deletion():
+    """context manager that collects the files of the attachments
+    deleted inside it, releases their references and queues the files
+    that aren't referenced anymore at once, instead of one by one inside
+    the signals, the part files of the uploads are deleted after the
+    transaction commits"""
+
+    if getattr(_file_batches, 'paths', None) is not None:
+        yield  # nested, the outer block deletes the files
+        return
+
+    _file_batches.paths = paths = []
+    _file_batches.attachment_files = attachment_files = []
+    try:
+        yield
+        _release_attachment_files(attachment_files)
+    finally:
+        _file_batches.paths = _file_batches.attachment_files = None
+    if paths:
+        transaction.on_commit(lambda: _delete_files(paths))
+
+
+def attachment_file_name(attachment):
+    """returns the name that the file of an attachment has or will have in the storage"""
+
+    file = attachment.file
+    if file._committed:
+        return file.name
+    return file.field.generate_filename(attachment, file.name)
+
+
+@receiver(pre_save, sender=NoteAttachmentModel)
+def reference_note_attachment_file(sender, **kwargs):
+    """The receiver called before a note attachment is saved to reference
+    its file when it's new or changed, and release its old file,
+    the file of a new attachment is hashed here to get its name"""
 
     attachment = kwargs['instance']
-    attachment.slug = unique_slugify(attachment, 'note', attachment.file.name)
+    if attachment.has_changed('file'):
+        # the metadata of the old file are read again for the new one
+        attachment.content_type, attachment.size, attachment.width, attachment.height = '', None, None, None
+        attachment.has_preview = False
+        if attachment.file:
+            AttachmentBlobModel.objects.reference(attachment_file_name(attachment))
+        old_name = (getattr(attachment, '_saved_values', None) or {}).get('file')
+        if old_name:
+            _release_attachment_files([old_name])
+
+
+@receiver(post_save, sender=NoteAttachmentModel)
+def generate_preview(sender, **kwargs):
+    """The receiver called after a note attachment is saved to read the
+    metadata and render the preview of its file in the background when it changed"""
+
+    attachment = kwargs['instance']
+    if attachment.file and attachment.has_changed('file'):
+        run_in_background(generate_attachment_preview, attachment.pk)
 
 
 @receiver(post_delete, sender=NoteAttachmentModel)
 def delete_note_attachment_file(sender, **kwargs):
-    """The receiver called after a note attachment is deleted
-    to delete the file it pointes to in the filesystem"""
+    """The receiver called after a note attachment is deleted to release
+    its file, which is queued to be deleted from the filesystem when it
+    was the last attachment with its content"""
 
     attachment = kwargs['instance']
     if attachment.file:
-        if os.path.isfile(attachment.file.path):
-            os.remove(attachment.file.path)
+        attachment_files = getattr(_file_batches, 'attachment_files', None)
+        if attachment_files is not None:
+            attachment_files.append(attachment.file.name)
+        else:
+            _release_attachment_files([attachment.file.name])
+
+
+@receiver(post_delete, sender=NoteAttachmentUploadModel)
+def delete_upload_part_file(sender, **kwargs):
+    """The receiver called after an upload is deleted to delete
+    its part file, finished uploads have no part file as it
+    was moved to their attachment"""
+
+    upload = kwargs['instance']
+    paths = getattr(_file_batches, 'paths', None)
+    if paths is not None:
+        paths.append(upload.path)
+    elif os.path.isfile(upload.path):
+        os.remove(upload.path)
+
+
+# a change of the feed, with the owner of the object if it was known without a query,
+# and the id of its notebook for notes and of its note for attachments.
+Change = namedtuple('Change', ('kind', 'object_id', 'deleted', 'user_id', 'parent_id'))
+
+_change_batches = threading.local()
+
+
+def change_of(instance, deleted=False):
+    """returns the change of a saved or deleted notebook, note or attachment"""
+
+    if isinstance(instance, NoteBookModel):
+        return Change(ChangeModel.NOTEBOOK, instance.pk, deleted, instance.user_id, None)
+    if isinstance(instance, NoteModel):
+        user_id = instance.notebook.user_id if NoteModel.notebook.is_cached(instance) else None
+        return Change(ChangeModel.NOTE, instance.pk, deleted, user_id, instance.notebook_id)
+    user_id = None
+    if NoteAttachmentModel.note.is_cached(instance) and NoteModel.notebook.is_cached(instance.note):
+        user_id = instance.note.notebook.user_id
+    return Change(ChangeModel.ATTACHMENT, instance.pk, deleted, user_id, instance.note_id)
+
+
+def _change_owners(changes):
+    """returns the user ids of the changes, they are looked up in at most
+    two queries for the changes whose owners aren't known, using the
+    notebooks and notes of the same changes first as they may be deleted"""
+
+    note_notebooks = {change.object_id: change.parent_id for change in changes if change.kind == ChangeModel.NOTE}
+    notebook_owners = {change.object_id: change.user_id for change in changes
+                       if change.kind == ChangeModel.NOTEBOOK}
+    unknown = [change for change in changes if change.user_id is None]
+
+    missing_notes = {change.parent_id for change in unknown
+                     if change.kind == ChangeModel.ATTACHMENT and change.parent_id not in note_notebooks}
+    if missing_notes:
+        note_notebooks.update(NoteModel.objects.filter(pk__in=missing_notes).values_list('id', 'notebook_id'))
+
+    def notebook_of(change):
+        return change.parent_id if change.kind == ChangeModel.NOTE else note_notebooks.get(change.parent_id)
+
+    missing_notebooks = {notebook_of(change) for change in unknown} - set(notebook_owners) - {None}
+    if missing_notebooks:
+        notebook_owners.update(NoteBookModel.objects.filter(pk__in=missing_notebooks).values_list('id', 'user_id'))
+
+    return [change.user_id if change.user_id is not None else notebook_owners.get(notebook_of(change))
+            for change in changes]
+
+
+def _save_changes(changes):
+    """writes the changes to the feed replacing the older changes of
+    the same objects, the profiles of their owners are locked first so
+    the changes of a user are given their ids in the order they commit"""
+
+    rows = {}
+    for change, user_id in zip(changes, _change_owners(changes)):
+        if user_id is not None:
+            rows[change.kind, change.object_id] = ChangeModel(user_id=user_id, kind=change.kind,
+                                                              object_id=change.object_id, deleted=change.deleted)
+    if not rows:
+        return
+
+    with transaction.atomic(savepoint=False):
+        users = set(UserProfileModel.objects.select_for_update()
+                    .filter(pk__in={row.user_id for row in rows.values()}).values_list('pk', flat=True))
+        rows = [row for row in rows.values() if row.user_id in users]  # the deleted users have no feed
+        if not rows:
+            return
+        replaced = Q()
+        for kind in {row.kind for row in rows}:
+            replaced |= Q(kind=kind, object_id__in=[row.object_id for row in rows if row.kind == kind])
+        ChangeModel.objects.filter(replaced).delete()
+        ChangeModel.objects.bulk_create(rows, batch_size=500)
+
+
+def record_changes(changes):
+    """Records changes in the change feed, or in the batch
+    of the batched_changes block it's called inside.
+    Arguments:
+        changes: the list of the changes, from change_of.
+    """
+    batch = getattr(_change_batches, 'changes', None)
+    if batch is not None:
+        batch.extend(changes)
+    else:
+        _save_changes(changes)
+
+
+@contextmanager
+def batched_changes():
+    """context manager that collects the changes recorded inside it and
+    writes them all at once when it exits, instead of one by one inside
+    the signals, it must be inside the transaction of the changes"""
+
+    if getattr(_change_batches, 'changes', None) is not None:
+        yield  # nested, the outer block writes the changes
+        return
+
+    _change_batches.changes = changes = []
+    try:
+        yield
+    finally:
+        _change_batches.changes = None
+    if changes:
+        _save_changes(changes)
+
+
+@receiver(post_save, sender=NoteBookModel)
+@receiver(post_save, sender=NoteModel)
+@receiver(post_save, sender=NoteAttachmentModel)
+def record_saved_change(sender, **kwargs):
+    """The receiver called after a notebook, note or
+    attachment is saved to record it in the change feed"""
+
+    record_changes([change_of(kwargs['instance'])])
+
+
+@receiver(post_delete, sender=NoteBookModel)
+@receiver(post_delete, sender=NoteModel)
+@receiver(post_delete, sender=NoteAttachmentModel)
+def record_deleted_change(sender, **kwargs):
+    """The receiver called after a notebook, note or attachment
+    is deleted to record its deletion in the change feed"""
+
+    record_changes([change_of(kwargs['instance'], deleted=True)])
+
+
+@receiver(post_delete, sender=UserProfileModel)
+def delete_user_changes(sender, **kwargs):
+    """The receiver called after a user profile is deleted
+    to delete its change feed, which has no foreign key"""
+
+    ChangeModel.objects.filter(user_id=kwargs['instance'].pk).delete()
@@ -0,0 +1,42 @@
+import os
+import tempfile
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """File system storage for files named by the hash of their content.
+    A file with the name of a stored file has the same content, so it's
+    not stored again, and new files are written to a temporary file that
+    replaces their path at once, so two processes storing the same file
+    at the same time just write the same content twice.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        """the name is the content, the stored file with the same name is reused"""
+        return name
+
+    def _save(self, name, content):
+        full_path = self.path(name)
+        try:
+            # the reused file is touched, so the sweep of the
+            # orphaned files doesn't take it for an old one
+            os.utime(full_path)
+            return name
+        except FileNotFoundError:
+            pass
+
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        if hasattr(content, 'temporary_file_path'):
+            file_move_safe(content.temporary_file_path(), full_path, allow_overwrite=True)
+        else:
+            with tempfile.NamedTemporaryFile(dir=directory, delete=False) as temporary_file:
+                for chunk in content.chunks():
+                    temporary_file.write(chunk)
+            os.replace(temporary_file.name, full_path)
+
+        if self.file_permissions_mode is not None:
+            os.chmod(full_path, self.file_permissions_mode)
+        return name
@@ -0,0 +1,89 @@
+from django.db.models import prefetch_related_objects
+from django.http import StreamingHttpResponse
+from rest_framework.response import Response
+
+from core.renderers import json_dumps
+
+
+def iterate_in_chunks(queryset, chunk_size, *lookups):
+    """Iterates a queryset with a server side cursor in lists of rows.
+    iterator() ignores prefetch_related, so the lookups are
+    prefetched for every chunk of rows instead.
+    Arguments:
+        queryset: the queryset that is iterated.
+        chunk_size: the number of rows fetched from the cursor at once.
+        lookups: the lookups prefetched for every chunk.
+    """
+    chunk = []
+    for row in queryset.iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            prefetch_related_objects(chunk, *lookups)
+            yield chunk
+            chunk = []
+    if chunk:
+        prefetch_related_objects(chunk, *lookups)
+        yield chunk
+
+
+class StreamingJSONResponse(StreamingHttpResponse):
+    """A JSON response of a list that is written while its rows are
+    serialized, so the whole payload is never built in memory.
+    The body is the data dict with the list of rows added under the key,
+    it's written in writes of about buffer_size bytes so
+    the compression middleware doesn't flush tiny chunks.
+    """
+
+    buffer_size = 64 * 1024
+
+    def __init__(self, data, key, chunks, serializer_class, context=None, **kwargs):
+        """Arguments:
+            data: the dict that the list of rows is added to.
+            key: the key of the list of rows.
+            chunks: an iterable of lists of rows.
+            serializer_class: the serializer of the rows.
+            context: the context of the serializer.
+        """
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(self._render(data, key, chunks, serializer_class, context or {}), **kwargs)
+
+    def _render(self, data, key, chunks, serializer_class, context):
+        """yields the JSON body of the response"""
+
+        # the data without its closing brace, then the opening of the list
+        buffer = [json_dumps(data)[:-1], b',' if data else b'', json_dumps(key), b':[']
+        size = 0
+        separator = b''
+        for chunk in chunks:
+            # the rows of a chunk are encoded at once, without the brackets of their list
+            rows = json_dumps(serializer_class(chunk, many=True, context=context).data)[1:-1]
+            if not rows:
+                continue
+            buffer.append(separator + rows)
+            size += len(rows)
+            separator = b','
+            if size >= self.buffer_size:
+                yield b''.join(buffer)
+                buffer = []
+                size = 0
+        buffer.append(b']}')
+        yield b''.join(buffer)
+
+
+def list_response(request, data, key, chunks, serializer_class, context=None):
+    """Returns the response of a list view.
+    JSON responses are streamed, other formats like the browsable API
+    are rendered by DRF after serializing all the rows.
+    Arguments:
+        request: the request of the list view.
+        data: the dict that the list of rows is added to,
+              like the pagination links.
+        key: the key of the list of rows.
+        chunks: an iterable of lists of rows.
+        serializer_class: the serializer of the rows.
+        context: the context of the serializer.
+    """
+    if request.accepted_renderer.format == 'json':
+        return StreamingJSONResponse(data, key, chunks, serializer_class, context)
+    data[key] = [row for chunk in chunks for row in serializer_class(chunk, many=True, context=context).data]
+    return Response(data=data)
@@ -0,0 +1,141 @@
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when the queue of a bounded pool is full"""
+
+
+class BoundedExecutor:
+    """A pool of threads with a bounded queue, the callers wait for their
+    function to run, and when max_workers functions run and max_queue wait
+    the next ones are rejected at once, so a burst can't hold the callers
+    for longer than the queue takes to drain. The functions that wait for
+    longer than timeout seconds before they start are rejected as well.
+    It counts the running, waiting, completed and rejected functions and
+    the time they waited.
+    """
+
+    def __init__(self, max_workers, max_queue, thread_name_prefix, timeout=None):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self._stats = {'running': 0, 'waiting': 0, 'completed': 0, 'rejected': 0, 'wait_seconds': 0.0}
+
+    def _call(self, func, args, queued_at):
+        """runs a function in a thread of the pool and counts it"""
+        with self._lock:
+            self._stats['waiting'] -= 1
+            self._stats['running'] += 1
+            self._stats['wait_seconds'] += time.perf_counter() - queued_at
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self._stats['running'] -= 1
+                self._stats['completed'] += 1
+
+    def run(self, func, *args):
+        """Runs a function in the pool and waits for it.
+        Arguments:
+            func: the function that is run.
+            args: the arguments of the function.
+        Returns:
+            the return value of the function.
+        Raises:
+            Overloaded if the queue is full or the function waited for too long.
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise Overloaded
+        try:
+            with self._lock:
+                self._stats['waiting'] += 1
+            future = self._executor.submit(self._call, func, args, time.perf_counter())
+            try:
+                return future.result(self.timeout)
+            except TimeoutError:
+                if not future.cancel():
+                    return future.result()  # it started, so it's waited for like the others
+                with self._lock:
+                    self._stats['waiting'] -= 1
+                    self._stats['rejected'] += 1
+                raise Overloaded
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        """returns the counters of the pool with its limits"""
+        with self._lock:
+            return dict(self._stats, max_workers=self.max_workers, max_queue=self.max_queue)
+
+
+_executor = ThreadPoolExecutor(max_workers=settings.BACKGROUND_WORKERS, thread_name_prefix='background')
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def _run(func, args):
+    """runs a background task in a worker thread"""
+
+    try:
+        func(*args)
+    except Exception:
+        logger.exception('Background task %s failed', func.__name__)
+    finally:
+        connection.close()  # every worker thread has its own connection
+
+
+def run_in_background(func, *args):
+    """Runs a function in the background threads of the process after
+    the transaction commits, so the request doesn't wait for it and
+    the function sees the committed data. The tasks that didn't run
+    are lost if the process exits, so they must be things that
+    a command can redo, like generating the thumbnails.
+    Arguments:
+        func: the function that is run.
+        args: the arguments of the function.
+    """
+    transaction.on_commit(lambda: _executor.submit(_run, func, args))
+
+
+def run_in_process(func, *args):
+    """Runs a function in the worker processes and returns its result,
+    for the CPU heavy parts of the background tasks that would hold the
+    GIL of the server. The processes are spawned at the first call, so they
+    don't inherit the threads and the connections of the server, the function
+    must not use Django. At most BACKGROUND_WORKERS functions wait for
+    the processes at once, one from every background thread.
+    Arguments:
+        func: the function that is run, it must be importable.
+        args: the arguments of the function, they must be picklable.
+    Returns:
+        the return value of the function.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=settings.BACKGROUND_PROCESSES,
+                                                mp_context=multiprocessing.get_context('spawn'))
+        process_pool = _process_pool
+    try:
+        return process_pool.submit(func, *args).result()
+    except BrokenProcessPool:
+        # a worker process died, like a decoder crash, the next call starts a new pool
+        with _process_pool_lock:
+            if _process_pool is process_pool:
+                _process_pool = None
+        raise
@@ -0,0 +1,23 @@
+import os
+import tempfile
+
+from django.test import override_settings
+from django.test.runner import DiscoverRunner
+
+
+class TestRunner(DiscoverRunner):
+    """The test runner of the project, the tests write the
+    journal of the search index in a temporary directory
+    instead of the journal of the project."""
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.search_index_directory = tempfile.TemporaryDirectory()
+        self.search_index_settings = override_settings(
+            SEARCH_INDEX_PATH=os.path.join(self.search_index_directory.name, 'search_index.journal'))
+        self.search_index_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.search_index_settings.disable()
+        self.search_index_directory.cleanup()
+        super().teardown_test_environment(**kwargs)
@@ -1,12 +1,26 @@
 #  Copyright (c) Code Written and Tested by Ahmed Emad in 13/03/2020, 20:02.
 
+import hashlib
+import io
 import os
+from unittest import mock
 
+from PIL import Image
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
 from core.models import NoteBookModel, NoteModel, NoteAttachmentModel, UserProfileModel, users_upload, \
-    attachment_upload
+    attachment_upload, AttachmentBlobModel, FileDeletionModel, ChangeModel, SlugSequenceModel, preview_name
+from core.serializers import NoteAttachmentSerializer
+from core.signals import batched_file_deletion, bulk_unique_slugify
+from core.thumbnails import generate_profile_photo_thumbnails, thumbnail_name, generate_attachment_preview
 
 
 class TestUsers(TestCase):
@@ -19,9 +33,12 @@ class TestUsers(TestCase):
         image_2_id = users_upload(None, 'image2')
         self.assertNotEquals(image_1_id, image_2_id)
 
-        file_1_id = attachment_upload(None, 'file1')
-        file_2_id = attachment_upload(None, 'file2')
+        # attachments are named by their content and format
+        file_1_id = attachment_upload(NoteAttachmentModel(file=ContentFile(b'1', 'file')), 'file.txt')
+        file_2_id = attachment_upload(NoteAttachmentModel(file=ContentFile(b'2', 'file')), 'file.txt')
         self.assertNotEquals(file_1_id, file_2_id)
+        self.assertEqual(attachment_upload(NoteAttachmentModel(file=ContentFile(b'1', 'file')), 'other.txt'), file_1_id)
+        self.assertNotEquals(attachment_upload(NoteAttachmentModel(file=ContentFile(b'1', 'file')), 'file.pdf'), file_1_id)
 
     def test_user_str(self):
         """test for user __str__ unction"""
@@ -38,6 +55,36 @@ class TestUsers(TestCase):
         user_profile.delete()
         self.assertEqual(User.objects.filter(username='username').exists(), False)
 
+    def test_generate_thumbnails_command(self):
+        """test for generating the missing thumbnails of the profile photos"""
+
+        buffer = io.BytesIO()
+        Image.new('RGBA', (100, 300), (0, 0, 255, 128)).save(buffer, 'PNG')
+        account = User.objects.create_user(username='username', password='password')
+        UserProfileModel.objects.create(account=User.objects.create_user(username='other', password='password'))
+        with mock.patch('core.signals.run_in_background') as run_in_background:  # a lost task
+            user_profile = UserProfileModel.objects.create(account=account,
+                                                           profile_photo=ContentFile(buffer.getvalue(), 'photo.png'))
+        run_in_background.assert_called_once_with(generate_profile_photo_thumbnails, user_profile.pk,
+                                                  user_profile.profile_photo.name)
+
+        call_command('generate_thumbnails', stdout=io.StringIO())
+        user_profile.refresh_from_db()
+        self.assertEqual(user_profile.thumbnails_of, user_profile.profile_photo.name)
+        storage = user_profile.profile_photo.storage
+        with Image.open(storage.path(thumbnail_name(user_profile.profile_photo.name, 40))) as image:
+            self.assertEqual(image.mode, 'RGBA')
+            self.assertEqual(image.size, (40, 40))
+
+        # nothing is missing anymore
+        with mock.patch('core.management.commands.generate_thumbnails.generate_profile_photo_thumbnails') as generate:
+            call_command('generate_thumbnails', stdout=io.StringIO())
+        generate.assert_not_called()
+
+        storage.delete(user_profile.profile_photo.name)
+        for size in settings.PROFILE_PHOTO_THUMBNAIL_SIZES:
+            storage.delete(thumbnail_name(user_profile.profile_photo.name, size))
+
 
 class TestNoteBook(TestCase):
     """UnitTest for notebook model"""
@@ -86,6 +133,134 @@ class TestNote(TestCase):
         note3 = NoteModel.objects.create(notebook=notebook2, title='note')
         self.assertEqual(note3.slug, 'note')
 
+    def test_note_slug_queries_constant(self):
+        """test for note slug allocation not probing the taken slugs"""
+
+        user = User.objects.create_user(username='username', password='password')
+        user_profile = UserProfileModel.objects.create(account=user)
+        notebook = NoteBookModel.objects.create(user=user_profile, title='notebook')
+
+        for _ in range(20):
+            NoteModel.objects.create(notebook=notebook, title='note')
+
+        with CaptureQueriesContext(connection) as queries:
+            note = NoteModel.objects.create(notebook=notebook, title='note')
+        self.assertEqual(note.slug, 'note-21')
+
+        with CaptureQueriesContext(connection) as more_queries:
+            note = NoteModel.objects.create(notebook=notebook, title='note')
+        self.assertEqual(note.slug, 'note-22')
+        self.assertEqual(len(queries), len(more_queries))
+
+    def test_note_slug_sequence(self):
+        """test for note slugs seeded from existing slugs and never reused"""
+
+        user = User.objects.create_user(username='username', password='password')
+        user_profile = UserProfileModel.objects.create(account=user)
+        notebook = NoteBookModel.objects.create(user=user_profile, title='notebook')
+
+        # slugs taken before the sequence existed
+        NoteModel.objects.bulk_create([NoteModel(notebook=notebook, title='note', slug='note'),
+                                       NoteModel(notebook=notebook, title='note', slug='note-7')])
+        note = NoteModel.objects.create(notebook=notebook, title='note')
+        self.assertEqual(note.slug, 'note-8')
+
+        # a title ending with a number taking a slug of the sequence
+        NoteModel.objects.create(notebook=notebook, title='note 9')
+        note = NoteModel.objects.create(notebook=notebook, title='note')
+        self.assertEqual(note.slug, 'note-10')
+
+        # deleted slugs are not given again
+        note.delete()
+        note = NoteModel.objects.create(notebook=notebook, title='note')
+        self.assertEqual(note.slug, 'note-11')
+
+        # saving without changing the title keeps the slug
+        note.text = 'text'
+        note.save()
+        self.assertEqual(note.slug, 'note-11')
+
+        # long titles are cut to fit the number
+        note1 = NoteModel.objects.create(notebook=notebook, title='a' * 255)
+        note2 = NoteModel.objects.create(notebook=notebook, title='a' * 255)
+        self.assertEqual(note1.slug, 'a' * 255)
+        self.assertEqual(note2.slug, 'a' * 253 + '-2')
+
+    def test_note_slug_sequence_delete(self):
+        """test that the slug sequences are deleted with their parents"""
+
+        user = User.objects.create_user(username='username', password='password')
+        user_profile = UserProfileModel.objects.create(account=user)
+        notebook = NoteBookModel.objects.create(user=user_profile, title='notebook')
+        other = NoteBookModel.objects.create(user=user_profile, title='other')
+        note = NoteModel.objects.create(notebook=notebook, title='note')
+        NoteModel.objects.bulk_create([NoteModel(notebook=other, slug=slug, title='note')
+                                       for slug in bulk_unique_slugify(NoteModel, 'notebook', other.pk, ['note'])])
+        NoteAttachmentModel.objects.create(note=note, file='attachments/file.txt')
+        self.assertEqual(SlugSequenceModel.objects.count(), 5)
+
+        notebook.delete()
+        self.assertEqual(set(SlugSequenceModel.objects.values_list('user', 'notebook')),
+                         {(user_profile.pk, None), (None, other.pk)})
+        user.delete()
+        self.assertFalse(SlugSequenceModel.objects.exists())
+
+    def test_note_tracked_fields(self):
+        """test for note changed fields tracking"""
+
+        user = User.objects.create_user(username='username', password='password')
+        user_profile = UserProfileModel.objects.create(account=user)
+        notebook1 = NoteBookModel.objects.create(user=user_profile, title='notebook1')
+        notebook2 = NoteBookModel.objects.create(user=user_profile, title='notebook2')
+
+        note = NoteModel(notebook=notebook1, title='note')
+        self.assertTrue(note.has_changed('title'))  # not saved yet
+        note.save()
+        self.assertFalse(note.has_changed('title', 'notebook'))
+
+        note = NoteModel.objects.get(pk=note.pk)
+        note.text = 'text'
+        self.assertFalse(note.has_changed('title', 'notebook'))
+        note.title = 'new note'
+        self.assertTrue(note.has_changed('title'))
+        note.save()
+        self.assertEqual(note.slug, 'new-note')
+        self.assertFalse(note.has_changed('title'))
+
+        # moving to a notebook that has the same slug
+        NoteModel.objects.create(notebook=notebook2, title='new note')
+        note.notebook = notebook2
+        self.assertTrue(note.has_changed('notebook'))
+        note.save()
+        self.assertEqual(note.slug, 'new-note-2')
+
+    def test_note_version(self):
+        """test for note versions increasing on every change"""
+
+        user = User.objects.create_user(username='username', password='password')
+        user_profile = UserProfileModel.objects.create(account=user)
+        notebook = NoteBookModel.objects.create(user=user_profile, title='notebook')
+
+        note = NoteModel.objects.create(notebook=notebook, title='note')
+        self.assertEqual(note.version, 1)
+        etag = note.etag
+
+        note.text = 'text'
+        note.save()
+        self.assertEqual(note.version, 2)
+        note.text = 'other'
+        note.save(update_fields=['text'])
+        note.refresh_from_db()
+        self.assertEqual(note.version, 3)
+        self.assertNotEqual(note.etag, etag)
+
+        # attachment changes
+        updated_at = note.updated_at
+        NoteModel.objects.touch(note.pk)
+        note.refresh_from_db()
+        self.assertEqual(note.version, 4)
+        self.assertGreater(note.updated_at, updated_at)
+
     def test_note_str(self):
         """test for note __str__ function"""
 
@@ -136,4 +311,204 @@ class TestNoteAttachment(TestCase):
         self.assertTrue(os.path.isfile(attachment.file.path))
         attachment.delete()
 
+        # the file is queued and deleted by the worker
+        self.assertTrue(os.path.isfile(attachment.file.path))
+        self.assertTrue(FileDeletionModel.objects.filter(name='.test').exists())
+        call_command('delete_queued_files', stdout=io.StringIO())
         self.assertFalse(os.path.isfile(attachment.file.path))
+        self.assertFalse(FileDeletionModel.objects.exists())
+
+    def test_file_dedupe(self):
+        """test for storing the attachments with the same content once"""
+
+        user = User.objects.create_user(username='username', password='password')
+        user_profile = UserProfileModel.objects.create(account=user)
+        notebook = NoteBookModel.objects.create(user=user_profile, title='notebook')
+        notes = [NoteModel.objects.create(notebook=notebook, title='note %s' % i) for i in range(3)]
+
+        attachments = [NoteAttachmentModel.objects.create(note=note, file=SimpleUploadedFile('file.txt', b'content'))
+                       for note in notes]
+        other = NoteAttachmentModel.objects.create(note=notes[0], file=SimpleUploadedFile('file.txt', b'other'))
+        path = attachments[0].file.path
+        self.assertEqual({attachment.file.name for attachment in attachments},
+                         {'attachments/%s.txt' % hashlib.sha256(b'content').hexdigest()})
+        self.assertNotEqual(other.file.path, path)
+        self.assertEqual(AttachmentBlobModel.objects.get(name=attachments[0].file.name).references, 3)
+
+        # a long format is cut to fit the name fields
+        long = NoteAttachmentModel.objects.create(note=notes[1], file=SimpleUploadedFile('file.' + 'x' * 200, b'long'))
+        self.assertEqual(long.file.name, 'attachments/%s.%s' % (hashlib.sha256(b'long').hexdigest(), 'x' * 23))
+        self.assertEqual(AttachmentBlobModel.objects.get(name=long.file.name).references, 1)
+        long.delete()
+
+        # the file is deleted with its last reference
+        attachments[0].delete()
+        self.assertTrue(os.path.isfile(path))
+        with batched_file_deletion():
+            NoteAttachmentModel.objects.filter(pk__in=[attachments[1].pk, other.pk]).delete()
+        self.assertEqual(AttachmentBlobModel.objects.get().references, 1)
+        attachments[2].delete()
+        call_command('delete_queued_files', stdout=io.StringIO())
+        self.assertFalse(os.path.isfile(path))
+        self.assertFalse(os.path.isfile(other.file.path))
+        self.assertFalse(AttachmentBlobModel.objects.exists())
+
+    def test_file_deletion_queue(self):
+        """test for queueing the attachment files in the transaction of their deletion"""
+
+        user = User.objects.create_user(username='username', password='password')
+        user_profile = UserProfileModel.objects.create(account=user)
+        notebook = NoteBookModel.objects.create(user=user_profile, title='notebook')
+        note = NoteModel.objects.create(notebook=notebook, title='note')
+        attachment = NoteAttachmentModel.objects.create(note=note, file=SimpleUploadedFile('file.txt', b'content'))
+        path = attachment.file.path
+
+        # a rolled back deletion keeps the file
+        try:
+            with transaction.atomic():
+                NoteAttachmentModel.objects.get(pk=attachment.pk).delete()
+                self.assertTrue(FileDeletionModel.objects.exists())
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(FileDeletionModel.objects.exists())
+        self.assertEqual(AttachmentBlobModel.objects.get().references, 1)
+
+        # a file that is referenced again before the worker deletes it is kept
+        attachment.delete()
+        self.assertTrue(FileDeletionModel.objects.exists())
+        attachment = NoteAttachmentModel.objects.create(note=note, file=SimpleUploadedFile('file.txt', b'content'))
+        self.assertFalse(FileDeletionModel.objects.exists())
+        call_command('delete_queued_files', stdout=io.StringIO())
+        self.assertTrue(os.path.isfile(path))
+
+        # the worker deletes the queue in batches
+        attachment.delete()
+        other = NoteAttachmentModel.objects.create(note=note, file=SimpleUploadedFile('file.txt', b'other'))
+        other.delete()
+        self.assertEqual(FileDeletionModel.objects.count(), 4)  # the files and their previews
+        self.assertEqual(FileDeletionModel.objects.delete_files(1), 1)
+        self.assertEqual(FileDeletionModel.objects.count(), 3)
+        call_command('delete_queued_files', batch_size=1, stdout=io.StringIO())
+        self.assertFalse(FileDeletionModel.objects.exists())
+        self.assertFalse(os.path.isfile(path))
+        self.assertFalse(os.path.isfile(other.file.path))
+
+    def test_previews(self):
+        """test for reading the metadata and rendering the previews of the attachments"""
+
+        user = User.objects.create_user(username='username', password='password')
+        user_profile = UserProfileModel.objects.create(account=user)
+        notebook = NoteBookModel.objects.create(user=user_profile, title='notebook')
+        notes = [NoteModel.objects.create(notebook=notebook, title='note %s' % i) for i in range(2)]
+
+        # a photo taken on its side
+        buffer = io.BytesIO()
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        Image.new('RGB', (640, 480), 'green').save(buffer, 'JPEG', exif=exif)
+        photos = [NoteAttachmentModel.objects.create(note=note, file=SimpleUploadedFile('photo.jpg', buffer.getvalue()))
+                  for note in notes]
+        text = NoteAttachmentModel.objects.create(note=notes[0], file=SimpleUploadedFile('file.txt', b'text'))
+        pdf = NoteAttachmentModel.objects.create(note=notes[0], file=SimpleUploadedFile('file.pdf', b'%PDF-1.4'))
+        self.assertIsNone(NoteAttachmentSerializer(photos[0]).data['size'])
+
+        # the attachments with the same file are saved together and recorded in the change feed
+        versions = {note.pk: note.version for note in notes}
+        last_change = ChangeModel.objects.order_by('id').last().id
+        generate_attachment_preview(photos[0].pk)
+        for photo in photos:
+            photo.refresh_from_db()
+            self.assertEqual((photo.content_type, photo.size, photo.width, photo.height, photo.has_preview),
+                             ('image/jpeg', len(buffer.getvalue()), 480, 640, True))
+        for note in NoteModel.objects.filter(pk__in=versions):
+            self.assertEqual(note.version, versions[note.pk] + 1)
+        self.assertEqual(set(ChangeModel.objects.filter(id__gt=last_change).values_list('object_id', flat=True)),
+                         {photo.pk for photo in photos})
+        storage = photos[0].file.storage
+        with Image.open(storage.path(preview_name(photos[0].file.name))) as image:
+            self.assertEqual(image.format, 'WEBP')
+            self.assertEqual(image.size, (240, 320))
+        self.assertEqual(NoteAttachmentSerializer(photos[0]).data['preview'],
+                         reverse('core:attachments-preview', kwargs={'notebook_slug': notebook.slug,
+                                                                     'note_slug': photos[0].note.slug,
+                                                                     'slug': photos[0].slug}))
+
+        # files without previews
+        generate_attachment_preview(text.pk)
+        generate_attachment_preview(pdf.pk)
+        text.refresh_from_db()
+        pdf.refresh_from_db()
+        self.assertEqual((text.content_type, text.size, text.has_preview), ('text/plain', 4, False))
+        self.assertEqual((pdf.content_type, pdf.width, pdf.has_preview), ('application/pdf', None, False))
+        self.assertIsNone(NoteAttachmentSerializer(text).data['preview'])
+
+        # the missing ones are generated by the command
+        NoteAttachmentModel.objects.update(size=None)
+        call_command('generate_previews', stdout=io.StringIO())
+        self.assertFalse(NoteAttachmentModel.objects.filter(size__isnull=True).exists())
+
+        # the preview is deleted with the file
+        for attachment in NoteAttachmentModel.objects.all():
+            attachment.delete()
+        self.assertTrue(FileDeletionModel.objects.filter(name=preview_name(photos[0].file.name)).exists())
+        call_command('delete_queued_files', stdout=io.StringIO())
+        self.assertFalse(os.path.isfile(storage.path(preview_name(photos[0].file.name))))
+
+    def test_sweep_command(self):
+        """test for queueing the orphaned attachment files"""
+
+        user = User.objects.create_user(username='username', password='password')
+        user_profile = UserProfileModel.objects.create(account=user)
+        notebook = NoteBookModel.objects.create(user=user_profile, title='notebook')
+        note = NoteModel.objects.create(notebook=notebook, title='note')
+        attachment = NoteAttachmentModel.objects.create(note=note, file=SimpleUploadedFile('file.txt', b'content'))
+        storage = NoteAttachmentModel._meta.get_field('file').storage
+        orphan = storage.path('attachments/orphan.txt')
+        with open(orphan, 'wb') as file:
+            file.write(b'orphan')
+
+        # new files may be referenced by transactions that aren't committed yet
+        call_command('sweep_attachment_files', stdout=io.StringIO())
+        self.assertFalse(FileDeletionModel.objects.exists())
+
+        call_command('sweep_attachment_files', min_age=0, stdout=io.StringIO())
+        queued = FileDeletionModel.objects.values_list('name', flat=True)
+        self.assertIn('attachments/orphan.txt', queued)
+        self.assertNotIn(attachment.file.name, queued)
+        call_command('delete_queued_files', stdout=io.StringIO())
+        self.assertFalse(os.path.isfile(orphan))
+        self.assertTrue(os.path.isfile(attachment.file.path))
+
+        attachment.delete()
+        call_command('delete_queued_files', stdout=io.StringIO())
+
+    def test_dedupe_command(self):
+        """test for renaming the existing attachment files by their content"""
+
+        user = User.objects.create_user(username='username', password='password')
+        user_profile = UserProfileModel.objects.create(account=user)
+        notebook = NoteBookModel.objects.create(user=user_profile, title='notebook')
+        note = NoteModel.objects.create(notebook=notebook, title='note')
+        storage = NoteAttachmentModel._meta.get_field('file').storage
+
+        # files stored before the content addressing
+        names = ['attachments/%sfile.txt' % i for i in range(3)]
+        os.makedirs(storage.path('attachments'), exist_ok=True)
+        for name in names:
+            with open(storage.path(name), 'wb') as file:
+                file.write(b'content')
+        for name in names + names[:1] + ['attachments/missing.txt']:
+            NoteAttachmentModel.objects.create(note=note, file=name)
+
+        call_command('dedupe_attachments', stdout=io.StringIO())
+
+        name = 'attachments/%s.txt' % hashlib.sha256(b'content').hexdigest()
+        self.assertEqual(NoteAttachmentModel.objects.filter(file=name).count(), 4)
+        self.assertEqual(AttachmentBlobModel.objects.get(name=name).references, 4)
+        self.assertEqual(AttachmentBlobModel.objects.get(name='attachments/missing.txt').references, 1)
+        self.assertFalse([old for old in names if os.path.exists(storage.path(old))])
+        for attachment in NoteAttachmentModel.objects.all():
+            attachment.delete()
+        call_command('delete_queued_files', stdout=io.StringIO())
+        self.assertFalse(os.path.exists(storage.path(name)))
@@ -0,0 +1,206 @@
+from contextlib import contextmanager
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from core.models import UserProfileModel, NoteBookModel, NoteModel, NoteAttachmentModel
+
+
+@contextmanager
+def execute_on_commit_callbacks():
+    """runs the on_commit callbacks registered in the block at its end, like
+    captureOnCommitCallbacks(execute=True) of newer django versions, the
+    transaction of a TestCase is never committed so they'd never run"""
+
+    start = len(connection.run_on_commit)
+    try:
+        yield
+    finally:
+        # the callbacks can register more callbacks
+        while len(connection.run_on_commit) > start:
+            callbacks = connection.run_on_commit[start:]
+            start = len(connection.run_on_commit)
+            for _, callback in callbacks:
+                callback()
+
+
+class DiscardingExecutor:
+    """drops the background tasks, they don't run in the requests"""
+
+    def submit(self, func, *args):
+        pass
+
+
+@mock.patch('core.tasks._executor', DiscardingExecutor())
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class TestQueryCounts(TestCase):
+    """Unit Test for the number of queries of every endpoint,
+    it must not grow with the number of rows the endpoint works on"""
+
+    small, large = 2, 6
+
+    def make_user(self, size):
+        """creates a user with size notebooks, every notebook has
+        size notes and every note has an attachment, and logs it in"""
+
+        account = User.objects.create_user(username='user%s' % User.objects.count(), password='password')
+        user_profile = UserProfileModel.objects.create(account=account)
+        for i in range(size):
+            notebook = NoteBookModel.objects.create(user=user_profile, title='notebook %s' % i)
+            notes = [NoteModel(notebook=notebook, title='note %s' % j, slug='note-%s' % j, text='text')
+                     for j in range(size)]
+            NoteModel.objects.bulk_create(notes)
+            for note in notebook.notes.all():
+                NoteAttachmentModel.objects.create(note=note, file='attachments/missing.txt')
+        self.client.force_login(account)
+        return user_profile
+
+    def count_queries(self, size, request):
+        """returns the number of queries of a request on the data of a user of the given size"""
+
+        self.make_user(size)
+        # the work done after commit, like indexing the notes, counts as well
+        with CaptureQueriesContext(connection) as queries, execute_on_commit_callbacks():
+            response = request(size)
+            # streaming responses run their queries while they are written
+            content = b''.join(response.streaming_content) if response.streaming else response.content
+        self.assertLess(response.status_code, 300, content)
+        return len(queries)
+
+    def assertQueriesConstant(self, request):
+        """checks that the request runs the same number of queries on small and large data"""
+
+        self.assertEqual(self.count_queries(self.small, request),
+                         self.count_queries(self.large, request))
+
+    def test_authentication(self):
+        """test that an authenticated request loads its user with the profile in one query"""
+
+        url = reverse('core:user-details')
+        user_profile = self.make_user(0)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 2)  # the session and the user with its profile
+
+        # only the session is read when the users are cached
+        with self.settings(AUTH_USER_CACHE_TIMEOUT=60):
+            self.client.get(url)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(queries), 1)
+
+            # a changed user isn't read from the cache
+            self.client.patch(url, {'first_name': 'changed'}, content_type='application/json')
+            self.assertEqual(self.client.get(url).data['first_name'], 'changed')
+            user_profile.account.set_password('changed')
+            user_profile.account.save()
+            self.assertEqual(self.client.get(url).status_code, 403)
+        cache.clear()
+
+        # the access tokens run no queries
+        self.client.logout()
+        tokens = self.client.post(reverse('core:token-login'), {'username': user_profile.account.username,
+                                                                'password': 'changed'},
+                                  content_type='application/json').data
+        url = reverse('core:notebooks-list')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'limit': 100}, HTTP_AUTHORIZATION='Bearer ' + tokens['access'])
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([query for query in queries if 'auth_user' in query['sql'] or
+                          'django_session' in query['sql'] or 'core_userprofilemodel' in query['sql']])
+
+    def test_user_details(self):
+        """test for user details queries"""
+
+        url = reverse('core:user-details')
+        self.assertQueriesConstant(lambda size: self.client.get(url))
+        self.assertQueriesConstant(lambda size: self.client.patch(url, {'first_name': 'name%s' % size},
+                                                                   content_type='application/json'))
+
+    def test_notebooks_list(self):
+        """test for notebook list queries"""
+
+        url = reverse('core:notebooks-list')
+        self.assertQueriesConstant(lambda size: self.client.get(url, {'limit': 100}))
+        self.assertQueriesConstant(lambda size: self.client.get(url, {'cursor': '', 'limit': 100}))
+
+    def test_notebook_tree(self):
+        """test for notebook tree queries"""
+
+        url = reverse('core:tree')
+        self.assertQueriesConstant(lambda size: self.client.get(url))
+
+    def test_changes(self):
+        """test for change feed queries"""
+
+        url = reverse('core:changes')
+        self.assertQueriesConstant(lambda size: self.client.get(url, {'since': 0, 'limit': 1000}))
+
+    def test_notebook_details(self):
+        """test for notebook create, update and delete queries"""
+
+        url = reverse('core:notebooks-list')
+        self.assertQueriesConstant(lambda size: self.client.post(url, {'title': 'notebook 0'},
+                                                                 content_type='application/json'))
+        url = reverse('core:notebooks-detail', kwargs={'slug': 'notebook-1'})
+        self.assertQueriesConstant(lambda size: self.client.put(url, {'title': 'renamed'},
+                                                                content_type='application/json'))
+        url = reverse('core:notebooks-detail', kwargs={'slug': 'notebook-0'})
+        self.assertQueriesConstant(lambda size: self.client.delete(url))
+
+    def test_notes_list(self):
+        """test for note list queries"""
+
+        url = reverse('core:notes-list', kwargs={'notebook_slug': 'notebook-0'})
+        self.assertQueriesConstant(lambda size: self.client.get(url, {'limit': 100}))
+        self.assertQueriesConstant(lambda size: self.client.get(url, {'cursor': '', 'limit': 100}))
+
+    def test_note_details(self):
+        """test for note create, retrieve, update and delete queries"""
+
+        url = reverse('core:notes-list', kwargs={'notebook_slug': 'notebook-0'})
+        self.assertQueriesConstant(lambda size: self.client.post(url, {'title': 'note 0'},
+                                                                 content_type='application/json'))
+        self.assertQueriesConstant(lambda size: self.client.post(url, [{'title': 'note 0'}] * size,
+                                                                 content_type='application/json'))
+
+        url = reverse('core:notes-detail', kwargs={'notebook_slug': 'notebook-0', 'slug': 'note-1'})
+        self.assertQueriesConstant(lambda size: self.client.get(url))
+        self.assertQueriesConstant(lambda size: self.client.put(url, {'title': 'note 0', 'text': 'text'},
+                                                                content_type='application/json'))
+        self.assertQueriesConstant(lambda size: self.client.patch(url, {'text': 'new text'},
+                                                                  content_type='application/json'))
+        self.assertQueriesConstant(lambda size: self.client.delete(url))
+
+    def test_note_bulk(self):
+        """test for note bulk delete and move queries"""
+
+        url = reverse('core:notes-bulk-delete', kwargs={'notebook_slug': 'notebook-0'})
+        self.assertQueriesConstant(lambda size: self.client.post(
+            url, {'slugs': ['note-%s' % i for i in range(size)]}, content_type='application/json'))
+
+        url = reverse('core:notes-bulk-move', kwargs={'notebook_slug': 'notebook-0'})
+        self.assertQueriesConstant(lambda size: self.client.post(
+            url, {'slugs': ['note-%s' % i for i in range(size)], 'notebook': 'notebook-1'},
+            content_type='application/json'))
+
+    def test_attachments(self):
+        """test for note attachment create and delete queries"""
+
+        url = reverse('core:attachments-list', kwargs={'notebook_slug': 'notebook-0', 'note_slug': 'note-0'})
+        self.assertQueriesConstant(lambda size: self.client.post(
+            url, {'file': SimpleUploadedFile('upload.txt', b'a' * size)}))
+        for attachment in NoteAttachmentModel.objects.filter(slug='uploadtxt'):
+            attachment.delete()  # deletes the uploaded files
+
+        url = reverse('core:attachments-detail', kwargs={'notebook_slug': 'notebook-0', 'note_slug': 'note-0',
+                                                         'slug': 'attachmentsmissingtxt'})
+        self.assertQueriesConstant(lambda size: self.client.delete(url))
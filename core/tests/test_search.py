@@ -0,0 +1,116 @@
+import json
+import os
+import tempfile
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from core.models import UserProfileModel, NoteBookModel, NoteModel
+from core.search import InvertedIndexBackend
+
+
+class TestInvertedIndex(TestCase):
+    """Unit Test for the inverted index search backend"""
+
+    def setUp(self):
+        """setup for unittest"""
+        self.user = UserProfileModel.objects.create(
+            account=User.objects.create_user(username='username', password='password'))
+        self.notebook = NoteBookModel.objects.create(user=self.user, title='work')
+        self.notes = [
+            NoteModel.objects.create(notebook=self.notebook, title='weekly meeting', text='talked about the budget'),
+            NoteModel.objects.create(notebook=self.notebook, title='todo', text='prepare the meeting room'),
+            NoteModel.objects.create(notebook=self.notebook, title='meetup', text='room booked for the weekly talk'),
+        ]
+        self.other = UserProfileModel.objects.create(
+            account=User.objects.create_user(username='other', password='password'))
+        other_notebook = NoteBookModel.objects.create(user=self.other, title='work')
+        self.notes.append(NoteModel.objects.create(notebook=other_notebook, title='meeting', text='not yours'))
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'index.journal')
+        self.backend = InvertedIndexBackend(self.path)
+        self.backend.index_notes(self.notes)
+
+    def search(self, text, backend=None):
+        """returns the slugs of the notes that match a search ordered by their rank"""
+        results = (backend or self.backend).search(self.user, text).order_by('-score', '-id')
+        return [note.slug for note in results]
+
+    def test_search(self):
+        """Test for words, prefixes and phrases"""
+
+        self.assertEqual(self.search('meeting'), ['weekly-meeting', 'todo'])
+        self.assertEqual(self.search('MEETING room'), ['todo'])
+        self.assertEqual(self.search('meet*'), ['meetup', 'weekly-meeting', 'todo'])
+        self.assertEqual(self.search('"weekly talk"'), ['meetup'])
+        self.assertEqual(self.search('"talked budget"'), [])
+        # phrases don't run from the title into the text
+        self.assertEqual(self.search('"meeting talked"'), [])
+        self.assertEqual(self.search('yours'), [])
+
+    def test_highlight(self):
+        """Test for the snippets of the results"""
+
+        notes = list(self.backend.search(self.user, 'room'))
+        self.backend.highlight(notes, 'room')
+        snippets = sorted(note.snippet for note in notes)
+        self.assertEqual(snippets, ['<mark>room</mark> booked for the weekly talk',
+                                    'prepare the meeting <mark>room</mark>'])
+
+    def test_updates(self):
+        """Test for indexing changed and deleted notes"""
+
+        note = self.notes[0]
+        note.title = 'budget'
+        self.backend.index_note(note)
+        self.assertEqual(self.search('meeting'), ['todo'])
+        self.backend.remove_note(self.notes[1].pk)
+        self.assertEqual(self.search('meeting'), [])
+
+    def test_journal(self):
+        """Test for sharing the index through its journal"""
+
+        # another process reads the index from the journal
+        other = InvertedIndexBackend(self.path)
+        self.assertEqual(self.search('meeting', other), ['weekly-meeting', 'todo'])
+
+        # and sees the later changes
+        self.backend.remove_note(self.notes[1].pk)
+        self.assertEqual(self.search('meeting', other), ['weekly-meeting'])
+
+        # the journal is compacted when it's mostly stale entries
+        with mock.patch.object(InvertedIndexBackend, 'compaction_slack', 10000):
+            for i in range(300):
+                self.backend.index_notes(self.notes)
+        with open(self.path) as journal:
+            self.assertLess(len(journal.readlines()), 1200)
+        self.assertEqual(self.search('meeting', other), ['weekly-meeting', 'todo'])
+
+        # rebuilding replaces the whole index
+        self.backend.rebuild([(self.notes[2].id, self.user.id, 'meetup', 'room')])
+        self.assertEqual(self.search('meet*', other), ['meetup'])
+
+    def test_long_note_saves(self):
+        """Test that the saves of a long note don't grow the journal without bound"""
+
+        note = self.notes[0]
+        note.text = 'budget ' * 20000
+        for i in range(100):
+            self.backend.index_note(note)
+        size = len(json.dumps(note.text.split()))
+        self.assertLess(os.path.getsize(self.path), 3 * size + InvertedIndexBackend.compaction_slack)
+        self.assertEqual(self.search('budget'), ['weekly-meeting'])
+
+    def test_notebook_queries(self):
+        """Test that the users of the notes are read in one query"""
+
+        notes = list(NoteModel.objects.order_by('id'))
+        with self.assertNumQueries(1):
+            self.backend.index_notes(notes)
+        notes = list(NoteModel.objects.select_related('notebook'))
+        with self.assertNumQueries(0):
+            self.backend.index_notes(notes)
+        self.assertEqual(self.search('meeting'), ['weekly-meeting', 'todo'])
@@ -1,12 +1,23 @@
 #  Copyright (c) Code Written and Tested by Ahmed Emad in 14/03/2020, 22:30.
 
+import datetime
 import os
+from unittest import mock
 
 from django.contrib.auth.models import User
 from django.core.files import File
+from django.db.models import Count
 from django.test import TestCase
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
 
-from core.serializers import UserProfileSerializer, NoteAttachmentSerializer
+from core.models import UserProfileModel, NoteBookModel, NoteModel, NoteAttachmentModel
+from core.renderers import FastJSONRenderer
+from core.serializers import UserProfileSerializer, NoteAttachmentSerializer, NoteTextEditsSerializer, \
+    NoteSerializer, NoteDetailSerializer, NoteBookSerializer, NoteValuesSerializer, NoteDetailValuesSerializer, \
+    NoteBookValuesSerializer
 
 
 class TestUsers(TestCase):
@@ -86,3 +97,115 @@ class TestNoteAttachment(TestCase):
         # delete file from os after test
         os.remove(self.file.name)
         os.remove(self.file2.name)
+
+
+class TestNoteTextEdits(TestCase):
+    """UnitTest for note text edits serializers"""
+
+    def edit(self, text, edits):
+        """returns the serializer of edits made to a text"""
+        serializer = NoteTextEditsSerializer(data={'text_edits': edits}, context={'text': text})
+        serializer.is_valid()
+        return serializer
+
+    def test_apply(self):
+        """test for applying the edits to the text"""
+
+        serializer = self.edit('the weekly meeting', [{'position': 0, 'delete': 3, 'insert': 'a'},
+                                                      {'position': 4, 'insert': 'long '},
+                                                      {'position': 11, 'delete': 7, 'insert': 'call'}])
+        self.assertEqual(serializer.validated_data['text'], 'a long weekly call')
+
+        # appending and the whitespace is kept
+        serializer = self.edit('text', [{'position': 4, 'insert': '\n  more'}])
+        self.assertEqual(serializer.validated_data['text'], 'text\n  more')
+
+        # the positions are in UTF-16 code units, an emoji takes two
+        serializer = self.edit('a \U0001F600 b \U0001F600 c', [{'position': 2, 'delete': 2, 'insert': 'x'},
+                                                              {'position': 9, 'insert': '!'}])
+        self.assertEqual(serializer.validated_data['text'], 'a x b \U0001F600! c')
+
+    def test_validation(self):
+        """test for edits that can't be applied"""
+
+        self.assertFalse(self.edit('text', []).is_valid())
+        self.assertFalse(self.edit('text', [{'position': 5, 'insert': 'a'}]).is_valid())
+        self.assertFalse(self.edit('text', [{'position': 2, 'delete': 3}]).is_valid())
+        self.assertFalse(self.edit('text', [{'position': -1}]).is_valid())
+        # not sorted or overlapping
+        self.assertFalse(self.edit('text', [{'position': 2}, {'position': 1}]).is_valid())
+        self.assertFalse(self.edit('text', [{'position': 0, 'delete': 2}, {'position': 1}]).is_valid())
+        self.assertTrue(self.edit('text', [{'position': 0, 'delete': 2}, {'position': 2}]).is_valid())
+        # inside the text in UTF-16 code units but not splitting a surrogate pair
+        self.assertTrue(self.edit('\U0001F600', [{'position': 2, 'insert': 'a'}]).is_valid())
+        self.assertFalse(self.edit('\U0001F600', [{'position': 3, 'insert': 'a'}]).is_valid())
+        self.assertFalse(self.edit('\U0001F600', [{'position': 1, 'insert': 'a'}]).is_valid())
+        self.assertFalse(self.edit('\U0001F600', [{'position': 0, 'delete': 1}]).is_valid())
+
+
+class TestValuesSerializers(TestCase):
+    """UnitTest for the lean serializers of values() rows"""
+
+    def setUp(self):
+        """setup for unittest"""
+
+        user = UserProfileModel.objects.create(account=User.objects.create_user(username='username',
+                                                                                password='password'))
+        notebook = NoteBookModel.objects.create(user=user, title='work')
+        NoteBookModel.objects.create(user=user, title='empty')
+        note = NoteModel.objects.create(notebook=notebook, title='meeting', text='the budget')
+        other = NoteModel.objects.create(notebook=notebook, title='todo')
+        NoteAttachmentModel.objects.create(note=note, file='attachments/file.txt')
+        NoteAttachmentModel.objects.create(note=other, file='')
+        NoteAttachmentModel.objects.filter(note=note).update(content_type='text/plain', size=4, has_preview=True)
+
+    def test_same_output(self):
+        """test that the lean serializers give the output of the model serializers"""
+
+        notes = NoteModel.objects.order_by('id')
+        self.assertEqual(NoteValuesSerializer(NoteValuesSerializer.values(notes), many=True).data,
+                         NoteSerializer(notes, many=True).data)
+
+        request = APIRequestFactory().get('/')
+        rows = NoteDetailValuesSerializer.add_attachments(list(NoteDetailValuesSerializer.values(notes)))
+        for context in ({}, {'request': request}):
+            self.assertEqual(NoteDetailValuesSerializer(rows, many=True, context=context).data,
+                             NoteDetailSerializer(notes, many=True, context=context).data)
+
+        notebooks = NoteBookModel.objects.annotate(notes_count=Count('notes')).order_by('id')
+        rows = NoteBookValuesSerializer.add_notes(list(NoteBookValuesSerializer.values(notebooks)),
+                                                  NoteModel.objects.order_by('id'))
+        self.assertEqual(NoteBookValuesSerializer(rows, many=True).data,
+                         NoteBookSerializer(notebooks, many=True).data)
+
+    def test_first_notes(self):
+        """test that only the first notes of every notebook are added in the order of the queryset"""
+
+        notebook = NoteBookModel.objects.get(slug='work')
+        NoteModel.objects.create(notebook=notebook, title='agenda')
+        notebooks = NoteBookModel.objects.annotate(notes_count=Count('notes')).order_by('id')
+        rows = NoteBookValuesSerializer.add_notes(list(NoteBookValuesSerializer.values(notebooks)),
+                                                  NoteModel.objects.order_by('-id'), 2)
+        self.assertEqual([[note['slug'] for note in row['notes']] for row in rows], [['agenda', 'todo'], []])
+        self.assertEqual(rows[0]['notes_count'], 3)
+
+
+class TestFastJSONRenderer(TestCase):
+    """UnitTest for the JSON renderer"""
+
+    def test_same_output(self):
+        """test that it renders the same JSON as the renderer of DRF"""
+
+        data = {'text': 'نص \u2028 "quoted"', 'lazy': _('username'), 'number': 1.5, 'none': None,
+                'date': datetime.datetime(2020, 3, 14, 22, 30, 5, 120, tzinfo=timezone.utc),
+                'day': datetime.date(2020, 3, 14), 'list': [1, {'nested': True}]}
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(FastJSONRenderer().render(None), b'')
+
+        # without orjson
+        with mock.patch('core.renderers.orjson', None):
+            self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+        # indented JSON
+        self.assertEqual(FastJSONRenderer().render(data, 'application/json; indent=2'),
+                         JSONRenderer().render(data, 'application/json; indent=2'))
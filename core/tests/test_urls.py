@@ -3,7 +3,8 @@
 from django.test import TestCase
 from django.urls import reverse, resolve
 
-from core.views import UserProfileView, user_login, user_logout, NoteBookView, NoteView, NoteAttachmentView
+from core.views import UserProfileView, user_login, user_logout, NoteBookView, NoteView, NoteAttachmentView, \
+    NoteSearchView, ChangesView, NoteAttachmentUploadView
 
 
 class TestUsers(TestCase):
@@ -31,6 +32,12 @@ class TestUsers(TestCase):
         self.assertEqual(resolve(url).func.__name__,
                          UserProfileView.as_view({'get': 'retrieve'}).__name__)
 
+    def test_user_photo(self):
+        """test for user photo url"""
+        url = reverse('core:user-photo')
+        self.assertEqual(resolve(url).func.__name__,
+                         UserProfileView.as_view({'get': 'photo'}).__name__)
+
 
 class TestNoteBook(TestCase):
     """Test for the notebook urls"""
@@ -47,6 +54,12 @@ class TestNoteBook(TestCase):
         self.assertEqual(resolve(url).func.__name__,
                          NoteBookView.as_view({'get': 'retrieve'}).__name__)
 
+    def test_notebook_tree(self):
+        """test for users notebook tree url"""
+        url = reverse('core:tree')
+        self.assertEqual(resolve(url).func.__name__,
+                         NoteBookView.as_view({'get': 'tree'}).__name__)
+
 
 class TestNote(TestCase):
     """Test for the note urls"""
@@ -63,6 +76,17 @@ class TestNote(TestCase):
         self.assertEqual(resolve(url).func.__name__,
                          NoteView.as_view({'get': 'retrieve'}).__name__)
 
+    def test_note_bulk_delete(self):
+        """test for users note bulk delete url"""
+        url = reverse('core:notes-bulk-delete', kwargs={'notebook_slug': 'slug'})
+        self.assertEqual(resolve(url).func.__name__,
+                         NoteView.as_view({'post': 'bulk_delete'}).__name__)
+
+    def test_note_bulk_move(self):
+        """test for users note bulk move url"""
+        url = reverse('core:notes-bulk-move', kwargs={'notebook_slug': 'slug'})
+        self.assertEqual(resolve(url).func.__name__,
+                         NoteView.as_view({'post': 'bulk_move'}).__name__)
 
 class TestNoteAttachments(TestCase):
     """Test for the users note attachments urls"""
@@ -79,3 +103,56 @@ class TestNoteAttachments(TestCase):
                                                          'note_slug': 'slug', 'slug': 'slug'})
         self.assertEqual(resolve(url).func.__name__,
                          NoteAttachmentView.as_view({'get': 'retrieve'}).__name__)
+
+    def test_attachment_download(self):
+        """test for users attachments download url"""
+        url = reverse('core:attachments-download', kwargs={'notebook_slug': 'slug',
+                                                           'note_slug': 'slug', 'slug': 'slug'})
+        self.assertEqual(resolve(url).func.__name__,
+                         NoteAttachmentView.as_view({'get': 'download'}).__name__)
+
+    def test_attachment_preview(self):
+        """test for users attachments preview url"""
+        url = reverse('core:attachments-preview', kwargs={'notebook_slug': 'slug',
+                                                          'note_slug': 'slug', 'slug': 'slug'})
+        self.assertEqual(resolve(url).func.__name__,
+                         NoteAttachmentView.as_view({'get': 'preview'}).__name__)
+
+
+class TestNoteAttachmentUploads(TestCase):
+    """Test for the note attachment upload urls"""
+
+    def test_uploads_list(self):
+        """test for attachment uploads list url"""
+        url = reverse('core:uploads-list', kwargs={'notebook_slug': 'slug', 'note_slug': 'slug'})
+        self.assertEqual(resolve(url).func.__name__,
+                         NoteAttachmentUploadView.as_view({'post': 'create'}).__name__)
+
+    def test_upload_detail(self):
+        """test for attachment upload details and finish urls"""
+        url = reverse('core:uploads-detail', kwargs={'notebook_slug': 'slug', 'note_slug': 'slug', 'pk': 'id'})
+        self.assertEqual(resolve(url).func.__name__,
+                         NoteAttachmentUploadView.as_view({'patch': 'partial_update'}).__name__)
+        url = reverse('core:uploads-finish', kwargs={'notebook_slug': 'slug', 'note_slug': 'slug', 'pk': 'id'})
+        self.assertEqual(resolve(url).func.__name__,
+                         NoteAttachmentUploadView.as_view({'post': 'finish'}).__name__)
+
+
+class TestNoteSearch(TestCase):
+    """Test for the note search urls"""
+
+    def test_search(self):
+        """test for users note search url"""
+        url = reverse('core:search')
+        self.assertEqual(resolve(url).func.__name__,
+                         NoteSearchView.as_view({'get': 'list'}).__name__)
+
+
+class TestChanges(TestCase):
+    """Test for the change feed urls"""
+
+    def test_changes(self):
+        """test for users change feed url"""
+        url = reverse('core:changes')
+        self.assertEqual(resolve(url).func.__name__,
+                         ChangesView.as_view({'get': 'list'}).__name__)
@@ -1,13 +1,47 @@
 #  Copyright (c) Code Written and Tested by Ahmed Emad in 14/03/2020, 22:30.
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import os
 import random
 import string
-
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock
+
+from PIL import Image
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+
+from core.asgi import ASGIHandler
+from core.models import UserProfileModel, NoteBookModel, NoteModel, NoteAttachmentModel, ChangeModel, \
+    NoteAttachmentUploadModel, AuthTokenModel, preview_name
+from core.sessions import SessionStore, _write_session
+from core.tasks import BoundedExecutor
+from core.thumbnails import generate_profile_photo_thumbnails, thumbnail_name
+from core.tokens import issue_tokens
+from core.uploadhandlers import lock_part
+from core.views import NoteBookView
+
 
-from core.models import UserProfileModel, NoteBookModel, NoteModel, NoteAttachmentModel
+def streamed_json(response):
+    """returns the JSON body of a streaming response"""
+    return json.loads(b''.join(response.streaming_content))
 
 
 class TestUsers(TestCase):
@@ -182,6 +216,434 @@ class TestUsers(TestCase):
         self.assertEqual(User.objects.filter(username='username').exists(), False)
 
 
+class InlineExecutor:
+    """runs the background tasks at once in the tests"""
+
+    def submit(self, func, *args):
+        func(*args)
+
+
+def photo_upload(size=(300, 200)):
+    """returns a JPEG photo"""
+
+    buffer = io.BytesIO()
+    Image.new('RGB', size, 'red').save(buffer, 'JPEG')
+    return SimpleUploadedFile(name='photo.jpg', content=buffer.getvalue(), content_type='image/jpeg')
+
+
+@mock.patch('core.tasks._executor', InlineExecutor())
+class TestProfilePhoto(TransactionTestCase):
+    """Unit Test for the profile photo thumbnails,
+    they're generated after commit so it needs real transactions"""
+
+    def setUp(self):
+        """set up for unittest"""
+        self.account = User.objects.create_user(username='username', password='password')
+        self.profile = UserProfileModel.objects.create(account=self.account)
+
+    def tearDown(self):
+        """deletes generated test files"""
+        profile = UserProfileModel.objects.get(pk=self.profile.pk)
+        storage = profile.profile_photo.storage
+        for name in self.photos:
+            storage.delete(name)
+            for size in settings.PROFILE_PHOTO_THUMBNAIL_SIZES:
+                storage.delete(thumbnail_name(name, size))
+
+    def test_thumbnails(self):
+        """test for generating the thumbnails of a new profile photo"""
+
+        url = reverse('core:user-details')
+        self.client.force_login(self.account)
+        self.photos = []
+
+        response = self.client.get(url)
+        self.assertIsNone(response.data['profile_photo_thumbnails'])
+
+        for _ in range(2):
+            response = self.client.patch(url, encode_multipart(BOUNDARY, {'profile_photo': photo_upload()}),
+                                         content_type=MULTIPART_CONTENT)
+            self.assertEqual(response.status_code, 200)
+            profile = UserProfileModel.objects.get(pk=self.profile.pk)
+            self.photos.append(profile.profile_photo.name)
+            self.assertEqual(profile.thumbnails_of, profile.profile_photo.name)
+
+        # a thumbnail of every size
+        response = self.client.get(url)
+        thumbnails = response.data['profile_photo_thumbnails']
+        self.assertEqual(set(thumbnails), {str(size) for size in settings.PROFILE_PHOTO_THUMBNAIL_SIZES})
+        for size in settings.PROFILE_PHOTO_THUMBNAIL_SIZES:
+            # the thumbnails are downloaded by the user, they aren't served at MEDIA_URL
+            self.assertEqual(thumbnails[str(size)], reverse('core:user-photo') + '?size=%s' % size)
+            response = self.client.get(thumbnails[str(size)])
+            self.assertEqual(response.status_code, 200)
+            with Image.open(io.BytesIO(b''.join(response.streaming_content))) as image:
+                self.assertEqual(image.format, 'WEBP')
+                self.assertEqual(image.size, (size, size))
+
+        # the thumbnails of an old photo don't replace the new ones
+        generate_profile_photo_thumbnails(self.profile.pk, self.photos[0])
+        self.assertEqual(UserProfileModel.objects.get(pk=self.profile.pk).thumbnails_of, self.photos[1])
+
+        # the photo itself is used until the thumbnails are generated
+        UserProfileModel.objects.filter(pk=self.profile.pk).update(thumbnails_of='')
+        response = self.client.get(url)
+        self.assertEqual(set(response.data['profile_photo_thumbnails'].values()), {response.data['profile_photo']})
+        self.assertEqual(response.data['profile_photo'], reverse('core:user-photo'))
+        response = self.client.get(reverse('core:user-photo'), {'size': 40})
+        with open(profile.profile_photo.path, 'rb') as photo:
+            self.assertEqual(b''.join(response.streaming_content), photo.read())
+
+        # only the user downloads its photo
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('core:user-photo')).status_code, 403)
+
+
+@mock.patch('core.tasks._executor', InlineExecutor())
+class TestSessions(TransactionTestCase):
+    """Unit Test for the session engines, the cached sessions
+    are written after commit so it needs real transactions"""
+
+    def setUp(self):
+        """set up for unittest"""
+        cache.clear()
+        self.account = User.objects.create_user(username='username', password='password')
+        UserProfileModel.objects.create(account=self.account)
+
+    def login(self):
+        """logs the user in and returns its session key"""
+        response = self.client.post(reverse('core:login'), {'username': 'username', 'password': 'password'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return self.client.cookies[settings.SESSION_COOKIE_NAME].value
+
+    @override_settings(SESSION_ENGINE='core.sessions')
+    def test_cached_sessions(self):
+        """test for the sessions in the cache with the database behind it"""
+
+        session_key = self.login()
+        cache_key = SessionStore.cache_key_prefix + session_key
+        self.assertIsNotNone(cache.get(cache_key))
+        self.assertTrue(Session.objects.filter(session_key=session_key).exists())
+
+        # the requests read the session from the cache
+        url = reverse('core:user-details')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertFalse([query for query in queries if 'django_session' in query['sql']])
+
+        # and from the database when the cache lost it
+        cache.clear()
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertIsNotNone(cache.get(cache_key))
+
+        # a logout deletes it from both, a late write doesn't bring it back
+        self.assertEqual(self.client.post(reverse('core:logout')).status_code, 200)
+        self.assertIsNone(cache.get(cache_key))
+        _write_session(session_key)
+        self.assertFalse(Session.objects.filter(session_key=session_key).exists())
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session_key
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+    def test_signed_cookie_sessions(self):
+        """test for the sessions in signed cookies"""
+
+        self.login()
+        self.assertEqual(self.client.get(reverse('core:user-details')).status_code, 200)
+        self.assertFalse(Session.objects.exists())
+
+    def test_sweep_sessions(self):
+        """test for deleting the expired sessions of the database"""
+
+        now = timezone.now()
+        for number in range(3):
+            Session.objects.create(session_key='expired{0}'.format(number), session_data='',
+                                   expire_date=now - timedelta(days=1))
+        Session.objects.create(session_key='valid', session_data='', expire_date=now + timedelta(days=1))
+        for number in range(3):
+            AuthTokenModel.objects.create(id='expired{0}'.format(number), account=self.account,
+                                          expires_at=now - timedelta(days=1))
+        AuthTokenModel.objects.create(id='valid', account=self.account, expires_at=now + timedelta(days=1))
+        call_command('sweep_sessions', '--batch-size', '2', stdout=io.StringIO())
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), ['valid'])
+        self.assertEqual(list(AuthTokenModel.objects.values_list('id', flat=True)), ['valid'])
+
+
+class TestTokens(TestCase):
+    """Unit Test for the token authentication of the API clients"""
+
+    def setUp(self):
+        """set up for unittest"""
+        cache.clear()
+        self.account = User.objects.create_user(username='username', password='password')
+        self.profile = UserProfileModel.objects.create(account=self.account)
+
+    def login(self, password='password'):
+        """logs in with tokens and returns them"""
+        response = self.client.post(reverse('core:token-login'), {'username': 'username', 'password': password},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def bearer(self, tokens):
+        """returns the Authorization header of the access token"""
+        return {'HTTP_AUTHORIZATION': 'Bearer ' + tokens['access']}
+
+    def test_access_token(self):
+        """test for authenticating with access tokens"""
+
+        response = self.client.post(reverse('core:token-login'), {'username': 'username', 'password': 'wrong'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        tokens = self.login()
+        self.assertEqual(tokens['expires_in'], settings.ACCESS_TOKEN_LIFETIME)
+
+        # the views work with the token, without the session and its CSRF
+        url = reverse('core:notebooks-list')
+        response = self.client.post(url, {'title': 'work'}, content_type='application/json', **self.bearer(tokens))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(NoteBookModel.objects.get().user, self.profile)
+        response = self.client.get(url, **self.bearer(tokens))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(streamed_json(response)['count'], 1)
+        response = self.client.get(reverse('core:user-details'), **self.bearer(tokens))
+        self.assertEqual(response.data['username'], 'username')
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+
+        # a bad token is told to refresh, no token is forbidden like without a session
+        response = self.client.get(url, HTTP_AUTHORIZATION='Bearer ' + tokens['access'][:-1])
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('invalid_token', response['WWW-Authenticate'])
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        # an expired token
+        with self.settings(ACCESS_TOKEN_LIFETIME=-1):
+            self.assertEqual(self.client.get(url, **self.bearer(tokens)).status_code, 401)
+
+    def test_refresh_token(self):
+        """test for refreshing and revoking the tokens"""
+
+        url = reverse('core:notebooks-list')
+        refresh_url = reverse('core:token-refresh')
+        tokens = self.login()
+        response = self.client.post(refresh_url, {'refresh': tokens['refresh']}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        new_tokens = response.data
+        self.assertEqual(self.client.get(url, **self.bearer(new_tokens)).status_code, 200)
+
+        # using a refresh token again revokes all of its tokens
+        response = self.client.post(refresh_url, {'refresh': tokens['refresh']}, content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.client.get(url, **self.bearer(new_tokens)).status_code, 401)
+        response = self.client.post(refresh_url, {'refresh': new_tokens['refresh']}, content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+        # logging out
+        tokens = self.login()
+        other_tokens = self.login()
+        logout_url = reverse('core:token-logout')
+        response = self.client.post(logout_url, {'refresh': tokens['refresh']}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(url, **self.bearer(tokens)).status_code, 401)
+        response = self.client.post(logout_url, {'refresh': tokens['refresh']}, content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+        # changing the password revokes the tokens of the other clients
+        self.assertEqual(self.client.get(url, **self.bearer(other_tokens)).status_code, 200)
+        tokens = self.login()
+        response = self.client.patch(reverse('core:user-details'), {'password': 'a new password'},
+                                     content_type='application/json', **self.bearer(tokens))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(url, **self.bearer(tokens)).status_code, 200)
+        self.assertEqual(self.client.get(url, **self.bearer(other_tokens)).status_code, 401)
+
+        # deleting the user revokes its tokens
+        self.assertEqual(self.client.delete(reverse('core:user-details'), **self.bearer(tokens)).status_code, 204)
+        self.assertEqual(self.client.get(url, **self.bearer(tokens)).status_code, 401)
+        self.assertFalse(AuthTokenModel.objects.exists())
+
+
+class TestPasswordHashing(TestCase):
+    """Unit Test for hashing the passwords in the bounded pool"""
+
+    def setUp(self):
+        """set up for unittest"""
+        self.account = User.objects.create_user(username='username', password='password')
+        UserProfileModel.objects.create(account=self.account)
+        self.url = reverse('core:login')
+
+    def test_back_pressure(self):
+        """test for rejecting the logins when the pool is full"""
+
+        pool = BoundedExecutor(1, 0, thread_name_prefix='test-hashing')
+        started, release = threading.Event(), threading.Event()
+        blocker = threading.Thread(target=pool.run, args=(lambda: started.set() or release.wait(),))
+        blocker.start()
+        started.wait()
+        try:
+            with mock.patch('core.passwords._pool', pool), self.assertLogs('core.passwords', 'WARNING'):
+                response = self.client.post(self.url, {'username': 'username', 'password': 'password'},
+                                            content_type='application/json')
+        finally:
+            release.set()
+            blocker.join()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        stats = pool.stats()
+        self.assertEqual((stats['running'], stats['waiting'], stats['completed'], stats['rejected']), (0, 0, 1, 1))
+
+        with mock.patch('core.passwords._pool', pool):
+            response = self.client.post(self.url, {'username': 'username', 'password': 'password'},
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_wait_timeout(self):
+        """test for rejecting the logins that wait for too long"""
+
+        pool = BoundedExecutor(1, 1, thread_name_prefix='test-hashing', timeout=0.05)
+        started, release = threading.Event(), threading.Event()
+        blocker = threading.Thread(target=pool.run, args=(lambda: started.set() or release.wait(),))
+        blocker.start()
+        started.wait()
+        try:
+            with mock.patch('core.passwords._pool', pool), self.assertLogs('core.passwords', 'WARNING'):
+                response = self.client.post(self.url, {'username': 'username', 'password': 'password'},
+                                            content_type='application/json')
+        finally:
+            release.set()
+            blocker.join()
+        self.assertEqual(response.status_code, 503)
+        stats = pool.stats()
+        self.assertEqual((stats['running'], stats['waiting'], stats['completed'], stats['rejected']), (0, 0, 1, 1))
+
+    def test_model_backend_sessions(self):
+        """test for keeping the sessions of the model backend of django"""
+
+        self.client.force_login(self.account, backend='django.contrib.auth.backends.ModelBackend')
+        self.assertEqual(self.client.get(reverse('core:user-details')).status_code, 200)
+        self.client.logout()
+
+        # the wrong passwords are hashed once, in the pool
+        with mock.patch('django.contrib.auth.backends.ModelBackend.authenticate') as model_authenticate:
+            for username in ('username', 'missing'):
+                response = self.client.post(self.url, {'username': username, 'password': 'wrong'},
+                                            content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+        model_authenticate.assert_not_called()
+
+    def test_hash_upgrade(self):
+        """test for upgrading the hash of an old hasher at login"""
+
+        self.account.password = make_password('password', hasher='pbkdf2_sha1')
+        self.account.save()
+        response = self.client.post(self.url, {'username': 'username', 'password': 'password'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.account.refresh_from_db()
+        self.assertTrue(self.account.password.startswith('pbkdf2_sha256$'))
+        self.assertTrue(self.account.check_password('password'))
+
+    def test_status(self):
+        """test for the status of the pool"""
+
+        url = reverse('core:password-hashing-status')
+        self.client.force_login(self.account)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        User.objects.filter(pk=self.account.pk).update(is_staff=True)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['max_workers'], settings.PASSWORD_HASHING_WORKERS)
+
+
+class TestASGI(TransactionTestCase):
+    """Unit Test for the ASGI handler, the requests run in
+    other threads so it needs real transactions"""
+
+    def setUp(self):
+        """set up for unittest"""
+        patcher = mock.patch('core.signals.run_in_background')  # no previews
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        account = User.objects.create_user(username='username', password='password')
+        UserProfileModel.objects.create(account=account)
+        notebook = NoteBookModel.objects.create(user=account.profile, title='title')
+        NoteModel.objects.bulk_create([NoteModel(notebook=notebook, title='note', slug='note-%s' % number)
+                                       for number in range(150)])
+        self.content = os.urandom(200 * 1000)
+        self.attachment = NoteAttachmentModel.objects.create(
+            note=notebook.notes.get(slug='note-0'), file=SimpleUploadedFile('data.bin', self.content))
+        self.token = issue_tokens(account)['access']
+        self.handler = ASGIHandler()
+        self.addCleanup(self.handler.close)  # the threads keep their connections
+
+    def tearDown(self):
+        """deletes the attachment file"""
+        self.attachment.file.storage.delete(self.attachment.file.name)
+
+    async def request(self, url, read=None):
+        """returns the status and the body of a GET request through the ASGI handler,
+        read is awaited before every part of the body is received, like a slow client"""
+        path, _, query = url.partition('?')
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'root_path': '', 'query_string': query.encode(),
+                 'headers': [(b'authorization', ('Bearer ' + self.token).encode())],
+                 'client': ('127.0.0.1', 0), 'server': ('testserver', 80)}
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            if read is not None and message['type'] == 'http.response.body':
+                await read()
+            messages.append(message)
+
+        await self.handler(scope, receive, send)
+        return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+    def get(self, url):
+        """returns the status and the body of a GET request through the ASGI handler"""
+        return asyncio.run(self.request(url))
+
+    def test_streaming_responses(self):
+        """test for streaming the lists from a cursor and the downloads"""
+
+        status, body = self.get(reverse('core:notes-list', kwargs={'notebook_slug': 'title'}) + '?limit=100')
+        self.assertEqual(status, 200)
+        body = json.loads(body)
+        self.assertEqual(body['count'], 150)
+        self.assertEqual(len(body['notes']), 100)
+
+        status, body = self.get(reverse('core:attachments-download', kwargs={
+            'notebook_slug': 'title', 'note_slug': 'note-0', 'slug': self.attachment.slug}))
+        self.assertEqual(status, 200)
+        self.assertEqual(body, self.content)
+
+    @override_settings(ASGI_REQUEST_THREADS=1)
+    def test_slow_clients(self):
+        """test that the clients reading their responses slowly hold no thread of the handler"""
+
+        urls = [reverse('core:notes-list', kwargs={'notebook_slug': 'title'}) + '?limit=100',
+                reverse('core:attachments-download', kwargs={'notebook_slug': 'title', 'note_slug': 'note-0',
+                                                             'slug': self.attachment.slug})]
+
+        async def main():
+            reading = asyncio.Event()
+            slow = [asyncio.ensure_future(self.request(url, reading.wait)) for url in urls]
+            # the only thread of the handler serves other requests while the slow clients wait
+            for url in urls:
+                status, _ = await asyncio.wait_for(self.request(url), 10)
+                self.assertEqual(status, 200)
+            self.assertFalse(any(request.done() for request in slow))
+            reading.set()
+            return await asyncio.gather(*slow)
+
+        (status, body), (download_status, download) = asyncio.run(main())
+        self.assertEqual((status, download_status), (200, 200))
+        self.assertEqual(len(json.loads(body)['notes']), 100)
+        self.assertEqual(download, self.content)
+
+
 class TestNoteBook(TestCase):
     """Unit Test for notebook views"""
 
@@ -202,6 +664,81 @@ class TestNoteBook(TestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
 
+    def test_list_notes_preview(self):
+        """Test for notebook list view showing the count and first notes"""
+
+        account = User.objects.create_user(username='username', password='password')
+        user_profile = UserProfileModel.objects.create(account=account)
+        notebook = NoteBookModel.objects.create(user=user_profile, title='notebook')
+        NoteBookModel.objects.create(user=user_profile, title='empty')
+        for i in range(12):
+            NoteModel.objects.create(notebook=notebook, title='note %s' % i)
+
+        self.client.force_login(account)
+        response = self.client.get(reverse('core:notebooks-list'))
+        notebook, empty = streamed_json(response)['notebooks']
+        self.assertEqual(notebook['notes_count'], 12)
+        self.assertEqual([note['slug'] for note in notebook['notes']], ['note-%s' % i for i in range(10)])
+        self.assertEqual(empty['notes_count'], 0)
+        self.assertEqual(empty['notes'], [])
+
+    def test_list_cursor(self):
+        """Test for notebook list view with cursor pagination"""
+
+        account = User.objects.create_user(username='username', password='password')
+        user_profile = UserProfileModel.objects.create(account=account)
+        for i in range(3):
+            NoteBookModel.objects.create(user=user_profile, title='notebook %s' % i)
+
+        url = reverse('core:notebooks-list')
+        self.client.force_login(account)
+        response = self.client.get(url, {'cursor': '', 'limit': 2})
+        self.assertEqual(response.status_code, 200)
+        data = streamed_json(response)
+        self.assertEqual([notebook['slug'] for notebook in data['notebooks']],
+                         ['notebook-0', 'notebook-1'])
+        self.assertIsNone(data['previous'])
+
+        data = streamed_json(self.client.get(data['next']))
+        self.assertEqual([notebook['slug'] for notebook in data['notebooks']],
+                         ['notebook-2'])
+        self.assertIsNone(data['next'])
+
+    def test_list_streaming(self):
+        """Test for notebook list view streamed in chunks and compressed"""
+
+        account = User.objects.create_user(username='username', password='password')
+        user_profile = UserProfileModel.objects.create(account=account)
+        for i in range(5):
+            notebook = NoteBookModel.objects.create(user=user_profile, title='notebook %s' % i)
+            NoteModel.objects.create(notebook=notebook, title='note %s' % i)
+
+        url = reverse('core:notebooks-list')
+        self.client.force_login(account)
+        with mock.patch.object(NoteBookView, 'chunk_size', 2):
+            response = self.client.get(url, {'limit': 4, 'offset': 1})
+            data = streamed_json(response)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual((data['limit'], data['offset'], data['count']), (4, 1, 5))
+        self.assertEqual([(notebook['slug'], notebook['notes_count'], notebook['notes'][0]['slug'])
+                          for notebook in data['notebooks']],
+                         [('notebook-%s' % i, 1, 'note-%s' % i) for i in range(1, 5)])
+
+        # empty pages
+        response = self.client.get(url, {'offset': 10})
+        self.assertEqual(streamed_json(response)['notebooks'], [])
+
+        # gzipped for the clients that accept it
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(b''.join(response.streaming_content))),
+                         streamed_json(self.client.get(url)))
+
+        # the browsable API isn't streamed
+        response = self.client.get(url, HTTP_ACCEPT='text/html')
+        self.assertFalse(response.streaming)
+        self.assertEqual(len(response.data['notebooks']), 5)
+
     def test_create(self):
         """test for notebook create view"""
 
@@ -279,6 +816,90 @@ class TestNoteBook(TestCase):
         self.assertEqual(response.status_code, 404)
 
 
+@override_settings(SEARCH_INDEX_PATH=None)
+class TestNoteBookTree(TransactionTestCase):
+    """Unit Test for the notebook tree view"""
+
+    def setUp(self):
+        """setup for unittest"""
+        cache.clear()
+        self.account = User.objects.create_user(username='username', password='password')
+        self.user = UserProfileModel.objects.create(account=self.account)
+        self.notebook = NoteBookModel.objects.create(user=self.user, title='work')
+        NoteModel.objects.create(notebook=self.notebook, title='meeting')
+        NoteBookModel.objects.create(user=self.user, title='home')
+
+    def assertTreeChanged(self, etag, changed=True):
+        """asserts that the tree changed or not since the given etag and returns its new etag"""
+        response = self.client.get(reverse('core:tree'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200 if changed else 304)
+        return response['ETag']
+
+    def test_tree(self):
+        """Test for notebook tree view"""
+
+        url = reverse('core:tree')
+
+        # not logged
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 403)
+
+        # right
+        self.client.force_login(self.account)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['notebooks'], [
+            {'slug': 'work', 'title': 'work', 'notes': [{'slug': 'meeting', 'title': 'meeting'}]},
+            {'slug': 'home', 'title': 'home', 'notes': []}])
+        etag = response['ETag']
+
+        # not modified, without querying the notebooks or the notes
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertFalse([query for query in context.captured_queries
+                          if 'core_notebookmodel' in query['sql'] or 'core_notemodel' in query['sql']])
+        # the ETag weakened by the compression middleware
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='W/' + etag)
+        self.assertEqual(response.status_code, 304)
+
+        # changing the text of a note keeps the tree
+        note = NoteModel.objects.get(slug='meeting')
+        note.text = 'text'
+        note.save()
+        self.assertTreeChanged(etag, changed=False)
+
+        # changing titles, creating and deleting notes and notebooks changes it
+        note.title = 'weekly meeting'
+        note.save()
+        etag = self.assertTreeChanged(etag)
+        note = NoteModel.objects.create(notebook=self.notebook, title='todo')
+        etag = self.assertTreeChanged(etag)
+        NoteModel.objects.filter(pk=note.pk).delete()
+        etag = self.assertTreeChanged(etag)
+        NoteBookModel.objects.create(user=self.user, title='ideas')
+        etag = self.assertTreeChanged(etag)
+        self.notebook.delete()
+        etag = self.assertTreeChanged(etag)
+
+        # so do the bulk views
+        response = self.client.post(reverse('core:notes-list', kwargs={'notebook_slug': 'home'}),
+                                    [{'title': 'todo'}], content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        etag = self.assertTreeChanged(etag)
+        response = self.client.post(reverse('core:notes-bulk-move', kwargs={'notebook_slug': 'home'}),
+                                    {'slugs': ['todo'], 'notebook': 'ideas'}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        etag = self.assertTreeChanged(etag)
+
+        # other users' changes don't
+        other = UserProfileModel.objects.create(account=User.objects.create_user(username='other',
+                                                                                   password='password'))
+        NoteBookModel.objects.create(user=other, title='work')
+        self.assertTreeChanged(etag, changed=False)
+
+
 class TestNote(TestCase):
     """Unit Test for note views"""
 
@@ -314,6 +935,28 @@ class TestNote(TestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, 404)
 
+    def test_list_cursor(self):
+        """Test for note list view with cursor pagination"""
+
+        for i in range(5):
+            NoteModel.objects.create(notebook=self.notebook, title='note %s' % i)
+        url = reverse('core:notes-list', kwargs={'notebook_slug': 'title'})
+        self.client.force_login(self.account)
+
+        slugs = []
+        next_url = url + '?cursor=&limit=2'
+        while next_url:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(next_url)
+                data = streamed_json(response)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('count', data)
+            for query in queries:
+                self.assertNotIn('COUNT(', query['sql'])
+            slugs.extend(note['slug'] for note in data['notes'])
+            next_url = data['next']
+        self.assertEqual(slugs, ['note-0', 'note-1', 'note-2', 'note-3', 'note-4'])
+
     def test_get(self):
         """Test for note get view"""
 
@@ -366,6 +1009,54 @@ class TestNote(TestCase):
                                     content_type='application/json')
         self.assertEqual(response.status_code, 404)
 
+    def test_create_many(self):
+        """Test for note bulk create view"""
+
+        NoteModel.objects.create(notebook=self.notebook, title='title')
+        url = reverse('core:notes-list', kwargs={'notebook_slug': 'title'})
+
+        # not logged
+        response = self.client.post(url, [{'title': 'title'}],
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+        # right
+        self.client.force_login(self.account)
+        response = self.client.post(url, [{'title': 'title'}, {'title': 'other', 'text': 'text'},
+                                          {'title': 'title'}],
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([note['slug'] for note in response.data], ['title-2', 'other', 'title-3'])
+        self.assertEqual(NoteModel.objects.get(slug='other').text, 'text')
+
+        # single inserts continue the slug sequence
+        response = self.client.post(url, {'title': 'title'},
+                                    content_type='application/json')
+        self.assertEqual(response.data['slug'], 'title-4')
+
+        # queries don't grow with the number of notes
+        with CaptureQueriesContext(connection) as few_queries:
+            self.client.post(url, [{'title': 'note %s' % i} for i in range(5)],
+                             content_type='application/json')
+        with CaptureQueriesContext(connection) as many_queries:
+            self.client.post(url, [{'title': 'note %s' % i} for i in range(50)],
+                             content_type='application/json')
+        self.assertEqual(len(few_queries), len(many_queries))
+        self.assertEqual(NoteModel.objects.count(), 60)
+
+        # wrong data creates nothing
+        response = self.client.post(url, [{'title': 'valid'}, {}],
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data[0], {})
+        self.assertIn('title', response.data[1])
+        self.assertFalse(NoteModel.objects.filter(title='valid').exists())
+
+        # too many notes
+        response = self.client.post(url, [{'title': 'title'}] * 1001,
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
     def test_update(self):
         """Test for note update view"""
 
@@ -412,6 +1103,121 @@ class TestNote(TestCase):
                                    content_type='application/json')
         self.assertEqual(response.status_code, 404)
 
+    def test_partial_update_text_only(self):
+        """Test for note text-only patch doing no slug lookups"""
+
+        NoteModel.objects.create(notebook=self.notebook, title='title')
+        url = reverse('core:notes-detail', kwargs={'notebook_slug': 'title', 'slug': 'title'})
+        self.client.force_login(self.account)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(url, {'text': 'autosaved text'},
+                                         content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(NoteModel.objects.get().text, 'autosaved text')
+        for query in queries:
+            self.assertNotIn('slugsequence', query['sql'].lower())
+            self.assertNotIn('"core_notemodel"."slug" LIKE', query['sql'])
+
+        # changing the title gives a new slug
+        response = self.client.patch(url, {'title': 'new title'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['slug'], 'new-title')
+
+    def test_conditional_requests(self):
+        """Test for note views with ETags and conditional headers"""
+
+        note = NoteModel.objects.create(notebook=self.notebook, title='title', text='text')
+        url = reverse('core:notes-detail', kwargs={'notebook_slug': 'title', 'slug': 'title'})
+        self.client.force_login(self.account)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(etag, note.etag)
+        self.assertIn('Last-Modified', response)
+
+        # not modified, in one query less as the attachments aren't loaded
+        with CaptureQueriesContext(connection) as full:
+            self.client.get(url)
+        with CaptureQueriesContext(connection) as conditional:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(len(conditional), len(full) - 1)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        # an update with the current ETag passes and changes it
+        response = self.client.patch(url, {'text': 'edited'}, content_type='application/json',
+                                     HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        new_etag = response['ETag']
+
+        # a stale ETag is rejected and nothing changes
+        response = self.client.put(url, {'title': 'title', 'text': 'stale'}, content_type='application/json',
+                                   HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(NoteModel.objects.get().text, 'edited')
+        response = self.client.delete(url, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 412)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        # adding an attachment changes the note
+        response = self.client.post(reverse('core:attachments-list', kwargs={'notebook_slug': 'title',
+                                                                             'note_slug': 'title'}),
+                                    {'file': SimpleUploadedFile('file.txt', b'content')})
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=new_etag)
+        self.assertEqual(response.status_code, 200)
+        os.remove(NoteAttachmentModel.objects.get().file.path)
+
+        # requests without conditions are not checked
+        response = self.client.patch(url, {'text': 'forced'}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        # the ETags weakened by the compression middleware never match If-Match
+        etag = response['ETag']
+        response = self.client.delete(url, HTTP_IF_MATCH='W/' + etag)
+        self.assertEqual(response.status_code, 412)
+        self.assertTrue(NoteModel.objects.filter(slug='title').exists())
+        response = self.client.delete(url, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 204)
+
+    def test_text_edits(self):
+        """Test for note partial update view with text edits"""
+
+        NoteModel.objects.create(notebook=self.notebook, title='title', text='the weekly meeting')
+        url = reverse('core:notes-detail', kwargs={'notebook_slug': 'title', 'slug': 'title'})
+        self.client.force_login(self.account)
+        etag = self.client.get(url)['ETag']
+        edits = {'text_edits': [{'position': 4, 'delete': 6, 'insert': 'daily'}]}
+
+        # the edited version is required
+        response = self.client.patch(url, edits, content_type='application/json')
+        self.assertEqual(response.status_code, 428)
+
+        # right, the text isn't sent back
+        response = self.client.patch(url, edits, content_type='application/json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'slug': 'title', 'title': 'title'})
+        self.assertEqual(NoteModel.objects.get().text, 'the daily meeting')
+        self.assertNotEqual(response['ETag'], etag)
+
+        # edits of an old version are rejected
+        response = self.client.patch(url, edits, content_type='application/json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 412)
+
+        # edits outside the text
+        etag = self.client.get(url)['ETag']
+        response = self.client.patch(url, {'text_edits': [{'position': 100, 'insert': 'a'}]},
+                                     content_type='application/json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(NoteModel.objects.get().text, 'the daily meeting')
+
     def test_delete(self):
         """Test for note delete view"""
 
@@ -438,6 +1244,306 @@ class TestNote(TestCase):
         self.assertEqual(response.status_code, 404)
 
 
+@override_settings(SEARCH_INDEX_PATH=None)
+@mock.patch('core.tasks._executor', InlineExecutor())
+class TestNoteBulk(TransactionTestCase):
+    """Unit Test for note bulk views,
+    they run in real transactions like the requests"""
+
+    def setUp(self):
+        """setup for unittest"""
+        self.account = User.objects.create_user(username='username', password='password')
+        user_profile = UserProfileModel.objects.create(account=self.account)
+        self.notebook = NoteBookModel.objects.create(user=user_profile, title='title')
+        self.target = NoteBookModel.objects.create(user=user_profile, title='target')
+        for title in ('note', 'note', 'other'):
+            NoteModel.objects.create(notebook=self.notebook, title=title)
+
+    def test_bulk_delete(self):
+        """Test for note bulk delete view"""
+
+        url = reverse('core:notes-bulk-delete', kwargs={'notebook_slug': 'title'})
+
+        # not logged
+        response = self.client.post(url, {'slugs': ['note']},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+        # wrong data
+        self.client.force_login(self.account)
+        response = self.client.post(url, {'slugs': []},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        # a wrong note slug deletes nothing
+        response = self.client.post(url, {'slugs': ['note', 'wrong']},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data['not_found'], ['wrong'])
+        self.assertEqual(NoteModel.objects.count(), 3)
+
+        # attachment files are deleted with the notes
+        note = NoteModel.objects.get(slug='note')
+        with open('media/.test', 'w+'):
+            pass
+        attachment = NoteAttachmentModel.objects.create(note=note, file='.test')
+
+        # right
+        response = self.client.post(url, {'slugs': ['note', 'note-2']},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(list(NoteModel.objects.values_list('slug', flat=True)), ['other'])
+        self.assertFalse(NoteAttachmentModel.objects.exists())
+        call_command('delete_queued_files', stdout=io.StringIO())
+        self.assertFalse(os.path.isfile(attachment.file.path))
+
+        # wrong notebook slug
+        url = reverse('core:notes-bulk-delete', kwargs={'notebook_slug': 'wrong'})
+        response = self.client.post(url, {'slugs': ['other']},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_bulk_move(self):
+        """Test for note bulk move view"""
+
+        NoteModel.objects.create(notebook=self.target, title='note')
+        url = reverse('core:notes-bulk-move', kwargs={'notebook_slug': 'title'})
+
+        # not logged
+        response = self.client.post(url, {'slugs': ['note'], 'notebook': 'target'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+        # wrong data
+        self.client.force_login(self.account)
+        response = self.client.post(url, {'slugs': ['note']},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        # the same notebook
+        response = self.client.post(url, {'slugs': ['note'], 'notebook': 'title'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        # wrong target notebook
+        response = self.client.post(url, {'slugs': ['note'], 'notebook': 'wrong'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+        # wrong note slug
+        response = self.client.post(url, {'slugs': ['note', 'wrong'], 'notebook': 'target'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.target.notes.count(), 1)
+
+        # right, taken slugs get new ones
+        response = self.client.post(url, {'slugs': ['note', 'note-2', 'other'], 'notebook': 'target'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'note': 'note-3', 'note-2': 'note-2', 'other': 'other'})
+        self.assertEqual(self.notebook.notes.count(), 0)
+        self.assertEqual(sorted(self.target.notes.values_list('slug', flat=True)),
+                         ['note', 'note-2', 'note-3', 'other'])
+
+
+@override_settings(SEARCH_INDEX_PATH=None)
+class TestNoteSearch(TransactionTestCase):
+    """Unit Test for note search views"""
+
+    def setUp(self):
+        """setup for unittest"""
+        self.account = User.objects.create_user(username='username', password='password')
+        user_profile = UserProfileModel.objects.create(account=self.account)
+        notebook = NoteBookModel.objects.create(user=user_profile, title='work')
+        NoteModel.objects.create(notebook=notebook, title='weekly meeting', text='talked about the budget')
+        NoteModel.objects.create(notebook=notebook, title='todo', text='prepare the meeting room')
+        NoteModel.objects.create(notebook=notebook, title='groceries', text='milk and eggs')
+
+        other = User.objects.create_user(username='other', password='password')
+        other_notebook = NoteBookModel.objects.create(user=UserProfileModel.objects.create(account=other),
+                                                      title='work')
+        NoteModel.objects.create(notebook=other_notebook, title='meeting', text='not yours')
+
+    def test_search(self):
+        """Test for note search view"""
+
+        url = reverse('core:search')
+
+        # not logged
+        response = self.client.get(url, {'q': 'meeting'})
+        self.assertEqual(response.status_code, 403)
+
+        # no search words
+        self.client.force_login(self.account)
+        response = self.client.get(url, {'q': ' '})
+        self.assertEqual(response.status_code, 400)
+
+        if connection.vendor == 'postgresql':
+            # the words are stemmed
+            response = self.client.get(url, {'q': 'meetings'})
+            self.assertEqual(len(response.data['notes']), 2)
+
+        # right, matches in the title rank higher
+        response = self.client.get(url, {'q': 'meeting'})
+        self.assertEqual(response.status_code, 200)
+        notes = response.data['notes']
+        self.assertEqual([note['slug'] for note in notes], ['weekly-meeting', 'todo'])
+        self.assertEqual(notes[0]['notebook'], 'work')
+        self.assertGreater(notes[0]['rank'], notes[1]['rank'])
+        self.assertIn('<mark>meeting</mark>', notes[1]['snippet'])
+
+        # the snippets are safe HTML
+        note = NoteModel.objects.get(slug='todo')
+        NoteModel.objects.create(notebook=note.notebook, title='script', text='tom & jerry <img src=x onerror=alert(1)> agenda')
+        snippet = self.client.get(url, {'q': 'agenda'}).data['notes'][0]['snippet']
+        self.assertNotIn('<img', snippet)
+        self.assertIn('<mark>agenda</mark>', snippet)
+        if connection.vendor == 'postgresql':
+            self.assertIn('&lt;img src=x onerror=alert(1)&gt;', snippet)
+
+        # the search vector follows the text
+        note = NoteModel.objects.get(slug='groceries')
+        note.text = 'buy snacks for the meeting'
+        note.save()
+        response = self.client.get(url, {'q': 'meeting'})
+        self.assertEqual(len(response.data['notes']), 3)
+
+        # deleted notes aren't found, also when deleted inside a transaction
+        NoteModel.objects.get(slug='todo').delete()
+        response = self.client.get(url, {'q': 'room'})
+        self.assertEqual(response.data['notes'], [])
+        response = self.client.post(reverse('core:notes-bulk-delete', kwargs={'notebook_slug': 'work'}),
+                                    {'slugs': ['weekly-meeting']}, content_type='application/json')
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get(url, {'q': 'budget'})
+        self.assertEqual(response.data['notes'], [])
+        NoteModel.objects.create(notebook=note.notebook, title='weekly meeting', text='talked about the budget')
+
+        # bulk created notes are found
+        response = self.client.post(reverse('core:notes-list', kwargs={'notebook_slug': 'work'}),
+                                    [{'title': 'todo', 'text': 'prepare the meeting room'}],
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get(url, {'q': 'room'})
+        self.assertEqual([note['slug'] for note in response.data['notes']], ['todo-2'])
+
+        # pages
+        response = self.client.get(url, {'q': 'meeting', 'limit': 2})
+        slugs = [note['slug'] for note in response.data['notes']]
+        response = self.client.get(response.data['next'])
+        slugs += [note['slug'] for note in response.data['notes']]
+        self.assertEqual(sorted(slugs), ['groceries', 'todo-2', 'weekly-meeting-2'])
+        self.assertIsNone(response.data['next'])
+
+
+class TestChanges(TestCase):
+    """Unit Test for the change feed view"""
+
+    def setUp(self):
+        """setup for unittest"""
+        self.account = User.objects.create_user(username='username', password='password')
+        self.user = UserProfileModel.objects.create(account=self.account)
+        self.notebook = NoteBookModel.objects.create(user=self.user, title='work')
+        self.note = NoteModel.objects.create(notebook=self.notebook, title='meeting', text='text')
+
+        other = User.objects.create_user(username='other', password='password')
+        other_notebook = NoteBookModel.objects.create(user=UserProfileModel.objects.create(account=other),
+                                                      title='work')
+        NoteModel.objects.create(notebook=other_notebook, title='meeting')
+
+    def get_changes(self, since, **params):
+        """returns the changes since a token and checks the response"""
+        response = self.client.get(reverse('core:changes'), dict(since=since, **params))
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_changes(self):
+        """Test for the change feed view"""
+
+        url = reverse('core:changes')
+
+        # not logged
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 403)
+
+        # not valid tokens
+        self.client.force_login(self.account)
+        self.assertEqual(self.client.get(url, {'since': 'token'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'since': -1}).status_code, 400)
+
+        # all the data of the user
+        data = self.get_changes(0)
+        self.assertEqual(data['changes'], [
+            {'type': 'notebook', 'id': self.notebook.id, 'deleted': False,
+             'data': {'id': self.notebook.id, 'slug': 'work', 'title': 'work'}},
+            {'type': 'note', 'id': self.note.id, 'deleted': False,
+             'data': {'id': self.note.id, 'notebook': self.notebook.id, 'slug': 'meeting', 'title': 'meeting',
+                      'text': 'text'}}])
+        self.assertFalse(data['more'])
+        since = data['since']
+
+        # up to date in one query on the feed
+        with CaptureQueriesContext(connection) as queries:
+            data = self.get_changes(since)
+        self.assertEqual(data, {'changes': [], 'since': since, 'more': False})
+        feed_queries = [query for query in queries.captured_queries if 'core_' in query['sql']
+                        and 'core_userprofilemodel' not in query['sql']]
+        self.assertEqual(len(feed_queries), 1)
+
+        # an edited object moves to the end of the feed only once
+        self.notebook.title = 'job'
+        self.notebook.save()
+        self.note.text = 'edited'
+        self.note.save()
+        self.note.text = 'edited again'
+        self.note.save()
+        data = self.get_changes(since)
+        self.assertEqual([(change['type'], change['data']['title']) for change in data['changes']],
+                         [('notebook', 'job'), ('note', 'meeting')])
+        self.assertEqual(data['changes'][1]['data']['text'], 'edited again')
+        self.assertEqual(ChangeModel.objects.filter(user=self.user).count(), 2)
+        since = data['since']
+
+        # bounded batches
+        NoteModel.objects.bulk_create([NoteModel(notebook=self.notebook, title='bulk', slug='bulk-%s' % i)
+                                       for i in range(3)])
+        response = self.client.post(reverse('core:notes-list', kwargs={'notebook_slug': 'job'}),
+                                    [{'title': 'note %s' % i} for i in range(5)], content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        data = self.get_changes(since, limit=3)
+        self.assertEqual(len(data['changes']), 3)
+        self.assertTrue(data['more'])
+        data = self.get_changes(data['since'], limit=3)
+        self.assertEqual([change['data']['slug'] for change in data['changes']], ['note-3', 'note-4'])
+        self.assertFalse(data['more'])
+        since = data['since']
+
+        # deletions are tombstones, cascades are recorded in constant queries
+        response = self.client.post(reverse('core:notes-bulk-delete', kwargs={'notebook_slug': 'job'}),
+                                    {'slugs': ['note-0', 'note-1']}, content_type='application/json')
+        self.assertEqual(response.status_code, 204)
+        data = self.get_changes(since)
+        self.assertEqual([(change['type'], change['deleted'], change['data']) for change in data['changes']],
+                         [('note', True, None), ('note', True, None)])
+        since = data['since']
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.delete(reverse('core:notebooks-detail', kwargs={'slug': 'job'}))
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(len([query for query in queries.captured_queries
+                              if 'core_changemodel' in query['sql']]), 2)
+        data = self.get_changes(since)
+        self.assertEqual(len(data['changes']), 8)  # the notebook and its 7 notes
+        self.assertTrue(all(change['deleted'] for change in data['changes']))
+        self.assertEqual(data['changes'][-1]['type'], 'notebook')
+
+        # the feed of a deleted user is deleted
+        response = self.client.delete(reverse('core:user-details'))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(ChangeModel.objects.filter(user_id=self.user.id).exists())
+        self.assertEqual(ChangeModel.objects.count(), 2)
+
+
 class TestNoteAttachment(TestCase):
     """Unit Test for note attachment views"""
 
@@ -466,6 +1572,7 @@ class TestNoteAttachment(TestCase):
 
         for attachment in self.note.attachments.all():
             attachment.delete()
+        call_command('delete_queued_files', stdout=io.StringIO())
 
     def test_create(self):
         """test for note attachment create view"""
@@ -480,6 +1587,17 @@ class TestNoteAttachment(TestCase):
         self.client.force_login(self.account)
         response = self.client.post(url, {'file': self.img_upload()})
         self.assertEqual(response.status_code, 201)
+        # the file is downloaded by the user, it isn't served at MEDIA_URL
+        self.assertEqual(response.data['file'], reverse('core:attachments-download', kwargs={
+            'notebook_slug': 'title', 'note_slug': 'title', 'slug': response.data['slug']}))
+
+        # stored by the hash of its content, which is computed while it's uploaded
+        with mock.patch('core.models.hashlib') as models_hashlib:
+            response = self.client.post(url, {'file': self.img_upload()})
+        self.assertEqual(response.status_code, 201)
+        models_hashlib.sha256.assert_not_called()
+        self.assertEqual({attachment.file.name for attachment in self.note.attachments.all()},
+                         {'attachments/%s.jpg' % hashlib.sha256(b'a').hexdigest()})
 
         # wrong data
         response = self.client.post(url, {})  # missing attrs
@@ -533,3 +1651,241 @@ class TestNoteAttachment(TestCase):
         self.assertEqual(response.status_code, 404)
 
         self.delete_test_files()
+
+    def test_download(self):
+        """test for note attachment download view"""
+
+        NoteAttachmentModel.objects.create(note=self.note, file=SimpleUploadedFile('test_img.jpg', b'0123456789'))
+        etag = '"%s"' % hashlib.sha256(b'0123456789').hexdigest()
+
+        url = reverse('core:attachments-download', kwargs={'notebook_slug': 'title', 'note_slug': 'title',
+                                                           'slug': 'test_imgjpg'})
+
+        # not logged
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 403)
+
+        # right, whatever the client accepts and without compression
+        self.client.force_login(self.account)
+        response = self.client.get(url, HTTP_ACCEPT='application/octet-stream', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="test_imgjpg.jpg"')
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+        # conditional requests
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, HTTP_IF_MATCH='"other"')
+        self.assertEqual(response.status_code, 412)
+
+        # ranges
+        for header, content in (('bytes=2-4', b'234'), ('bytes=7-', b'789'), ('bytes=-2', b'89'),
+                                ('bytes=8-100', b'89')):
+            response = self.client.get(url, HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b''.join(response.streaming_content), content)
+            self.assertEqual(response['Content-Length'], str(len(content)))
+        self.assertEqual(response['Content-Range'], 'bytes 8-9/10')
+
+        response = self.client.get(url, HTTP_RANGE='bytes=10-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+
+        # multiple ranges, invalid ranges and ranges of another version get the whole file
+        for headers in ({'HTTP_RANGE': 'bytes=0-1,4-5'}, {'HTTP_RANGE': 'bytes=5-2'},
+                        {'HTTP_RANGE': 'bytes=2-4', 'HTTP_IF_RANGE': '"other"'}):
+            response = self.client.get(url, **headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        response = self.client.get(url, HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+
+        # handed to the front server
+        with self.settings(ATTACHMENT_SENDFILE='X-Accel-Redirect'):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/protected/attachments/%s.jpg' % hashlib.sha256(b'0123456789').hexdigest())
+        self.assertEqual(b''.join(response.streaming_content), b'')
+        with self.settings(ATTACHMENT_SENDFILE='X-Sendfile'):
+            response = self.client.get(url)
+        self.assertEqual(response['X-Sendfile'], self.note.attachments.get().file.path)
+
+        # another user's attachment
+        account = User.objects.create_user(username='other', password='password')
+        UserProfileModel.objects.create(account=account)
+        self.client.force_login(account)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+        self.delete_test_files()
+
+    def test_preview(self):
+        """test for note attachment preview download view"""
+
+        attachment = NoteAttachmentModel.objects.create(note=self.note, file=SimpleUploadedFile('photo.jpg', b'photo'))
+        storage = attachment.file.storage
+        storage.save(preview_name(attachment.file.name), ContentFile(b'preview'))
+        self.addCleanup(storage.delete, preview_name(attachment.file.name))
+        url = reverse('core:attachments-preview', kwargs={'notebook_slug': 'title', 'note_slug': 'title',
+                                                          'slug': 'photojpg'})
+
+        # not logged
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 403)
+
+        # not rendered yet
+        self.client.force_login(self.account)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+        NoteAttachmentModel.objects.filter(pk=attachment.pk).update(has_preview=True)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'preview')
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        self.delete_test_files()
+
+
+class TestNoteAttachmentUpload(TestCase):
+    """Unit Test for note attachment chunked upload views"""
+
+    def setUp(self):
+        """set up for unittest"""
+
+        self.account = User.objects.create_user(username='username', password='password')
+        user = UserProfileModel.objects.create(account=self.account)
+        notebook = NoteBookModel.objects.create(user=user, title='title')
+        self.note = NoteModel.objects.create(notebook=notebook, title='title')
+        self.url = reverse('core:uploads-list', kwargs={'notebook_slug': 'title', 'note_slug': 'title'})
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(ATTACHMENT_UPLOAD_DIR=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def send(self, url, chunk, offset):
+        """sends a chunk of an upload"""
+        return self.client.patch(url, chunk, content_type='application/offset+octet-stream',
+                                 HTTP_UPLOAD_OFFSET=str(offset))
+
+    def test_upload(self):
+        """test for uploading an attachment in chunks"""
+
+        # not logged
+        response = self.client.post(self.url, {'filename': 'file.txt', 'size': 10})
+        self.assertEqual(response.status_code, 403)
+
+        self.client.force_login(self.account)
+        response = self.client.post(self.url, {'filename': '../file.txt', 'size': 10})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['filename'], response.data['offset']), ('file.txt', 0))
+        upload = NoteAttachmentUploadModel.objects.get()
+        url = reverse('core:uploads-detail', kwargs={'notebook_slug': 'title', 'note_slug': 'title',
+                                                     'pk': upload.pk})
+
+        response = self.send(url, b'01234', 0)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Upload-Offset'], '5')
+
+        # not finished yet
+        response = self.client.post(url + 'finish/')
+        self.assertEqual(response.status_code, 409)
+
+        # a chunk at the wrong offset, which is resumed from the upload offset
+        response = self.send(url, b'56789', 3)
+        self.assertEqual(response.status_code, 409)
+        response = self.client.get(url)
+        self.assertEqual(response.data['offset'], 5)
+        self.assertEqual(response['Upload-Offset'], '5')
+
+        # a chunk while another chunk is received
+        with open(upload.path, 'rb') as part:
+            lock_part(part)
+            response = self.send(url, b'56789', 5)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.client.get(url).data['offset'], 5)
+
+        # past the size
+        response = self.send(url, b'56789a', 5)
+        self.assertEqual(response.status_code, 413)
+        response = self.client.patch(url, b'56789', content_type='application/offset+octet-stream')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.send(url, b'56789', 5)
+        self.assertEqual(response.data['offset'], 10)
+        response = self.client.post(url + 'finish/')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['slug'], 'filetxt')
+
+        # the part file is moved to the attachment
+        attachment = self.note.attachments.get()
+        with open(attachment.file.path, 'rb') as file:
+            self.assertEqual(file.read(), b'0123456789')
+        self.assertFalse(os.path.exists(upload.path))
+        self.assertFalse(NoteAttachmentUploadModel.objects.exists())
+        self.assertEqual(NoteModel.objects.get().version, 2)
+        attachment.delete()
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_create(self):
+        """test for starting an upload with wrong data"""
+
+        self.client.force_login(self.account)
+        response = self.client.post(self.url, {'filename': 'file.txt', 'size': 0})
+        self.assertEqual(response.status_code, 400)
+        with override_settings(ATTACHMENT_UPLOAD_MAX_SIZE=100):
+            response = self.client.post(self.url, {'filename': 'file.txt', 'size': 101})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(self.url, {'filename': '/', 'size': 10})
+        self.assertEqual(response.status_code, 400)
+
+        # wrong note slug
+        url = reverse('core:uploads-list', kwargs={'notebook_slug': 'title', 'note_slug': 'wrong'})
+        response = self.client.post(url, {'filename': 'file.txt', 'size': 10})
+        self.assertEqual(response.status_code, 404)
+
+    def test_delete(self):
+        """test for aborting uploads"""
+
+        self.client.force_login(self.account)
+        upload = NoteAttachmentUploadModel.objects.get(pk=self.client.post(
+            self.url, {'filename': 'file.txt', 'size': 10}).data['id'])
+        self.assertTrue(os.path.exists(upload.path))
+
+        # another user's upload and wrong ids
+        other = User.objects.create_user(username='other', password='password')
+        UserProfileModel.objects.create(account=other)
+        url = reverse('core:uploads-detail', kwargs={'notebook_slug': 'title', 'note_slug': 'title',
+                                                     'pk': upload.pk})
+        self.client.force_login(other)
+        self.assertEqual(self.client.delete(url).status_code, 404)
+        self.client.force_login(self.account)
+        wrong = reverse('core:uploads-detail', kwargs={'notebook_slug': 'title', 'note_slug': 'title',
+                                                       'pk': 'wrong'})
+        self.assertEqual(self.client.delete(wrong).status_code, 404)
+
+        response = self.client.delete(url)
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(os.path.exists(upload.path))
+
+        # expired uploads
+        upload = NoteAttachmentUploadModel.objects.get(pk=self.client.post(
+            self.url, {'filename': 'file.txt', 'size': 10}).data['id'])
+        call_command('clear_expired_uploads', stdout=io.StringIO())
+        self.assertTrue(os.path.exists(upload.path))
+        NoteAttachmentUploadModel.objects.update(created_at=timezone.now() - timedelta(days=2))
+        call_command('clear_expired_uploads', stdout=io.StringIO())
+        self.assertFalse(NoteAttachmentUploadModel.objects.exists())
+        self.assertFalse(os.path.exists(upload.path))
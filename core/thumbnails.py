@@ -0,0 +1,147 @@
+import io
+import os
+
+from PIL import Image, ImageOps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+
+from core.authentication import forget_user
+from core.downloads import download_url
+from core.models import UserProfileModel, NoteAttachmentModel, NoteModel, preview_name
+from core.previews import read_attachment
+from core.tasks import run_in_process
+
+
+def thumbnail_name(photo_name, size):
+    """returns the name in the storage of a thumbnail of a profile photo"""
+
+    return 'users/thumbnails/{0}_{1}.webp'.format(os.path.splitext(os.path.basename(photo_name))[0], size)
+
+
+def make_thumbnails(file, sizes):
+    """Makes square WebP thumbnails of an image.
+    Arguments:
+        file: the file of the image.
+        sizes: the widths of the thumbnails in pixels.
+    Returns:
+        a dict of the WebP bytes of every size.
+    """
+    with Image.open(file) as image:
+        # JPEGs are decoded at the smallest scale that is still bigger
+        # than the thumbnails, which is many times faster for photos
+        image.draft('RGB', (max(sizes) * 2, max(sizes) * 2))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+    thumbnails = {}
+    for size in sorted(sizes, reverse=True):
+        # every thumbnail is resized from the bigger one before it
+        image = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, 'WEBP', quality=settings.PROFILE_PHOTO_THUMBNAIL_QUALITY, method=4)
+        thumbnails[size] = buffer.getvalue()
+    return thumbnails
+
+
+def generate_profile_photo_thumbnails(profile_id, photo_name):
+    """Generates the thumbnails of a profile photo, and marks them as
+    generated if the profile still has that photo.
+    Arguments:
+        profile_id: the id of the user profile.
+        photo_name: the name of the photo in the storage.
+    """
+    storage = UserProfileModel._meta.get_field('profile_photo').storage
+    sizes = settings.PROFILE_PHOTO_THUMBNAIL_SIZES
+    with storage.open(photo_name) as file:
+        thumbnails = make_thumbnails(file, sizes)
+    for size, content in thumbnails.items():
+        name = thumbnail_name(photo_name, size)
+        storage.delete(name)  # generated again by the command
+        storage.save(name, ContentFile(content))
+    if UserProfileModel.objects.filter(pk=profile_id, profile_photo=photo_name).update(thumbnails_of=photo_name):
+        forget_user(UserProfileModel.objects.values_list('account_id', flat=True).get(pk=profile_id))
+
+
+def profile_photo_url(profile, request=None, size=None):
+    """Returns the URL that the owner of a profile downloads its photo from.
+    Arguments:
+        profile: the user profile.
+        request: the request that the URL is made absolute with.
+        size: the size of the thumbnail, the photo itself if it's None.
+    Returns:
+        None if the profile has no photo, if not, the URL of the photo.
+    """
+    if not profile.profile_photo:
+        return None
+    return download_url('core:user-photo', request, query=size and 'size={0}'.format(size))
+
+
+def profile_photo_urls(profile, request=None):
+    """Returns the URLs of a profile photo at every thumbnail size, they're
+    the URL of the photo itself until its thumbnails are generated.
+    Arguments:
+        profile: the user profile.
+        request: the request that the URLs are made absolute with.
+    Returns:
+        None if the profile has no photo, if not, a dict of the URLs of every size.
+    """
+    photo = profile.profile_photo
+    if not photo:
+        return None
+    sizes = settings.PROFILE_PHOTO_THUMBNAIL_SIZES
+    if profile.thumbnails_of == photo.name:
+        return {str(size): profile_photo_url(profile, request, size) for size in sizes}
+    url = profile_photo_url(profile, request)
+    return {str(size): url for size in sizes}
+
+
+ATTACHMENT_METADATA = ('content_type', 'size', 'width', 'height', 'has_preview')
+
+
+def generate_attachment_preview(attachment_id):
+    """Reads the metadata and renders the preview of an attachment's file
+    in the worker processes, and saves them in all the attachments with
+    that file, the files that were read before aren't read again.
+    Arguments:
+        attachment_id: the id of the note attachment.
+    """
+    name = NoteAttachmentModel.objects.filter(pk=attachment_id).values_list('file', flat=True).first()
+    if not name:
+        return  # deleted before its turn
+    metadata = NoteAttachmentModel.objects.filter(file=name, size__isnull=False).values(*ATTACHMENT_METADATA).first()
+    if metadata is None:
+        storage = NoteAttachmentModel._meta.get_field('file').storage
+        metadata, preview = run_in_process(read_attachment, storage.path(name), settings.ATTACHMENT_PREVIEW_SIZE,
+                                           settings.ATTACHMENT_PREVIEW_QUALITY)
+        if preview is not None:
+            storage.save(preview_name(name), ContentFile(preview))
+        metadata['has_preview'] = preview is not None
+
+    # saved one by one so they're in the change feed, the clients sync them
+    with transaction.atomic():
+        attachments = NoteAttachmentModel.objects.filter(file=name, size__isnull=True).select_for_update()
+        note_ids = set()
+        for attachment in attachments:
+            for field, value in metadata.items():
+                setattr(attachment, field, value)
+            attachment.save(update_fields=ATTACHMENT_METADATA)
+            note_ids.add(attachment.note_id)
+        NoteModel.objects.touch(*note_ids)
+
+
+def attachment_preview_url(notebook_slug, note_slug, slug, has_preview, request=None):
+    """Returns the URL of the preview of an attachment.
+    Arguments:
+        notebook_slug: the slug of the notebook of the attachment's note.
+        note_slug: the slug of the attachment's note.
+        slug: the slug of the attachment.
+        has_preview: whether the preview of the file was rendered.
+        request: the request that the URL is made absolute with.
+    Returns:
+        None if the file has no preview, if not, its URL.
+    """
+    if not has_preview:
+        return None
+    return download_url('core:attachments-preview', request, notebook_slug=notebook_slug, note_slug=note_slug,
+                        slug=slug)
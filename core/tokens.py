@@ -0,0 +1,153 @@
+import hashlib
+import secrets
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+
+from core.models import AuthTokenModel
+
+ACCESS_TOKEN_SALT = 'core.tokens.access'
+
+
+def _revoked_key(token_id):
+    """returns the cache key that marks the access tokens of a refresh token as revoked"""
+    return 'revoked-token:{0}'.format(token_id)
+
+
+def _secret_hash(secret):
+    """returns the hash of the secret of a refresh token"""
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+
+def _token_pair(token, secret, profile_id):
+    """returns the response data of a refresh token and a new access token"""
+
+    access = signing.dumps({'t': token.pk, 'u': token.account_id, 'p': profile_id},
+                           salt=ACCESS_TOKEN_SALT, compress=False)
+    return {'access': access, 'refresh': '{0}.{1}'.format(token.pk, secret),
+            'expires_in': settings.ACCESS_TOKEN_LIFETIME}
+
+
+def issue_tokens(account):
+    """Logs a user in with tokens.
+    Arguments:
+        account: the user, it must have a profile.
+    Returns:
+        a dict of the access token, the refresh token and the
+        seconds until the access token expires.
+    """
+    secret = secrets.token_urlsafe(32)
+    token = AuthTokenModel.objects.create(
+        id=secrets.token_hex(16), account=account, secret_hash=_secret_hash(secret),
+        expires_at=timezone.now() + timedelta(seconds=settings.REFRESH_TOKEN_LIFETIME))
+    return _token_pair(token, secret, account.profile.pk)
+
+
+def _get_token(refresh):
+    """returns the unexpired row of a refresh token with its user and profile
+    and whether its secret is the current one, or None and False if there's none"""
+
+    token_id, _, secret = refresh.partition('.')
+    token = AuthTokenModel.objects.select_related('account__profile').filter(pk=token_id).first()
+    if token is None or token.expires_at <= timezone.now():
+        return None, False
+    return token, constant_time_compare(token.secret_hash, _secret_hash(secret))
+
+
+def refresh_tokens(refresh):
+    """Replaces a refresh token with a new one and a new access token.
+    A refresh token is used once, using an old one again means it was
+    stolen, so the refresh token and its access tokens are revoked.
+    Arguments:
+        refresh: the refresh token.
+    Returns:
+        None if the refresh token isn't valid, if not, returns
+        the dict of the new tokens like issue_tokens.
+    """
+    token, is_current = _get_token(refresh)
+    if token is None:
+        return None
+    if not is_current:
+        token.delete()
+        return None
+    if not token.account.is_active or not hasattr(token.account, 'profile'):
+        return None
+
+    secret = secrets.token_urlsafe(32)
+    # the secret is replaced only if no other request replaced it first
+    replaced = AuthTokenModel.objects.filter(pk=token.pk, secret_hash=token.secret_hash).update(
+        secret_hash=_secret_hash(secret),
+        expires_at=timezone.now() + timedelta(seconds=settings.REFRESH_TOKEN_LIFETIME))
+    if not replaced:
+        AuthTokenModel.objects.filter(pk=token.pk).delete()
+        return None
+    return _token_pair(token, secret, token.account.profile.pk)
+
+
+def revoke_refresh_token(refresh):
+    """Logs a client out by revoking its refresh token and its access tokens.
+    Arguments:
+        refresh: the refresh token.
+    Returns:
+        True if the token was revoked, False if it isn't valid.
+    """
+    token, is_current = _get_token(refresh)
+    if token is None or not is_current:
+        return False
+    token.delete()
+    return True
+
+
+def revoke_user_tokens(account, keep=None):
+    """Revokes the tokens of a user, like after its password changed.
+    Arguments:
+        account: the user.
+        keep: the id of a token that isn't revoked, like the token of the request.
+    """
+    AuthTokenModel.objects.filter(account=account).exclude(pk=keep).delete()
+
+
+def forget_token(token_id):
+    """Marks the access tokens of a deleted refresh token as revoked until
+    they expire, with many server processes the cache must be shared.
+    Arguments:
+        token_id: the id of the refresh token.
+    """
+    cache.set(_revoked_key(token_id), True, settings.ACCESS_TOKEN_LIFETIME)
+
+
+def read_access_token(access):
+    """Verifies an access token without any query.
+    Arguments:
+        access: the access token.
+    Returns:
+        None if the token is forged, expired or revoked, if not,
+        returns its dict of the ids of the refresh token 't',
+        of the user 'u' and of its profile 'p'.
+    """
+    try:
+        payload = signing.loads(access, salt=ACCESS_TOKEN_SALT, max_age=settings.ACCESS_TOKEN_LIFETIME)
+    except signing.BadSignature:
+        return None
+    if cache.get(_revoked_key(payload['t'])):
+        return None
+    return payload
+
+
+def delete_expired_tokens(batch_size):
+    """Deletes a batch of the expired refresh tokens.
+    Arguments:
+        batch_size: the number of tokens deleted at most.
+    Returns:
+        the number of deleted tokens.
+    """
+    ids = list(AuthTokenModel.objects.filter(expires_at__lt=timezone.now())
+               .values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return 0
+    count, _ = AuthTokenModel.objects.filter(id__in=ids).delete()
+    return count
@@ -0,0 +1,58 @@
+import hashlib
+
+try:
+    import fcntl
+except ImportError:  # not POSIX, the chunks are only checked against the offset of the upload
+    fcntl = None
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+
+class HashingUploadHandlerMixin:
+    """Computes the sha256 of an uploaded file from the chunks that the
+    handler stores while they are received, and keeps it on the file,
+    so the attachments are stored by their content without reading them again."""
+
+    def new_file(self, *args, **kwargs):
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        data = super().receive_data_chunk(raw_data, start)
+        if data is None:  # the chunk was stored by this handler
+            self.sha256.update(raw_data)
+        return data
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.sha256.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadHandlerMixin, MemoryFileUploadHandler):
+    """Upload handler that keeps small files in memory and hashes them"""
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadHandlerMixin, TemporaryFileUploadHandler):
+    """Upload handler that streams big files to a temporary file and hashes them"""
+
+
+class PartLocked(Exception):
+    """Raised when another request is receiving a chunk of the upload"""
+
+
+def lock_part(part):
+    """Locks the part file of a chunked upload without waiting,
+    the lock is released when the file is closed.
+    Arguments:
+        part: the opened part file.
+    Raises:
+        PartLocked: if another request holds the lock.
+    """
+    if fcntl is None:
+        return
+    try:
+        fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        raise PartLocked
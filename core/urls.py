@@ -3,7 +3,10 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
-from core.views import user_login, user_logout, UserProfileView, NoteBookView, NoteView, NoteAttachmentView
+from core.downloads import DownloadContentNegotiation
+from core.views import user_login, user_logout, token_login, token_refresh, token_logout, \
+    password_hashing_status, UserProfileView, NoteBookView, NoteView, NoteAttachmentView, \
+    NoteSearchView, ChangesView, NoteAttachmentUploadView
 
 app_name = 'core'
 
@@ -16,15 +19,30 @@ note_router.register('', NoteView, basename='notes')
 note_attachment_router = DefaultRouter()
 note_attachment_router.register('', NoteAttachmentView, basename='attachments')
 
+note_attachment_upload_router = DefaultRouter()
+note_attachment_upload_router.register('', NoteAttachmentUploadView, basename='uploads')
+
 urlpatterns = [
     path('users/signup/', UserProfileView.as_view({'post': 'create'}), name='signup'),
     path('users/login/', user_login, name='login'),
     path('users/logout/', user_logout, name='logout'),
+    path('users/tokens/', token_login, name='token-login'),
+    path('users/tokens/refresh/', token_refresh, name='token-refresh'),
+    path('users/tokens/logout/', token_logout, name='token-logout'),
     path('users/me/', UserProfileView.as_view({'get': 'retrieve',
                                                'put': 'update',
                                                'patch': 'partial_update',
                                                'delete': 'destroy'}), name='user-details'),
+    path('users/me/photo/', UserProfileView.as_view({'get': 'photo'},
+                                                    content_negotiation_class=DownloadContentNegotiation),
+         name='user-photo'),
     path('notebooks/', include(note_book_router.urls)),
     path('notebooks/<slug:notebook_slug>/notes/', include(note_router.urls)),
-    path('notebooks/<slug:notebook_slug>/notes/<slug:note_slug>/attachment/', include(note_attachment_router.urls))
+    path('notebooks/<slug:notebook_slug>/notes/<slug:note_slug>/attachment/uploads/',
+         include(note_attachment_upload_router.urls)),
+    path('notebooks/<slug:notebook_slug>/notes/<slug:note_slug>/attachment/', include(note_attachment_router.urls)),
+    path('search/', NoteSearchView.as_view({'get': 'list'}), name='search'),
+    path('tree/', NoteBookView.as_view({'get': 'tree'}), name='tree'),
+    path('changes/', ChangesView.as_view({'get': 'list'}), name='changes'),
+    path('status/password-hashing/', password_hashing_status, name='password-hashing-status')
 ]
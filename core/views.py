@@ -1,16 +1,43 @@
 #  Copyright (c) Code Written and Tested by Ahmed Emad in 14/03/2020, 22:30.
 
+import hashlib
+import json
+import os
+
+from django.conf import settings
 from django.contrib.auth import authenticate, login, logout, update_session_auth_hash
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count, F
+from django.http import Http404
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags, quote_etag
 from rest_framework import status, viewsets
-from rest_framework.decorators import api_view
-from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 
-from core.models import NoteBookModel, NoteModel, NoteAttachmentModel
+from core.authentication import load_profile
+from core.downloads import DownloadContentNegotiation, file_response
+from core.models import NoteBookModel, NoteModel, NoteAttachmentModel, ChangeModel, NoteAttachmentUploadModel, \
+    preview_name
+from core.pagination import KeysetPagination, SearchPagination, StreamingLimitOffsetPagination
+from core.passwords import hashing_stats
 from core.permissions import UserProfilePermissions, NoteBookPermissions, NotePermissions, NoteAttachmentPermissions
 from core.serializers import UserProfileSerializer, NoteBookSerializer, NoteSerializer, NoteAttachmentSerializer, \
-    NoteDetailSerializer
+    NoteDetailSerializer, NoteSlugsSerializer, NoteMoveSerializer, NoteSearchSerializer, NoteBookSyncSerializer, \
+    NoteSyncSerializer, NoteAttachmentSyncSerializer, NoteTextEditsSerializer, NoteBookValuesSerializer, \
+    NoteValuesSerializer, NoteDetailValuesSerializer, NoteAttachmentUploadSerializer
+from core.search import get_search_backend
+from core.signals import bulk_unique_slugify, batched_file_deletion, invalidate_notebook_trees, notebook_tree_key, \
+    batched_changes, change_of, record_changes
+from core.streaming import iterate_in_chunks, list_response
+from core.thumbnails import thumbnail_name
+from core.tokens import issue_tokens, refresh_tokens, revoke_refresh_token, revoke_user_tokens
+from core.uploadhandlers import PartLocked, lock_part
 
 
 @api_view(['POST'])
@@ -42,6 +69,49 @@ def user_logout(request):
     return Response('Your are not logged in', status=status.HTTP_401_UNAUTHORIZED)
 
 
+@api_view(['POST'])
+def token_login(request):
+    """View for logging the API clients in with tokens, they send the
+    short lived access token in the Authorization header as 'Bearer <token>'
+    and get new tokens with the refresh token before it expires"""
+
+    user = authenticate(username=request.data.get('username'), password=request.data.get('password'))
+
+    if user and hasattr(user, 'profile'):
+        return Response(issue_tokens(user))
+    return Response('Wrong Username or Password', status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(['POST'])
+def token_refresh(request):
+    """View for replacing a refresh token with new tokens,
+    every refresh token can be used once"""
+
+    tokens = refresh_tokens(str(request.data.get('refresh', '')))
+    if tokens is None:
+        return Response('Invalid or expired refresh token', status=status.HTTP_401_UNAUTHORIZED)
+    return Response(tokens)
+
+
+@api_view(['POST'])
+def token_logout(request):
+    """View for logging the API clients out, their refresh
+    token and its access tokens are revoked"""
+
+    if revoke_refresh_token(str(request.data.get('refresh', ''))):
+        return Response('Logged Out Successfully')
+    return Response('Invalid or expired refresh token', status=status.HTTP_401_UNAUTHORIZED)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def password_hashing_status(request):
+    """View for the staff to watch the queue of the password hashing pool,
+    a growing wait or rejected count means the pool is too small for the logins"""
+
+    return Response(hashing_stats())
+
+
 class UserProfileView(viewsets.ViewSet):
     """View for the user profile.
     Retrieves, creates, Updates and Deletes a User Profile.
@@ -61,10 +131,36 @@ class UserProfileView(viewsets.ViewSet):
             HTTP 403 if user is not logged in,
             if not, returns HTTP 200 Response with the profile's JSON data.
         """
-        user_profile = request.user.profile
+        user_profile = load_profile(request)
         serializer = self.serializer_class(user_profile)
         return Response(serializer.data)
 
+    def photo(self, request):
+        """Downloads the profile photo of the user or one of its thumbnails.
+        Arguments:
+            request: the request data sent by the user, it is used
+                     to get the user profile, its size parameter is the
+                     size of the thumbnail, the photo itself is sent without it,
+                     or until its thumbnails are generated.
+        Returns:
+            HTTP 403 if user is not logged in,
+            HTTP 404 Response if the user has no profile photo,
+            HTTP 304 or 412 Response for conditional requests,
+            if not, returns HTTP 200 Response with the photo.
+        """
+        user_profile = load_profile(request)
+        photo = user_profile.profile_photo
+        if not photo:
+            raise Http404
+        name = photo.name
+        size = request.query_params.get('size')
+        if size in {str(size) for size in settings.PROFILE_PHOTO_THUMBNAIL_SIZES} and \
+                user_profile.thumbnails_of == photo.name:
+            name = thumbnail_name(photo.name, size)
+        # a stored photo or thumbnail never changes, a new photo has a new name
+        etag = quote_etag(hashlib.sha256(name.encode()).hexdigest())
+        return file_response(request, photo.storage.path(name), name, os.path.basename(name), etag)
+
     def create(self, request):
         """Creates A new user profile and Logs it In.
         Checks if user is authenticated if true, return HTTP 401 Response,
@@ -85,7 +181,7 @@ class UserProfileView(viewsets.ViewSet):
             serializer = self.serializer_class(data=request.data)
             if serializer.is_valid():
                 user_profile = serializer.save()
-                login(request, user_profile.account)
+                login(request, user_profile.account, backend=settings.AUTHENTICATION_BACKENDS[0])
                 return Response(serializer.data, status=status.HTTP_201_CREATED)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         return Response(status=status.HTTP_401_UNAUTHORIZED)
@@ -103,11 +199,15 @@ class UserProfileView(viewsets.ViewSet):
              if not returns HTTP 200 Response with the update JSON data.
         """
 
-        user_profile = request.user.profile
+        user_profile = load_profile(request)
         serializer = self.serializer_class(user_profile, data=request.data)
         if serializer.is_valid():
+            password_changed = 'password' in serializer.validated_data.get('account', {})
             serializer.save()
-            update_session_auth_hash(request, user_profile.account)
+            if request.auth is None:  # the token clients have no session
+                update_session_auth_hash(request, user_profile.account)
+            if password_changed:
+                revoke_user_tokens(user_profile.account, keep=request.auth)
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -124,11 +224,15 @@ class UserProfileView(viewsets.ViewSet):
              if not returns HTTP 200 Response with the update JSON data.
         """
 
-        user_profile = request.user.profile
+        user_profile = load_profile(request)
         serializer = self.serializer_class(user_profile, data=request.data, partial=True)
         if serializer.is_valid():
+            password_changed = 'password' in serializer.validated_data.get('account', {})
             serializer.save()
-            update_session_auth_hash(request, user_profile.account)
+            if request.auth is None:  # the token clients have no session
+                update_session_auth_hash(request, user_profile.account)
+            if password_changed:
+                revoke_user_tokens(user_profile.account, keep=request.auth)
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -142,8 +246,9 @@ class UserProfileView(viewsets.ViewSet):
             if not returns HTTP 204 Response with no content.
         """
 
-        user_profile = request.user.profile
-        user_profile.delete()
+        user_profile = load_profile(request)
+        with transaction.atomic(), batched_file_deletion(), batched_changes():
+            user_profile.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
@@ -155,9 +260,14 @@ class NoteBookView(viewsets.ViewSet):
     permission_classes = (NoteBookPermissions,)
     serializer_class = NoteBookSerializer
     lookup_field = 'slug'
+    notes_preview_size = 10
+    chunk_size = 100
+    tree_cache_timeout = 24 * 60 * 60
 
     def list(self, request):
         """Lists all notebooks the user has.
+        Every notebook has its notes count and only its first notes,
+        they are all fetched in one query for the whole page.
         Arguments:
             request: the request data sent by the user, it is used
                      to get the user's profile.
@@ -165,19 +275,74 @@ class NoteBookView(viewsets.ViewSet):
             HTTP 403 Response if the user is
             not logged in,
             HTTP 200 Response with all notebooks in
-            the user's profile in JSON.
+            the user's profile in JSON, paginated by limit and offset
+            or by cursor if the request has a cursor parameter.
         """
         user = request.user.profile
-        queryset = user.notebooks.all()
+        first_notes = NoteModel.objects.order_by('id')
+        queryset = NoteBookValuesSerializer.values(user.notebooks.annotate(notes_count=Count('notes')))
+
+        if KeysetPagination.is_requested(request):
+            paginator = KeysetPagination(page_size=10)
+            paginated_queryset = paginator.paginate_queryset(queryset, request)
+            rows = NoteBookValuesSerializer.add_notes(paginated_queryset, first_notes, self.notes_preview_size)
+            return list_response(request, {'next': paginator.get_next_link(),
+                                           'previous': paginator.get_previous_link()},
+                                 'notebooks', [rows], NoteBookValuesSerializer)
 
-        paginator = LimitOffsetPagination()
-        paginator.default_limit = 10
-        paginator.max_limit = 100
+        paginator = StreamingLimitOffsetPagination(default_limit=10, max_limit=100)
         paginated_queryset = paginator.paginate_queryset(queryset, request)
-        serializer = self.serializer_class(paginated_queryset, many=True)
+        chunks = (NoteBookValuesSerializer.add_notes(chunk, first_notes, self.notes_preview_size)
+                  for chunk in iterate_in_chunks(paginated_queryset, self.chunk_size))
+
+        return list_response(request, {'limit': paginator.limit, 'offset': paginator.offset,
+                                       'count': paginator.count}, 'notebooks', chunks, NoteBookValuesSerializer)
+
+    def _build_tree(self, user):
+        """returns the notebooks of a user with the slugs and titles of their notes"""
 
-        return Response(data={'limit': paginator.limit, 'offset': paginator.offset,
-                              'count': paginator.count, 'notebooks': serializer.data})
+        notebooks = list(user.notebooks.order_by('id').values('id', 'slug', 'title'))
+        notes = {notebook['id']: [] for notebook in notebooks}
+        for notebook_id, slug, title in NoteModel.objects.filter(notebook__user=user).order_by('id') \
+                .values_list('notebook_id', 'slug', 'title'):
+            notes[notebook_id].append({'slug': slug, 'title': title})
+        return [{'slug': notebook['slug'], 'title': notebook['title'], 'notes': notes[notebook['id']]}
+                for notebook in notebooks]
+
+    def tree(self, request):
+        """Lists all notebooks of the user with the slugs and titles of
+        all their notes, for the clients to build their sidebar at once.
+        The tree is cached until a notebook or a note title changes, and
+        its ETag is sent back in If-None-Match to revalidate it.
+        Arguments:
+            request: the request data sent by the user, it is used
+                     to get the user's profile.
+        Returns:
+            HTTP 403 Response if the user is
+            not logged in,
+            HTTP 304 Response with no content if the tree
+            didn't change since the ETag the user has,
+            if not, returns HTTP 200 Response with the tree in JSON.
+        """
+        user = request.user.profile
+        key = notebook_tree_key(user.pk)
+        cached = cache.get(key)
+        if cached is None:
+            tree = self._build_tree(user)
+            etag = quote_etag(hashlib.md5(json.dumps(tree, separators=(',', ':')).encode()).hexdigest())
+            cached = (etag, tree)
+            cache.set(key, cached, self.tree_cache_timeout)
+
+        etag, tree = cached
+        # the compression middleware sends the ETag as a weak one
+        if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+        if etag in if_none_match or 'W/' + etag in if_none_match:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(data={'notebooks': tree})
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
 
     def create(self, request):
         """Creates a new notebook and adds it to the user's list.
@@ -232,7 +397,8 @@ class NoteBookView(viewsets.ViewSet):
         """
         user = request.user.profile
         notebook = get_object_or_404(NoteBookModel, slug=slug, user=user)
-        notebook.delete()
+        with transaction.atomic(), batched_file_deletion(), batched_changes():
+            notebook.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
@@ -244,6 +410,8 @@ class NoteView(viewsets.ViewSet):
     permission_classes = (NotePermissions,)
     serializer_class = NoteDetailSerializer
     lookup_field = 'slug'
+    chunk_size = 100
+    max_bulk_size = 1000
 
     def list(self, request, notebook_slug):
         """Lists all notes the user has inside a notebook.
@@ -256,20 +424,26 @@ class NoteView(viewsets.ViewSet):
             HTTP 404 if notebook is not found
             HTTP 403 Response if the user is
             not logged in,
-            HTTP 200 Response with all notes in JSON.
+            HTTP 200 Response with all notes in JSON, paginated by limit
+            and offset or by cursor if the request has a cursor parameter.
         """
         user = request.user.profile
         notebook = get_object_or_404(NoteBookModel, user=user, slug=notebook_slug)
-        queryset = notebook.notes.all()
+        queryset = NoteValuesSerializer.values(notebook.notes.all())
 
-        paginator = LimitOffsetPagination()
-        paginator.default_limit = 30
-        paginator.max_limit = 100
+        if KeysetPagination.is_requested(request):
+            paginator = KeysetPagination(page_size=30)
+            paginated_queryset = paginator.paginate_queryset(queryset, request)
+            return list_response(request, {'next': paginator.get_next_link(),
+                                           'previous': paginator.get_previous_link()},
+                                 'notes', [paginated_queryset], NoteValuesSerializer)
+
+        paginator = StreamingLimitOffsetPagination(default_limit=30, max_limit=100)
         paginated_queryset = paginator.paginate_queryset(queryset, request)
-        serializer = NoteSerializer(paginated_queryset, many=True)
 
-        return Response(data={'limit': paginator.limit, 'offset': paginator.offset,
-                              'count': paginator.count, 'notes': serializer.data})
+        return list_response(request, {'limit': paginator.limit, 'offset': paginator.offset,
+                                       'count': paginator.count},
+                             'notes', iterate_in_chunks(paginated_queryset, self.chunk_size), NoteValuesSerializer)
 
     def retrieve(self, request, notebook_slug, slug):
         """Retrieves a certain note from the user's list
@@ -283,14 +457,20 @@ class NoteView(viewsets.ViewSet):
         Returns:
             HTTP 403 Response if the user is
             not logged in,
-            HTTP 404 Response if note is not found, if not,
-            returns HTTP 200 Response with the note's JSON data.
+            HTTP 404 Response if note is not found,
+            HTTP 304 Response with no content if the note didn't change
+            since the ETag or date in If-None-Match or If-Modified-Since,
+            if not, returns HTTP 200 Response with the note's JSON data.
         """
         user = request.user.profile
         note = get_object_or_404(NoteModel, slug=slug, notebook__slug=notebook_slug,
                                  notebook__user=user)
-        serializer = self.serializer_class(note)
-        return Response(serializer.data)
+        response = self._check_preconditions(request, note)
+        if response is not None:
+            return response
+        row = {'id': note.id, 'slug': note.slug, 'title': note.title, 'text': note.text}
+        serializer = NoteDetailValuesSerializer(NoteDetailValuesSerializer.add_attachments([row])[0])
+        return self._with_validators(Response(serializer.data), note)
 
     def create(self, request, notebook_slug):
         """Creates a new note and adds it to the user's list.
@@ -309,12 +489,56 @@ class NoteView(viewsets.ViewSet):
         user = request.user.profile
         notebook = get_object_or_404(NoteBookModel, user=user,
                                      slug=notebook_slug)
+        if isinstance(request.data, list):
+            return self.create_many(request, notebook)
+
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
             serializer.save(notebook=notebook)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def create_many(self, request, notebook):
+        """Creates many notes at once from a JSON array.
+        All notes are validated in one pass, given their slugs in memory
+        and inserted with one bulk query inside a single transaction,
+        so either all of them are created or none of them.
+        Arguments:
+            request: the request data sent by the user, its data
+                     is the list of the notes to create.
+            notebook: the notebook that the created notes will be in.
+        Returns:
+            HTTP 400 Response if the list is too long or any note is not valid
+            with a list of the errors of every note in the same order,
+            if not, returns HTTP 201 Response with a list of the created
+            notes' slugs and titles in the same order.
+        """
+        if len(request.data) > self.max_bulk_size:
+            return Response('Can\'t create more than {0} notes at once'.format(self.max_bulk_size),
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = self.serializer_class(data=request.data, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        notes = [NoteModel(notebook=notebook, **data) for data in serializer.validated_data]
+        with transaction.atomic():
+            slugs = bulk_unique_slugify(NoteModel, 'notebook', notebook.pk,
+                                        [note.title for note in notes])
+            for note, slug in zip(notes, slugs):
+                note.slug = slug
+            NoteModel.objects.bulk_create(notes, batch_size=500)
+            if notes[0].pk is None:  # only PostgreSQL returns the ids of bulk inserted rows
+                ids = dict(NoteModel.objects.filter(notebook=notebook, slug__in=slugs).values_list('slug', 'id'))
+                for note in notes:
+                    note.pk = ids[note.slug]
+            backend = get_search_backend()
+            transaction.on_commit(lambda: backend.index_notes(notes))  # bulk_create sends no signals
+            invalidate_notebook_trees(user_ids=[notebook.user_id])
+            record_changes([change_of(note) for note in notes])
+
+        return Response(NoteSerializer(notes, many=True).data, status=status.HTTP_201_CREATED)
+
     def update(self, request, notebook_slug, slug):
         """Completely Updates a certain note from the user's list.
         Arguments:
@@ -328,20 +552,16 @@ class NoteView(viewsets.ViewSet):
             HTTP 403 Response if the user is
             not logged in,
             HTTP 400 Response if the data is not valid with the errors,
-            HTTP 404 Response if the note is not found
+            HTTP 404 Response if the note is not found,
+            HTTP 412 Response if the note changed since the ETag in If-Match,
             if not returns HTTP 200 Response with the update JSON data.
         """
-        user = request.user.profile
-        note = get_object_or_404(NoteModel, slug=slug, notebook__slug=notebook_slug,
-                                 notebook__user=user)
-        serializer = self.serializer_class(note, data=request.data)
-        if serializer.is_valid():
-            serializer.save()
-            return Response(serializer.data)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return self._update(request, notebook_slug, slug, partial=False)
 
     def partial_update(self, request, notebook_slug, slug):
         """Partially Updates a certain note from the user's list.
+        If the data has text_edits instead of the text, they are
+        applied to the text on the server, see _edit_text.
         Arguments:
             request: the request data sent by the user, it is used
                      to get the user's profile.
@@ -353,17 +573,52 @@ class NoteView(viewsets.ViewSet):
             HTTP 403 Response if the user is
             not logged in,
             HTTP 400 Response if the data is not valid with the errors,
-            HTTP 404 Response if the note is not found
+            HTTP 404 Response if the note is not found,
+            HTTP 412 Response if the note changed since the ETag in If-Match,
+            HTTP 428 Response if the data has text edits but no If-Match,
             if not returns HTTP 200 Response with the update JSON data.
         """
+        return self._update(request, notebook_slug, slug, partial=True)
+
+    def _update(self, request, notebook_slug, slug, partial):
+        """Updates a note if the preconditions of the request hold.
+        The note is locked until the update is saved, so two updates
+        with the same If-Match can't both pass the check.
+        """
         user = request.user.profile
-        note = get_object_or_404(NoteModel, slug=slug, notebook__slug=notebook_slug,
-                                 notebook__user=user)
-        serializer = self.serializer_class(note, data=request.data, partial=True)
-        if serializer.is_valid():
+        with transaction.atomic():
+            note = get_object_or_404(NoteModel.objects.select_for_update(of=('self',)).select_related('notebook'),
+                                     slug=slug, notebook__slug=notebook_slug, notebook__user=user)
+            response = self._check_preconditions(request, note)
+            if response is not None:
+                return response
+            if partial and 'text_edits' in request.data:
+                return self._edit_text(request, note)
+            serializer = self.serializer_class(note, data=request.data, partial=partial)
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
             serializer.save()
-            return Response(serializer.data)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return self._with_validators(Response(serializer.data), note)
+
+    def _edit_text(self, request, note):
+        """Patches the text of a locked note with a list of edits.
+        The edits are made to the version of the text in If-Match,
+        so they are only applied if the note is still at that version,
+        and only the slug and title are sent back, not the text.
+        Returns:
+            HTTP 428 Response if the request has no If-Match,
+            HTTP 400 Response if the edits are not valid with the errors,
+            if not returns HTTP 200 Response with the note's slug and title.
+        """
+        if 'HTTP_IF_MATCH' not in request.META:
+            return Response('Text edits need the ETag of the edited version in If-Match',
+                            status=status.HTTP_428_PRECONDITION_REQUIRED)
+        serializer = NoteTextEditsSerializer(data=request.data, context={'text': note.text})
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        note.text = serializer.validated_data['text']
+        note.save(update_fields=['text'])
+        return self._with_validators(Response(NoteSerializer(note).data), note)
 
     def destroy(self, request, notebook_slug, slug):
         """Deletes a certain note from the user's list.
@@ -377,18 +632,247 @@ class NoteView(viewsets.ViewSet):
             HTTP 404 Response if the note is not found
             HTTP 403 Response if the user is
             not logged in,
+            HTTP 412 Response if the note changed since the ETag in If-Match,
             if not, returns HTTP 204 Response with no content.
         """
         user = request.user.profile
-        note = get_object_or_404(NoteModel, slug=slug, notebook__slug=notebook_slug,
-                                 notebook__user=user)
-        note.delete()
+        with transaction.atomic():
+            note = get_object_or_404(NoteModel.objects.select_for_update(of=('self',)), slug=slug,
+                                     notebook__slug=notebook_slug, notebook__user=user)
+            response = self._check_preconditions(request, note)
+            if response is not None:
+                return response
+            note.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @staticmethod
+    def _check_preconditions(request, note):
+        """Checks the conditional headers of a request against the
+        version of a note, they need no query as the version is a
+        column of the note.
+        Returns:
+            HTTP 304 Response for a read of a note that didn't change,
+            HTTP 412 Response for a write to a note that changed,
+            if not, None.
+        """
+        # If-Match uses the strong comparison, so the weak ETags that the compression
+        # middleware sends only match If-None-Match, the writes need the strong ETag
+        response = get_conditional_response(request, etag=note.etag,
+                                            last_modified=int(note.updated_at.timestamp()))
+        if response is not None:
+            return NoteView._with_validators(response, note)
+        return None
+
+    @staticmethod
+    def _with_validators(response, note):
+        """adds the ETag and Last-Modified headers of a note to its response"""
+        response['ETag'] = note.etag
+        response['Last-Modified'] = http_date(note.updated_at.timestamp())
+        return response
+
+    def _get_bulk_notes(self, notebook, slugs, fields):
+        """Gets the notes of a bulk operation in one query.
+        Arguments:
+            notebook: the notebook that the notes are in.
+            slugs: the slugs of the notes.
+            fields: the fields of the notes to load.
+        Returns:
+            A tuple of the found notes and the list of slugs not found.
+        """
+        notes = list(NoteModel.objects.filter(notebook=notebook, slug__in=slugs).only(*fields))
+        found = {note.slug for note in notes}
+        return notes, [slug for slug in slugs if slug not in found]
+
+    @action(detail=False, methods=['post'], url_path='bulk-delete')
+    def bulk_delete(self, request, notebook_slug):
+        """Deletes many notes of a notebook at once.
+        The notes are deleted with set based queries and the files
+        of their attachments are deleted in one batch after commit.
+        Arguments:
+            request: the request data sent by the user, its data
+                     has the list of the slugs of the notes to delete.
+            notebook_slug: the slug of the notebook that the notes are in.
+        Returns:
+            HTTP 403 Response if the user is
+            not logged in,
+            HTTP 400 Response if the data is not valid,
+            HTTP 404 Response if the notebook or any of the notes
+            is not found with the slugs not found, nothing is deleted then,
+            if not, returns HTTP 204 Response with no content.
+        """
+        user = request.user.profile
+        serializer = NoteSlugsSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        notebook = get_object_or_404(NoteBookModel, user=user, slug=notebook_slug)
+        notes, missing = self._get_bulk_notes(notebook, serializer.validated_data['slugs'], ('pk', 'slug'))
+        if missing:
+            return Response({'not_found': missing}, status=status.HTTP_404_NOT_FOUND)
+
+        with transaction.atomic(), batched_file_deletion(), batched_changes():
+            NoteModel.objects.filter(pk__in=[note.pk for note in notes]).delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=False, methods=['post'], url_path='bulk-move')
+    def bulk_move(self, request, notebook_slug):
+        """Moves many notes of a notebook to another notebook at once.
+        The notes keep their slugs unless they are taken in the other
+        notebook, then they are given new ones, all in set based queries.
+        Arguments:
+            request: the request data sent by the user, its data
+                     has the list of the slugs of the notes to move and
+                     the slug of the notebook to move them to.
+            notebook_slug: the slug of the notebook that the notes are in.
+        Returns:
+            HTTP 403 Response if the user is
+            not logged in,
+            HTTP 400 Response if the data is not valid,
+            HTTP 404 Response if any of the notebooks or the notes
+            is not found, nothing is moved then,
+            if not, returns HTTP 200 Response with the new slug of every moved note.
+        """
+        user = request.user.profile
+        serializer = NoteMoveSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        target_slug = serializer.validated_data['notebook']
+        if target_slug == notebook_slug:
+            return Response({'notebook': ['The notes are already in this notebook.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+        notebooks = {notebook.slug: notebook for notebook in
+                     NoteBookModel.objects.filter(user=user, slug__in=(notebook_slug, target_slug))}
+        if len(notebooks) != 2:
+            return Response('Notebook not found', status=status.HTTP_404_NOT_FOUND)
+        notebook, target = notebooks[notebook_slug], notebooks[target_slug]
+
+        slugs = serializer.validated_data['slugs']
+        with transaction.atomic():
+            notes, missing = self._get_bulk_notes(notebook, slugs, ('pk', 'slug', 'title'))
+            if missing:
+                return Response({'not_found': missing}, status=status.HTTP_404_NOT_FOUND)
+
+            old_slugs = {note.pk: note.slug for note in notes}
+            taken = set(NoteModel.objects.filter(notebook=target, slug__in=old_slugs.values())
+                        .values_list('slug', flat=True))
+            conflicts = [note for note in notes if note.slug in taken]
+            kept = [note.slug for note in notes if note.slug not in taken]
+            new_slugs = bulk_unique_slugify(NoteModel, 'notebook', target.pk,
+                                            [note.title for note in conflicts], reserved=kept)
+            for note, slug in zip(conflicts, new_slugs):
+                note.slug = slug
+            now = timezone.now()
+            for note in notes:
+                note.notebook = target
+                note.version = F('version') + 1
+                note.updated_at = now
+            NoteModel.objects.bulk_update(notes, ['notebook', 'slug', 'version', 'updated_at'], batch_size=500)
+            invalidate_notebook_trees(user_ids=[user.pk])  # bulk_update sends no signals
+            record_changes([change_of(note) for note in notes])
+
+        return Response({old_slugs[note.pk]: note.slug for note in notes})
+
+
+class NoteSearchView(viewsets.ViewSet):
+    """View for searching the user notes.
+    Lists the notes of all notebooks that match the search words.
+    """
+
+    permission_classes = (NotePermissions,)
+    serializer_class = NoteSearchSerializer
+
+    def list(self, request):
+        """Lists the user's notes that match the 'q' query parameter
+        ordered by their rank, with a highlighted snippet of their text.
+        Arguments:
+            request: the request data sent by the user, it is used
+                     to get the user's profile and the search words.
+        Returns:
+            HTTP 403 Response if the user is
+            not logged in,
+            HTTP 400 Response if there are no search words,
+            HTTP 200 Response with a page of the matched notes in JSON,
+            paginated by cursor.
+        """
+        user = request.user.profile
+        text = request.query_params.get('q', '').strip()
+        if not text:
+            return Response('No search words', status=status.HTTP_400_BAD_REQUEST)
+
+        backend = get_search_backend()
+        paginator = SearchPagination(page_size=20)
+        paginated_queryset = paginator.paginate_queryset(backend.search(user, text), request)
+        backend.highlight(paginated_queryset, text)
+        serializer = self.serializer_class(paginated_queryset, many=True)
+        return Response(data={'next': paginator.get_next_link(), 'previous': paginator.get_previous_link(),
+                              'notes': serializer.data})
+
+
+class ChangesView(viewsets.ViewSet):
+    """View for the change feed of the user.
+    Lists the notebooks, notes and attachments that were saved
+    or deleted since the last change the user has seen.
+    """
+
+    permission_classes = (NoteBookPermissions,)
+    sources = {
+        ChangeModel.NOTEBOOK: (NoteBookModel.objects.all(), NoteBookSyncSerializer),
+        ChangeModel.NOTE: (NoteModel.objects.all(), NoteSyncSerializer),
+        ChangeModel.ATTACHMENT: (NoteAttachmentModel.objects.select_related('note__notebook'),
+                                 NoteAttachmentSyncSerializer),
+    }
+    default_limit = 100
+    max_limit = 1000
+
+    def list(self, request):
+        """Lists the changes after the since token in the order they
+        were made, with the current data of the saved objects.
+        A user that is up to date costs one query on the feed's index.
+        Arguments:
+            request: the request data sent by the user, its since parameter
+                     is the token of the last response or 0 for all the data,
+                     and its limit parameter is the number of changes.
+        Returns:
+            HTTP 403 Response if the user is
+            not logged in,
+            HTTP 400 Response if the token or limit are not valid, if not,
+            HTTP 200 Response with the changes in JSON, the token to send
+            as since next time, and whether there are more changes.
+        """
+        user = request.user.profile
+        try:
+            since = int(request.query_params.get('since', 0))
+            limit = min(int(request.query_params.get('limit', self.default_limit)), self.max_limit)
+        except ValueError:
+            return Response('since and limit must be numbers', status=status.HTTP_400_BAD_REQUEST)
+        if since < 0 or limit < 1:
+            return Response('since and limit must be positive', status=status.HTTP_400_BAD_REQUEST)
+
+        changes = list(ChangeModel.objects.filter(user=user, id__gt=since).order_by('id')[:limit + 1])
+        more = len(changes) > limit
+        changes = changes[:limit]
+
+        saved = {}
+        for kind, (queryset, serializer_class) in self.sources.items():
+            ids = [change.object_id for change in changes if change.kind == kind and not change.deleted]
+            if ids:
+                serializer = serializer_class(queryset.filter(pk__in=ids), many=True,
+                                              context={'request': request})
+                saved[kind] = {data['id']: data for data in serializer.data}
+
+        results = []
+        for change in changes:
+            # an object deleted after its change was read is sent as deleted
+            data = saved.get(change.kind, {}).get(change.object_id)
+            results.append({'type': change.kind, 'id': change.object_id, 'deleted': data is None, 'data': data})
+        return Response(data={'changes': results, 'since': str(changes[-1].id if changes else since),
+                              'more': more})
+
 
 class NoteAttachmentView(viewsets.ViewSet):
     """View for the note attachment.
-    Creates and Deletes a note attachment.
+    Creates, Downloads and Deletes a note attachment.
     """
 
     permission_classes = (NoteAttachmentPermissions,)
@@ -410,14 +894,72 @@ class NoteAttachmentView(viewsets.ViewSet):
             returns HTTP 201 Response with the note attachment's JSON data.
         """
         user = request.user.profile
-        note = get_object_or_404(NoteModel, notebook__slug=notebook_slug,
+        note = get_object_or_404(NoteModel.objects.select_related('notebook'), notebook__slug=notebook_slug,
                                  notebook__user=user, slug=note_slug)
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
             serializer.save(note=note)
+            NoteModel.objects.touch(note.pk)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=True, methods=['get'], content_negotiation_class=DownloadContentNegotiation)
+    def download(self, request, notebook_slug, note_slug, slug):
+        """Downloads the file of a certain note attachment.
+        The file is stored by the hash of its content,
+        so the hash is used as its ETag.
+        Arguments:
+            request: the request data sent by the user, it is used
+                     to get the user's profile and the Range and
+                     conditional headers
+            notebook_slug: the notebook slug that the note is in
+            note_slug: the note slug that the attachment is in
+            slug: the slug of the note attachment that the user wants to download.
+        Returns:
+            HTTP 404 Response if the note attachment is not found
+            HTTP 403 Response if the user is
+            not logged in,
+            HTTP 304 or 412 Response for conditional requests,
+            HTTP 416 Response if the range is after the end of the file,
+            HTTP 206 Response with the bytes of a range request, if not,
+            returns HTTP 200 Response with the file.
+        """
+        user = request.user.profile
+        attachment = get_object_or_404(NoteAttachmentModel.objects.only('slug', 'file'),
+                                       note__notebook__user=user,
+                                       note__notebook__slug=notebook_slug,
+                                       note__slug=note_slug, slug=slug)
+        name = attachment.file.name
+        base, extension = os.path.splitext(os.path.basename(name))
+        # a stored file never changes, its name is the hash of its content or was unique before that
+        return file_response(request, attachment.file.path, name, attachment.slug + extension, quote_etag(base))
+
+    @action(detail=True, methods=['get'], content_negotiation_class=DownloadContentNegotiation)
+    def preview(self, request, notebook_slug, note_slug, slug):
+        """Downloads the preview of a certain note attachment.
+        Arguments:
+            request: the request data sent by the user, it is used
+                     to get the user's profile and the conditional headers
+            notebook_slug: the notebook slug that the note is in
+            note_slug: the note slug that the attachment is in
+            slug: the slug of the note attachment.
+        Returns:
+            HTTP 404 Response if the note attachment is not found or has no preview
+            HTTP 403 Response if the user is
+            not logged in,
+            HTTP 304 or 412 Response for conditional requests,
+            if not, returns HTTP 200 Response with the WebP preview.
+        """
+        user = request.user.profile
+        attachment = get_object_or_404(NoteAttachmentModel.objects.only('slug', 'file'),
+                                       note__notebook__user=user,
+                                       note__notebook__slug=notebook_slug,
+                                       note__slug=note_slug, slug=slug, has_preview=True)
+        name = preview_name(attachment.file.name)
+        base = os.path.splitext(os.path.basename(name))[0]
+        return file_response(request, attachment.file.storage.path(name), name, attachment.slug + '.webp',
+                             quote_etag(base + '-preview'))
+
     def destroy(self, request, notebook_slug, note_slug, slug):
         """Deletes a certain note attachment from the note's attachments list.
         Arguments:
@@ -433,8 +975,190 @@ class NoteAttachmentView(viewsets.ViewSet):
             if not, returns HTTP 204 Response with no content.
         """
         user = request.user.profile
-        attachment = get_object_or_404(NoteAttachmentModel, note__notebook__user=user,
+        attachment = get_object_or_404(NoteAttachmentModel.objects.select_related('note__notebook'),
+                                       note__notebook__user=user,
                                        note__notebook__slug=notebook_slug,
                                        note__slug=note_slug, slug=slug)
         attachment.delete()
+        NoteModel.objects.touch(attachment.note_id)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class NoteAttachmentUploadView(viewsets.ViewSet):
+    """View for the chunked uploads of note attachments.
+    Starts an upload, receives its chunks, finishes it into
+    an attachment and aborts it.
+    """
+
+    permission_classes = (NoteAttachmentPermissions,)
+    serializer_class = NoteAttachmentUploadSerializer
+    max_chunk_size = 10 * 1000 * 1000
+    block_size = 64 * 1024
+
+    @staticmethod
+    def _get_upload(request, notebook_slug, note_slug, pk, lock=False):
+        """returns an upload of the user, locked until the end of the transaction if lock is True"""
+
+        queryset = NoteAttachmentUploadModel.objects.select_related('note__notebook')
+        if lock:
+            queryset = queryset.select_for_update(of=('self',))
+        try:
+            return queryset.get(note__notebook__user=request.user.profile, note__notebook__slug=notebook_slug,
+                                note__slug=note_slug, pk=pk)
+        except (NoteAttachmentUploadModel.DoesNotExist, ValidationError):  # not found or not a uuid
+            raise Http404
+
+    def create(self, request, notebook_slug, note_slug):
+        """Starts an upload of a note attachment.
+        Arguments:
+            request: the request data sent by the user, it is used
+                     to get the user's profile and the name and size of the file.
+            notebook_slug: the notebook slug that the note is in
+            note_slug: the note slug that the attachment will be in
+        Returns:
+            HTTP 403 Response if the user is
+            not logged in,
+            HTTP 404 if note is not found,
+            HTTP 400 Response if the data is not valid, if not,
+            returns HTTP 201 Response with the upload's JSON data.
+        """
+        user = request.user.profile
+        note = get_object_or_404(NoteModel, notebook__slug=notebook_slug, notebook__user=user, slug=note_slug)
+        serializer = self.serializer_class(data=request.data)
+        if serializer.is_valid():
+            upload = serializer.save(note=note)
+            os.makedirs(settings.ATTACHMENT_UPLOAD_DIR, exist_ok=True)
+            open(upload.path, 'wb').close()
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    def retrieve(self, request, notebook_slug, note_slug, pk):
+        """Retrieves an upload to resume it from its offset.
+        Arguments:
+            request: the request data sent by the user, it is used
+                     to get the user's profile
+            notebook_slug: the notebook slug that the note is in
+            note_slug: the note slug that the attachment will be in
+            pk: the id of the upload.
+        Returns:
+            HTTP 403 Response if the user is
+            not logged in,
+            HTTP 404 Response if the upload is not found,
+            if not, returns HTTP 200 Response with the upload's JSON data.
+        """
+        upload = self._get_upload(request, notebook_slug, note_slug, pk)
+        return Response(self.serializer_class(upload).data, headers={'Upload-Offset': str(upload.offset)})
+
+    def partial_update(self, request, notebook_slug, note_slug, pk):
+        """Receives a chunk of an upload, the body of the request is
+        the chunk's bytes which are written to the part file of the upload
+        as they are read, the Upload-Offset header is the offset of the chunk.
+        if the request ends early the received bytes are kept,
+        and the upload can be resumed from its new offset.
+        Arguments:
+            request: the request data sent by the user, it is used
+                     to get the user's profile and the chunk.
+            notebook_slug: the notebook slug that the note is in
+            note_slug: the note slug that the attachment will be in
+            pk: the id of the upload.
+        Returns:
+            HTTP 403 Response if the user is
+            not logged in,
+            HTTP 404 Response if the upload is not found,
+            HTTP 400 Response if the Upload-Offset header is missing,
+            HTTP 409 Response if the offset is not the offset of the upload
+            or another chunk of the upload is being received,
+            HTTP 411 Response if the request has no Content-Length,
+            HTTP 413 Response if the chunk is too large or goes past the size of the upload,
+            if not, returns HTTP 200 Response with the upload's JSON data.
+        """
+        try:
+            offset = int(request.META['HTTP_UPLOAD_OFFSET'])
+        except (KeyError, ValueError):
+            return Response('The Upload-Offset header must be the offset of the chunk.',
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            length = int(request.META['CONTENT_LENGTH'])
+        except (KeyError, ValueError):
+            return Response('The chunk must have a Content-Length.', status=status.HTTP_411_LENGTH_REQUIRED)
+
+        upload = self._get_upload(request, notebook_slug, note_slug, pk)
+        try:
+            part = open(upload.path, 'r+b')
+        except FileNotFoundError:  # deleted after the upload was read
+            raise Http404
+        with part:
+            # the part file is locked while the chunk is received, the row of the
+            # upload is only locked to check the offset and to advance it, so a
+            # slow client doesn't hold a transaction and a database connection
+            try:
+                lock_part(part)
+            except PartLocked:
+                return Response('Another chunk of the upload is being received.', status=status.HTTP_409_CONFLICT,
+                                headers={'Upload-Offset': str(upload.offset)})
+            with transaction.atomic():
+                upload = self._get_upload(request, notebook_slug, note_slug, pk, lock=True)
+                if offset != upload.offset:
+                    return Response(self.serializer_class(upload).data, status=status.HTTP_409_CONFLICT,
+                                    headers={'Upload-Offset': str(upload.offset)})
+                if length > self.max_chunk_size or offset + length > upload.size:
+                    return Response('The chunk is too large.', status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+            part.seek(offset)
+            remaining = length
+            while remaining > 0:
+                block = request.stream.read(min(self.block_size, remaining))
+                if not block:
+                    break
+                part.write(block)
+                remaining -= len(block)
+            part.truncate()
+
+            with transaction.atomic():
+                upload = self._get_upload(request, notebook_slug, note_slug, pk, lock=True)
+                upload.offset = part.tell()
+                upload.save(update_fields=['offset'])
+
+        return Response(self.serializer_class(upload).data, headers={'Upload-Offset': str(upload.offset)})
+
+    @action(detail=True, methods=['post'])
+    def finish(self, request, notebook_slug, note_slug, pk):
+        """Finishes a complete upload into an attachment of its note.
+        Arguments:
+            request: the request data sent by the user, it is used
+                     to get the user's profile
+            notebook_slug: the notebook slug that the note is in
+            note_slug: the note slug that the attachment will be in
+            pk: the id of the upload.
+        Returns:
+            HTTP 403 Response if the user is
+            not logged in,
+            HTTP 404 Response if the upload is not found,
+            HTTP 409 Response if the upload didn't receive all its bytes,
+            if not, returns HTTP 201 Response with the note attachment's JSON data.
+        """
+        with transaction.atomic():
+            upload = self._get_upload(request, notebook_slug, note_slug, pk, lock=True)
+            if upload.offset != upload.size:
+                return Response(self.serializer_class(upload).data, status=status.HTTP_409_CONFLICT,
+                                headers={'Upload-Offset': str(upload.offset)})
+            attachment = upload.finish()
+            NoteModel.objects.touch(attachment.note_id)
+        return Response(NoteAttachmentSerializer(attachment).data, status=status.HTTP_201_CREATED)
+
+    def destroy(self, request, notebook_slug, note_slug, pk):
+        """Aborts an upload and deletes its part file.
+        Arguments:
+            request: the request data sent by the user, it is used
+                     to get the user's profile
+            notebook_slug: the notebook slug that the note is in
+            note_slug: the note slug that the attachment will be in
+            pk: the id of the upload.
+        Returns:
+            HTTP 404 Response if the upload is not found
+            HTTP 403 Response if the user is
+            not logged in,
+            if not, returns HTTP 204 Response with no content.
+        """
+        self._get_upload(request, notebook_slug, note_slug, pk).delete()
         return Response(status=status.HTTP_204_NO_CONTENT)